@@ -4,38 +4,119 @@ BelekBox.kg - Магазин подарочных боксов
 """
 
 import os
+import re
+import sys
 import json
 import uuid
 import shutil
+import io
+import csv
+import gzip
+import zipfile
+import posixpath
+import base64
+import hashlib
+import asyncio
+import time
+import random
+import itertools
+import bisect
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import wait as futures_wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from datetime import datetime
-from typing import Optional
+from contextlib import asynccontextmanager
+from datetime import datetime, date, timedelta
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional, NamedTuple, Union
+
+import anyio
 
 from fastapi import FastAPI, HTTPException, Depends, Request, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
+from fastapi import Header, Query
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, Response
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, Text
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Text, Index
+from sqlalchemy import Float, MetaData
+from sqlalchemy import ForeignKey, tuple_, func, exists, select
+from sqlalchemy import case, insert, update, bindparam
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from fastapi.responses import HTMLResponse, JSONResponse, FileResponse
 from pathlib import Path
 
+from PIL import UnidentifiedImageError
+
+try:
+    import brotli
+except ImportError:  # Без brotli отдаем только gzip
+    brotli = None
+
+try:
+    import orjson
+except ImportError:  # Без orjson используется стандартный json
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: миграции выполняются без блокировки
+    fcntl = None
+
+from archive import ArchivedOrder, OrderArchive, month_key
+from images import process_product_image
+from limits import IdempotencyConflict, TokenBucketLimiter
+from metrics import MetricsRegistry, MetricsMiddleware, instrument_engine
+from notify import NotificationSender, TelegramSender, WebhookSender
+from storage import (
+    UploadTooLarge,
+    stream_upload,
+    blob_dir,
+    blob_name,
+    files_exist,
+    discard,
+    remove_files,
+    remove_blobs,
+    blob_hashes,
+)
+
 # ===== КОНФИГУРАЦИЯ =====
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
-# Создаем необходимые папки если их нет
-Path("uploads/products").mkdir(parents=True, exist_ok=True)
-Path("static/css").mkdir(parents=True, exist_ok=True)
-Path("static/js").mkdir(parents=True, exist_ok=True)
-Path("static/images").mkdir(parents=True, exist_ok=True)
-Path("templates").mkdir(parents=True, exist_ok=True)
+# Папки, которые создаются при старте (prepare_storage)
+REQUIRED_DIRS = [
+    "uploads/products",
+    "tmp/uploads",
+    "archive/orders",
+    "static/css",
+    "static/js",
+    "static/images",
+    "templates",
+]
+
+# Число процессов uvicorn (python app.py). Процессы делят базу SQLite,
+# поэтому для нескольких процессов нужен SQLITE_PROFILE=production (WAL)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# Блокировка, под которой один процесс выполняет миграции при старте,
+# и файл поколения каталога: при изменении товаров файл перезаписывается,
+# и остальные процессы пересобирают свой снимок каталога
+STARTUP_LOCK_FILE = "tmp/startup.lock"
+CATALOG_GENERATION_FILE = "tmp/catalog.generation"
 
 # Настройки из .env файла
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
@@ -44,17 +125,149 @@ WHATSAPP_ORDER_NUMBER = os.getenv(
 )  # Для заказов
 CONTACT_NUMBERS = os.getenv("CONTACT_NUMBERS", "+996 500 555 626")  # Для отображения
 
+# Размер страницы заказов в админке по умолчанию и максимальный
+ORDERS_PAGE_SIZE = 50
+ORDERS_PAGE_MAX = 500
+
+# Размер страницы поиска товаров по умолчанию и максимальный
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+
+# Ограничения корзины: число позиций и количество одного товара
+CART_MAX_LINES = 100
+CART_MAX_QUANTITY = 999
+
+# Сколько заказов читается из БД за раз при выгрузке
+EXPORT_BATCH_SIZE = 1000
+
+# Архив заказов: заказы старше ARCHIVE_AFTER_DAYS дней переносятся из
+# таблицы orders в сжатые помесячные сегменты. По умолчанию выключен
+# (0 - не переносить), включается явно, например ARCHIVE_AFTER_DAYS=365.
+# Проверка раз в ARCHIVE_INTERVAL секунд, перенос пачками по
+# ARCHIVE_BATCH_SIZE заказов; переносит один процесс под блокировкой
+ARCHIVE_ROOT = "archive/orders"
+ARCHIVE_LOCK_FILE = "tmp/archive.lock"
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 6 * 3600))  # секунд
+ARCHIVE_BATCH_SIZE = 1000
+
+# Заголовок Cache-Control для каталога: браузер хранит ответ, но каждый раз
+# перепроверяет его по ETag (в ответ приходит дешевый 304)
+CATALOG_CACHE_CONTROL = os.getenv("CATALOG_CACHE_CONTROL", "public, no-cache")
+
+# Cookie, которую ставит main.js, когда каталог сохранен в браузере: такой
+# клиент получает страницу без встроенного каталога и догружает изменения
+# через /api/products?since=<ревизия>
+CATALOG_COOKIE = "catalog_cached"
+
+# Массовый импорт товаров: лимит на размер запроса (манифест и zip-архив
+# изображений) и на число товаров в импорте или перестановке
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_MB", 200)) * 1024 * 1024
+BULK_MAX_PRODUCTS = int(os.getenv("BULK_MAX_PRODUCTS", 2000))
+
+# Ширины вариантов изображений товаров (для srcset) и число процессов обработки
+IMAGE_WIDTHS = [
+    int(w) for w in os.getenv("IMAGE_WIDTHS", "320,640,1024,1600").split(",")
+]
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
+# Хранилище изображений: корень, каталог для загрузок в процессе,
+# лимит размера файла и сборка неиспользуемых файлов
+UPLOADS_ROOT = "uploads/products"
+UPLOAD_TMP_DIR = "tmp/uploads"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 10)) * 1024 * 1024
+IMAGE_GC_INTERVAL = int(os.getenv("IMAGE_GC_INTERVAL", 600))  # секунд
+IMAGE_GC_GRACE = int(os.getenv("IMAGE_GC_GRACE", 3600))  # секунд
+
+# Пакетная запись заказов: заказы копятся в очереди и записываются одной
+# транзакцией раз в ORDER_BATCH_WINDOW_MS или по ORDER_BATCH_SIZE штук.
+# Если в очереди больше ORDER_QUEUE_MAX заказов, новые получают 503
+ORDER_BATCHING = os.getenv("ORDER_BATCHING", "false").lower() == "true"
+ORDER_BATCH_SIZE = int(os.getenv("ORDER_BATCH_SIZE", 50))
+ORDER_BATCH_WINDOW_MS = int(os.getenv("ORDER_BATCH_WINDOW_MS", 5))
+ORDER_QUEUE_MAX = int(os.getenv("ORDER_QUEUE_MAX", 1000))
+ORDER_COMMIT_TIMEOUT = 30  # секунд
+
+# Живая лента заказов для админки (SSE): заказы этого процесса рассылаются
+# сразу, других процессов - после опроса БД раз в ORDER_FEED_POLL секунд.
+# Клиенту, который отстал больше чем на ORDER_FEED_BACKLOG заказов,
+# предлагается перезагрузить список целиком
+ORDER_FEED_POLL = float(os.getenv("ORDER_FEED_POLL", 2))  # секунд
+ORDER_FEED_HEARTBEAT = 15  # секунд
+ORDER_FEED_BACKLOG = 500
+ORDER_FEED_QUEUE = 100  # Событий в очереди подключения
+
+# Уведомления о новых заказах операторам (включаются своими переменными):
+# вебхук магазина и/или Telegram-бот. Уведомления пишутся в outbox вместе
+# с заказом и отправляются в фоне раз в NOTIFY_INTERVAL секунд (и сразу
+# после заказа); при ошибке повтор через NOTIFY_BACKOFF_BASE * 2^n секунд,
+# но не больше NOTIFY_BACKOFF_MAX, всего NOTIFY_MAX_ATTEMPTS попыток
+NOTIFY_WEBHOOK_URL = os.getenv("NOTIFY_WEBHOOK_URL")
+NOTIFY_WEBHOOK_SECRET = os.getenv("NOTIFY_WEBHOOK_SECRET")
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+NOTIFY_INTERVAL = float(os.getenv("NOTIFY_INTERVAL", 5))  # секунд
+NOTIFY_TIMEOUT = float(os.getenv("NOTIFY_TIMEOUT", 10))  # секунд
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 10))
+NOTIFY_BACKOFF_BASE = float(os.getenv("NOTIFY_BACKOFF_BASE", 5))  # секунд
+NOTIFY_BACKOFF_MAX = float(os.getenv("NOTIFY_BACKOFF_MAX", 3600))  # секунд
+NOTIFY_LEASE = 300  # секунд: столько пачка считается занятой одним процессом
+
+# Повторы заказов с тем же Idempotency-Key отдают сохраненный результат
+# в течение IDEMPOTENCY_TTL секунд
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+
+# Ограничение частоты заказов с одного IP и одного телефона:
+# ORDER_RATE_BURST подряд, дальше ORDER_RATE_PER_MINUTE в минуту.
+# TRUST_PROXY_HEADERS - брать IP клиента из X-Forwarded-For (за прокси)
+ORDER_RATE_PER_MINUTE = float(os.getenv("ORDER_RATE_PER_MINUTE", 6))
+ORDER_RATE_BURST = int(os.getenv("ORDER_RATE_BURST", 5))
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "false").lower() == "true"
+# Ключи и корзины хранятся в БД (общие для всех воркеров); истекшие
+# удаляются не чаще раза в PROTECTION_PURGE_INTERVAL секунд
+PROTECTION_PURGE_INTERVAL = 300
+
+# Метрики (/metrics): запросы дольше SLOW_REQUEST_MS попадают в лог
+# с вероятностью SLOW_LOG_SAMPLE. Если задан METRICS_TOKEN, /metrics
+# требует заголовок Authorization: Bearer <токен>
+SLOW_REQUEST_MS = int(os.getenv("SLOW_REQUEST_MS", 500))
+SLOW_LOG_SAMPLE = float(os.getenv("SLOW_LOG_SAMPLE", 0.1))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Перечитывать HTML-шаблоны при изменении файла (для разработки)
+TEMPLATES_AUTO_RELOAD = os.getenv("TEMPLATES_AUTO_RELOAD", "false").lower() == "true"
+
+# Сборка JS/CSS при старте: минификация, хеш в имени файла, сжатие.
+# Для разработки можно отключить и отдавать исходники из /static
+STATIC_BUILD = os.getenv("STATIC_BUILD", "true").lower() == "true"
+STATIC_BUILD_DIR = "build/assets"
+
 # Базовый путь
 BASE_DIR = Path(__file__).parent
 
 # ===== ИНИЦИАЛИЗАЦИЯ FASTAPI =====
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Запуск и остановка приложения (сами шаги - в разделе ЖИЗНЕННЫЙ ЦИКЛ).
+    """
+    await startup()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+
 app = FastAPI(
     title="BelekBox.kg",
     description="Магазин подарочных боксов с доставкой по Кыргызстану",
     version="1.0.0",
     docs_url="/docs",  # Включить документацию API
     redoc_url="/redoc",  # Альтернативная документация
+    lifespan=lifespan,
 )
 
 # Настройка CORS (разрешаем доступ с любых доменов)
@@ -66,25 +279,138 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class UploadSizeLimitMiddleware:
+    """
+    Отклоняет загрузку товаров с Content-Length больше лимита до чтения тела.
+    Загрузки без Content-Length ограничивает stream_upload.
+    """
+
+    def __init__(self, app, max_bytes: int, path_prefix: str):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.path_prefix):
+            content_length = dict(scope["headers"]).get(b"content-length")
+            response = None
+            if content_length:
+                try:
+                    size = int(content_length)
+                except ValueError:
+                    size = None
+                if size is None or size < 0:
+                    response = JSONResponse(
+                        status_code=400,
+                        content={"detail": "Неверный заголовок Content-Length"},
+                    )
+                # Запас на поля формы и границы multipart
+                elif size > self.max_bytes + 64 * 1024:
+                    response = JSONResponse(
+                        status_code=413,
+                        content={"detail": "Файл слишком большой"},
+                    )
+            if response is not None:
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=MAX_UPLOAD_BYTES,
+    path_prefix="/api/admin/products",
+)
+app.add_middleware(
+    UploadSizeLimitMiddleware,
+    max_bytes=MAX_IMPORT_BYTES,
+    path_prefix="/api/admin/import",
+)
+
+# Метрики запросов (добавляется последним, чтобы учитывать все остальное)
+metrics = MetricsRegistry()
+app.add_middleware(
+    MetricsMiddleware,
+    registry=metrics,
+    slow_request_seconds=SLOW_REQUEST_MS / 1000,
+    slow_log_sample=SLOW_LOG_SAMPLE,
+)
+
 # ===== СТАТИЧЕСКИЕ ФАЙЛЫ =====
 
-# Подключаем статические файлы
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Подключаем статические файлы (папки создаются при старте)
+app.mount("/uploads", StaticFiles(directory="uploads", check_dir=False), name="uploads")
+app.mount("/static", StaticFiles(directory="static", check_dir=False), name="static")
 
 # ===== БАЗА ДАННЫХ =====
 
 # SQLite база данных
-SQLALCHEMY_DATABASE_URL = "sqlite:///./database.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./database.db")
+
+# Профили настроек SQLite (PRAGMA), применяются к каждому новому соединению.
+# production: WAL позволяет читать во время записи, busy_timeout заставляет
+# писателей ждать блокировку вместо ошибки "database is locked"
+SQLITE_PROFILES = {
+    "production": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "mmap_size": 268435456,  # 256 МБ
+        "cache_size": -65536,  # 64 МБ (отрицательное значение - в КиБ)
+        "temp_store": "MEMORY",
+    },
+    "default": {},
+}
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production")
+# Внешние ключи включены в любом профиле: без них не работают ON DELETE
+SQLITE_PRAGMAS = {"foreign_keys": "ON", **SQLITE_PROFILES[SQLITE_PROFILE]}
+
+# Точечные переопределения: SQLITE_PRAGMAS="busy_timeout=10000,mmap_size=0"
+for pragma in filter(None, os.getenv("SQLITE_PRAGMAS", "").split(",")):
+    pragma_name, _, pragma_value = pragma.partition("=")
+    SQLITE_PRAGMAS[pragma_name.strip()] = pragma_value.strip()
+
+# Обработчики, работающие с БД, объявлены через обычный def: FastAPI
+# выполняет их в пуле потоков, и запросы к SQLite не блокируют event loop.
+# Пул соединений должен покрывать число потоков, иначе они будут ждать друг друга.
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", 40))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
 
 # Создаем движок базы данных
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}  # Для SQLite
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},  # Для SQLite
+    pool_size=DB_POOL_SIZE,
+    max_overflow=max(THREADPOOL_SIZE - DB_POOL_SIZE, 0),
 )
 
+
+@event.listens_for(engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Применяет PRAGMA выбранного профиля к новому соединению SQLite.
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+# Замер времени SQL-запросов для /metrics
+instrument_engine(engine, metrics)
+
 # Создаем фабрику сессий
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+@event.listens_for(SessionLocal, "after_commit")
+def keep_new_images(session):
+    """
+    После коммита новые изображения записаны в image_files, их файлы нужны.
+    """
+    session.info.pop("new_images", None)
+
 # Базовый класс для моделей
 Base = declarative_base()
 
@@ -104,14 +430,84 @@ class Product(Base):
     description = Column(Text, nullable=False)  # Описание
     price = Column(Integer, nullable=False)  # Цена в сомах
     image_url = Column(String)  # URL изображения товара
+    image_variants = Column(Text)  # Варианты изображения (WebP/JPEG) в JSON
+    image_hash = Column(String, index=True)  # Файл изображения (image_files.hash)
     is_available = Column(Boolean, default=True)  # Доступен для заказа
     sort_order = Column(Integer, default=0)  # Порядок сортировки
+    revision = Column(Integer, nullable=False, default=0)  # Ревизия каталога
     created_at = Column(DateTime, default=datetime.now)  # Дата создания
+    updated_at = Column(
+        DateTime, default=datetime.now, onupdate=datetime.now
+    )  # Дата изменения
+
+    __table_args__ = (
+        # Витрина: доступные товары в порядке сортировки
+        Index("ix_products_available_sort", "is_available", "sort_order", "id"),
+        # id удаленных товаров не выдаются повторно: на них ссылается
+        # история продаж (order_items, daily_product_sales)
+        {"sqlite_autoincrement": True},
+    )
 
     def __repr__(self):
         return f"<Product(id={self.id}, name='{self.name}', price={self.price})>"
 
 
+class ProductTombstone(Base):
+    """
+    Удаленный товар
+    Нужен, чтобы клиенты с сохраненным каталогом узнали об удалении
+    """
+
+    __tablename__ = "product_tombstones"
+
+    product_id = Column(Integer, primary_key=True)  # id удаленного товара
+    revision = Column(Integer, nullable=False)  # Ревизия каталога при удалении
+    deleted_at = Column(DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<ProductTombstone(product_id={self.product_id}, revision={self.revision})>"
+
+
+class CatalogRevision(Base):
+    """
+    Ревизия каталога (одна строка)
+    Увеличивается при каждом изменении товаров в админке; товары
+    и записи об удалении помечаются ревизией, в которой изменились
+    """
+
+    __tablename__ = "catalog_revision"
+
+    id = Column(Integer, primary_key=True)
+    revision = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<CatalogRevision(revision={self.revision})>"
+
+
+class ImageFile(Base):
+    """
+    Модель файла изображения
+    Файлы хранятся по хешу содержимого и могут использоваться несколькими
+    товарами; ref_count - число товаров, которые на него ссылаются
+    """
+
+    __tablename__ = "image_files"
+
+    hash = Column(String, primary_key=True)  # SHA-256 загруженного файла
+    image_url = Column(String, nullable=False)  # Основное изображение
+    variants = Column(Text)  # Варианты изображения в JSON
+    files = Column(Text, nullable=False)  # Все файлы (пути от UPLOADS_ROOT) в JSON
+    size = Column(Integer)  # Размер загрузки в байтах
+    ref_count = Column(Integer, nullable=False, default=0)  # Число товаров
+    released_at = Column(DateTime)  # Когда перестал использоваться
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (Index("ix_image_files_orphans", "ref_count", "released_at"),)
+
+    def __repr__(self):
+        return f"<ImageFile(hash='{self.hash[:12]}', ref_count={self.ref_count})>"
+
+
 class Order(Base):
     """
     Модель заказа
@@ -130,186 +526,3360 @@ class Order(Base):
     total_amount = Column(Integer, nullable=False)  # Общая сумма заказа
     created_at = Column(DateTime, default=datetime.now)  # Дата создания заказа
 
+    # Позиции заказа в нормализованном виде
+    order_items = relationship(
+        "OrderItem", back_populates="order", cascade="all, delete-orphan"
+    )
+    # Уведомления операторам (outbox)
+    notifications = relationship(
+        "OrderNotification", back_populates="order", cascade="all, delete-orphan"
+    )
+    # Ключ Idempotency-Key, с которым создан заказ
+    idempotency_key = relationship(
+        "IdempotencyKey",
+        back_populates="order",
+        uselist=False,
+        cascade="all, delete-orphan",
+    )
+
+    __table_args__ = (
+        # Для постраничной выдачи заказов (сначала новые)
+        Index("ix_orders_created_at_id", "created_at", "id"),
+    )
+
     def __repr__(self):
         return f"<Order(id={self.id}, order_number='{self.order_number}', total={self.total_amount})>"
 
 
-# Создаем таблицы в базе данных (если их нет)
-Base.metadata.create_all(bind=engine)
+class OrderItem(Base):
+    """
+    Модель позиции заказа
+    Копия товаров из items_json для агрегатных запросов по продажам
+    """
+
+    __tablename__ = "order_items"
 
-# ===== ЗАВИСИМОСТИ =====
+    id = Column(Integer, primary_key=True)
+    order_id = Column(
+        Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    product_id = Column(
+        Integer, ForeignKey("products.id", ondelete="SET NULL")
+    )  # Товар (может быть уже удален)
+    name = Column(String, nullable=False)  # Название на момент заказа
+    price = Column(Integer, nullable=False)  # Цена на момент заказа
+    quantity = Column(Integer, nullable=False)  # Количество
+    created_at = Column(DateTime, nullable=False)  # Дата заказа (для отчетов)
 
+    order = relationship("Order", back_populates="order_items")
 
-def get_db():
+    __table_args__ = (
+        # Покрывающий индекс для отчетов по продажам за период
+        Index(
+            "ix_order_items_created_product",
+            "created_at",
+            "product_id",
+            "quantity",
+            "price",
+        ),
+        Index("ix_order_items_product_created", "product_id", "created_at"),
+    )
+
+    def __repr__(self):
+        return f"<OrderItem(order_id={self.order_id}, product_id={self.product_id}, quantity={self.quantity})>"
+
+
+class OrderNotification(Base):
     """
-    Зависимость для получения сессии базы данных.
-    Гарантирует закрытие сессии после использования.
+    Модель уведомления о заказе (outbox)
+    Пишется в одной транзакции с заказом, отправляется фоновым циклом
     """
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
 
+    __tablename__ = "order_notifications"
 
-# ===== УТИЛИТЫ =====
+    id = Column(Integer, primary_key=True)
+    order_id = Column(
+        Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    channel = Column(String, nullable=False)  # Отправитель (webhook, telegram)
+    payload = Column(Text, nullable=False)  # Содержимое уведомления в JSON
+    status = Column(String, nullable=False, default="pending")  # pending/sent/failed
+    attempts = Column(Integer, nullable=False, default=0)  # Неудачных попыток
+    next_attempt_at = Column(DateTime, nullable=False)  # Когда отправлять
+    claim = Column(String)  # Метка процесса, который сейчас отправляет
+    last_error = Column(String)  # Последняя ошибка отправки
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime)
 
+    order = relationship("Order", back_populates="notifications")
 
-def generate_order_number() -> str:
+    __table_args__ = (
+        # Выборка уведомлений, которые пора отправить
+        Index("ix_order_notifications_due", "status", "channel", "next_attempt_at"),
+    )
+
+    def __repr__(self):
+        return f"<OrderNotification(id={self.id}, channel='{self.channel}', status='{self.status}')>"
+
+
+class IdempotencyKey(Base):
     """
-    Генерирует уникальный номер заказа.
-    Формат: BB-YYYYMMDD-XXXXXX (где XXXXXX - случайная строка)
+    Модель ключа Idempotency-Key заказа
+    Пишется в одной транзакции с заказом вместе с ответом клиенту: повтор
+    с тем же ключом в любом процессе отдает этот ответ, а параллельный
+    повтор упирается в первичный ключ и не создает второй заказ
     """
-    date_str = datetime.now().strftime("%Y%m%d")
-    random_part = uuid.uuid4().hex[:6].upper()
-    return f"BB-{date_str}-{random_part}"
 
+    __tablename__ = "idempotency_keys"
 
-def create_whatsapp_message(
-    order_number: str,
-    items: list,
-    total_amount: int,
-    client_phone: Optional[str],
-    client_comment: Optional[str],
-) -> str:
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)  # Хеш данных запроса
+    order_id = Column(
+        Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    response = Column(Text, nullable=False)  # Ответ клиенту в JSON
+    created_at = Column(DateTime, nullable=False, index=True)
+
+    order = relationship("Order", back_populates="idempotency_key")
+
+    def __repr__(self):
+        return f"<IdempotencyKey(key='{self.key}', order_id={self.order_id})>"
+
+
+class RateBucket(Base):
     """
-    Создает сообщение для WhatsApp с информацией о заказе.
+    Модель корзины ограничителя частоты заказов (общая для всех процессов)
     """
-    import urllib.parse
 
-    message = "Здравствуйте! Хочу заказать:\n\n"
-    message += f"Заказ #{order_number}\n\n"
-    message += "Товары:\n"
+    __tablename__ = "rate_buckets"
+
+    key = Column(String, primary_key=True)  # ip:<адрес> или phone:<цифры>
+    tokens = Column(Float, nullable=False)
+    updated = Column(Float, nullable=False, index=True)  # time.time()
+
+    def __repr__(self):
+        return f"<RateBucket(key='{self.key}', tokens={self.tokens:.2f})>"
+
+
+class DailySales(Base):
+    """
+    Продажи за день
+    Обновляется при каждом заказе, чтобы аналитика не сканировала orders
+    """
+
+    __tablename__ = "daily_sales"
+
+    day = Column(Date, primary_key=True)  # День
+    orders_count = Column(Integer, nullable=False, default=0)  # Число заказов
+    revenue = Column(Integer, nullable=False, default=0)  # Сумма заказов
+    units = Column(Integer, nullable=False, default=0)  # Продано штук
+
+    def __repr__(self):
+        return f"<DailySales(day={self.day}, orders={self.orders_count}, revenue={self.revenue})>"
+
+
+class DailyProductSales(Base):
+    """
+    Продажи товара за день
+    product_id = 0 для позиций без известного товара
+    """
+
+    __tablename__ = "daily_product_sales"
+
+    day = Column(Date, primary_key=True)  # День
+    product_id = Column(Integer, primary_key=True)  # Товар
+    name = Column(String, nullable=False)  # Последнее название товара
+    units = Column(Integer, nullable=False, default=0)  # Продано штук
+    revenue = Column(Integer, nullable=False, default=0)  # Выручка
+
+    def __repr__(self):
+        return f"<DailyProductSales(day={self.day}, product_id={self.product_id}, units={self.units})>"
+
+
+def order_items_from_json(items_data: list, created_at: datetime) -> list:
+    """
+    Преобразует товары из корзины (items_json) в позиции заказа.
+    """
+    order_items = []
+    for item in items_data:
+        try:
+            product_id = item.get("id")
+            order_items.append(
+                OrderItem(
+                    product_id=int(product_id) if product_id is not None else None,
+                    name=str(item["name"]),
+                    price=int(item["price"]),
+                    quantity=int(item["quantity"]),
+                    created_at=created_at,
+                )
+            )
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise ValueError("Неверный формат товаров")
+    return order_items
+
+
+def record_daily_sales(db: Session, order: Order) -> None:
+    """
+    Добавляет заказ в дневные итоги (в той же транзакции, что и заказ).
+    """
+    day = order.created_at.date()
+
+    stmt = sqlite_insert(DailySales).values(
+        day=day,
+        orders_count=1,
+        revenue=order.total_amount,
+        units=sum(item.quantity for item in order.order_items),
+    )
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["day"],
+            set_={
+                "orders_count": DailySales.orders_count + 1,
+                "revenue": DailySales.revenue + stmt.excluded.revenue,
+                "units": DailySales.units + stmt.excluded.units,
+            },
+        )
+    )
+
+    for item in order.order_items:
+        stmt = sqlite_insert(DailyProductSales).values(
+            day=day,
+            product_id=item.product_id or 0,
+            name=item.name,
+            units=item.quantity,
+            revenue=item.quantity * item.price,
+        )
+        db.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["day", "product_id"],
+                set_={
+                    "name": stmt.excluded.name,
+                    "units": DailyProductSales.units + stmt.excluded.units,
+                    "revenue": DailyProductSales.revenue + stmt.excluded.revenue,
+                },
+            )
+        )
+
+
+def rebuild_sales_rollups(conn) -> None:
+    """
+    Пересчитывает дневные итоги по всей истории заказов,
+    включая заказы, перенесенные в архив.
+    """
+    conn.execute(text("DELETE FROM daily_sales"))
+    conn.execute(text("DELETE FROM daily_product_sales"))
+    conn.execute(
+        text(
+            """
+            INSERT INTO daily_sales (day, orders_count, revenue, units)
+            SELECT date(o.created_at), COUNT(*), SUM(o.total_amount),
+                   COALESCE(SUM(
+                       (SELECT SUM(i.quantity) FROM order_items i
+                        WHERE i.order_id = o.id)
+                   ), 0)
+            FROM orders o
+            WHERE o.created_at IS NOT NULL
+            GROUP BY date(o.created_at)
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            INSERT INTO daily_product_sales (day, product_id, name, units, revenue)
+            SELECT date(created_at), COALESCE(product_id, 0), MAX(name),
+                   SUM(quantity), SUM(quantity * price)
+            FROM order_items
+            GROUP BY date(created_at), COALESCE(product_id, 0)
+            """
+        )
+    )
+    add_archived_sales(conn)
+
+
+def add_archived_sales(conn) -> None:
+    """
+    Добавляет в дневные итоги заказы из архива: их уже нет в orders
+    и order_items. Заказы, которые еще остались в БД (перенос прервался
+    до удаления), уже посчитаны и пропускаются.
+    """
+    if not order_archive.months():
+        return
+    in_db = set(conn.execute(select(Order.order_number)).scalars())
+
+    days: Dict[date, list] = {}  # день -> [заказов, выручка, штук]
+    products: Dict[tuple, list] = {}  # (день, товар) -> [название, штук, выручка]
+    for order in order_archive.scan():
+        if order.order_number in in_db:
+            continue
+        try:
+            items = order_items_from_json(
+                json.loads(order.items_json), order.created_at
+            )
+        except ValueError:
+            items = []  # Как и в БД: у заказа с поврежденными товарами нет позиций
+
+        day = order.created_at.date()
+        totals = days.setdefault(day, [0, 0, 0])
+        totals[0] += 1
+        totals[1] += order.total_amount
+        totals[2] += sum(item.quantity for item in items)
+        for item in items:
+            entry = products.setdefault((day, item.product_id or 0), [item.name, 0, 0])
+            entry[0] = max(entry[0], item.name)
+            entry[1] += item.quantity
+            entry[2] += item.quantity * item.price
+
+    if days:
+        stmt = sqlite_insert(DailySales)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["day"],
+                set_={
+                    "orders_count": DailySales.orders_count
+                    + stmt.excluded.orders_count,
+                    "revenue": DailySales.revenue + stmt.excluded.revenue,
+                    "units": DailySales.units + stmt.excluded.units,
+                },
+            ),
+            [
+                {"day": day, "orders_count": count, "revenue": revenue, "units": units}
+                for day, (count, revenue, units) in days.items()
+            ],
+        )
+    if products:
+        stmt = sqlite_insert(DailyProductSales)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["day", "product_id"],
+                set_={
+                    "name": func.max(DailyProductSales.name, stmt.excluded.name),
+                    "units": DailyProductSales.units + stmt.excluded.units,
+                    "revenue": DailyProductSales.revenue + stmt.excluded.revenue,
+                },
+            ),
+            [
+                {
+                    "day": day,
+                    "product_id": product_id,
+                    "name": name,
+                    "units": units,
+                    "revenue": revenue,
+                }
+                for (day, product_id), (name, units, revenue) in products.items()
+            ],
+        )
+
+
+def backfill_order_items(conn, batch_size: int = 500):
+    """
+    Заполняет order_items для заказов, созданных до появления таблицы.
+    Заказы с поврежденным items_json пропускаются.
+    """
+    db = Session(bind=conn)
+    last_id = 0
+    while True:
+        orders = (
+            db.query(Order)
+            .filter(Order.id > last_id)
+            .filter(~exists().where(OrderItem.order_id == Order.id))
+            .order_by(Order.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not orders:
+            break
+
+        for order in orders:
+            try:
+                order.order_items = order_items_from_json(
+                    json.loads(order.items_json), order.created_at or datetime.now()
+                )
+            except ValueError:
+                continue
+        db.flush()
+        last_id = orders[-1].id
+        db.expunge_all()
+
+
+# ===== ПОИСК =====
+
+# Приведение текста для поиска: ё -> е, кыргызские ң/ө/ү -> н/о/у
+# (покупатели часто пишут без кыргызской раскладки)
+SEARCH_TRANSLATION = str.maketrans({"ё": "е", "ң": "н", "ө": "о", "ү": "у"})
+
+
+def normalize_search_text(value: Optional[str]) -> str:
+    """
+    Нормализует текст для полнотекстового индекса и поисковых запросов.
+    """
+    return (value or "").casefold().translate(SEARCH_TRANSLATION)
+
+
+def search_match_query(query: str) -> Optional[str]:
+    """
+    Строит выражение MATCH для FTS5: каждое слово ищется по префиксу,
+    все слова должны встретиться. None, если в запросе нет слов.
+    """
+    words = re.findall(r"\w+", normalize_search_text(query))
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def index_product(db, product: Product) -> None:
+    """
+    Обновляет запись товара в поисковом индексе (products_fts).
+    Вызывается в той же транзакции, что и изменение товара.
+    """
+    index_products(db, [product])
+
+
+def index_products(db, products: list) -> None:
+    """
+    Обновляет записи нескольких товаров в поисковом индексе
+    (по одному executemany на удаление и вставку).
+    """
+    if not products:
+        return
+    db.execute(
+        text("DELETE FROM products_fts WHERE rowid = :id"),
+        [{"id": product.id} for product in products],
+    )
+    db.execute(
+        text(
+            "INSERT INTO products_fts (rowid, name, description) "
+            "VALUES (:id, :name, :description)"
+        ),
+        [
+            {
+                "id": product.id,
+                "name": normalize_search_text(product.name),
+                "description": normalize_search_text(product.description),
+            }
+            for product in products
+        ],
+    )
+
+
+def unindex_product(db, product_id: int) -> None:
+    """
+    Удаляет товар из поискового индекса.
+    """
+    db.execute(text("DELETE FROM products_fts WHERE rowid = :id"), {"id": product_id})
+
+
+def rebuild_search_index(conn) -> None:
+    """
+    Создает поисковый индекс товаров и заполняет его заново.
+    """
+    conn.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS products_fts "
+            "USING fts5(name, description, tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+    conn.execute(text("DELETE FROM products_fts"))
+    # Нормализация текста - на Python, поэтому не INSERT ... SELECT,
+    # а один executemany на весь каталог
+    products = conn.execute(
+        select(Product.id, Product.name, Product.description)
+    ).all()
+    if not products:
+        return
+    conn.execute(
+        text(
+            "INSERT INTO products_fts (rowid, name, description) "
+            "VALUES (:id, :name, :description)"
+        ),
+        [
+            {
+                "id": product.id,
+                "name": normalize_search_text(product.name),
+                "description": normalize_search_text(product.description),
+            }
+            for product in products
+        ],
+    )
+
+
+# ===== МИГРАЦИИ =====
+
+
+def add_column_if_missing(conn, table: str, column: str, column_type: str) -> None:
+    """
+    Добавляет колонку в существующую таблицу, если ее еще нет.
+    """
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
+
+
+def create_index_if_missing(conn, index: Index) -> None:
+    """
+    Создает индекс модели в существующей таблице.
+    """
+    index.create(conn, checkfirst=True)
+
+
+def index_of(model, name: str) -> Index:
+    """
+    Находит индекс модели по имени.
+    """
+    return next(i for i in model.__table__.indexes if i.name == name)
+
+
+def register_legacy_images(conn) -> None:
+    """
+    Заводит записи image_files для изображений, загруженных до появления
+    хранилища по хешу, чтобы на них тоже работал подсчет ссылок.
+    """
+    rows = conn.execute(
+        select(Product.id, Product.image_url, Product.image_variants).where(
+            Product.image_url.isnot(None), Product.image_hash.is_(None)
+        )
+    ).all()
+
+    images = {}
+    for row in rows:
+        image = images.setdefault(
+            row.image_url, {"variants": row.image_variants, "product_ids": []}
+        )
+        image["product_ids"].append(row.id)
+
+    prefix = "/uploads/products/"
+    for image_url, image in images.items():
+        content_hash = "legacy-" + hashlib.sha1(image_url.encode()).hexdigest()
+        files = set()
+        if image_url.startswith(prefix):
+            files.add(image_url[len(prefix):])
+        if image["variants"]:
+            for fmt_variants in json.loads(image["variants"]).values():
+                files.update(v["file"] for v in fmt_variants)
+
+        conn.execute(
+            ImageFile.__table__.insert().values(
+                hash=content_hash,
+                image_url=image_url,
+                variants=image["variants"],
+                files=json.dumps(sorted(files)),
+                ref_count=len(image["product_ids"]),
+                created_at=datetime.now(),
+            )
+        )
+        conn.execute(
+            Product.__table__.update()
+            .where(Product.id.in_(image["product_ids"]))
+            .values(image_hash=content_hash)
+        )
+
+
+def add_product_revisions(conn) -> None:
+    """
+    Добавляет товарам ревизию каталога и дату изменения.
+    Существующие товары получают ревизию 0.
+    """
+    add_column_if_missing(conn, "products", "revision", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(conn, "products", "updated_at", "DATETIME")
+    conn.execute(
+        Product.__table__.update()
+        .where(Product.updated_at.is_(None))
+        .values(updated_at=Product.created_at)
+    )
+
+
+def rebuild_products_autoincrement(conn) -> None:
+    """
+    Перестраивает products с AUTOINCREMENT (порядок из документации SQLite:
+    новая таблица, копия строк, DROP, RENAME). Счетчик id ставится не ниже
+    любого id, который встречается в истории продаж и удаленных товарах.
+    """
+    table_sql = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'products'")
+    ).scalar()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+
+    table = Product.__table__
+    new_table = table.to_metadata(MetaData(), name="products_new")
+    new_table.indexes.clear()
+    new_table.create(conn)
+    columns = ", ".join(c.name for c in table.columns)
+    conn.execute(
+        text(f"INSERT INTO products_new ({columns}) SELECT {columns} FROM products")
+    )
+    conn.execute(text("DROP TABLE products"))
+    conn.execute(text("ALTER TABLE products_new RENAME TO products"))
+    for index in table.indexes:
+        index.create(conn)
+
+    last_id = conn.execute(
+        text(
+            "SELECT MAX(id) FROM ("
+            "SELECT MAX(id) AS id FROM products "
+            "UNION ALL SELECT MAX(product_id) FROM order_items "
+            "UNION ALL SELECT MAX(product_id) FROM daily_product_sales "
+            "UNION ALL SELECT MAX(product_id) FROM product_tombstones)"
+        )
+    ).scalar()
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'products'"))
+    conn.execute(
+        text("INSERT INTO sqlite_sequence (name, seq) VALUES ('products', :seq)"),
+        {"seq": last_id or 0},
+    )
+
+
+# Версионированные миграции: (версия, описание, функция(conn)).
+# Новые таблицы создает create_all; миграции меняют уже существующие
+# таблицы и данные, поэтому каждая написана так, чтобы ее можно было
+# безопасно применить и к только что созданной базе.
+MIGRATIONS = [
+    (
+        1,
+        "products.image_variants",
+        lambda conn: add_column_if_missing(conn, "products", "image_variants", "TEXT"),
+    ),
+    (
+        2,
+        "orders: индекс по дате",
+        lambda conn: create_index_if_missing(
+            conn, index_of(Order, "ix_orders_created_at_id")
+        ),
+    ),
+    (3, "order_items из items_json", backfill_order_items),
+    (4, "дневные итоги продаж", rebuild_sales_rollups),
+    (
+        5,
+        "products: индекс витрины",
+        lambda conn: create_index_if_missing(
+            conn, index_of(Product, "ix_products_available_sort")
+        ),
+    ),
+    (
+        6,
+        "products.image_hash",
+        lambda conn: (
+            add_column_if_missing(conn, "products", "image_hash", "VARCHAR"),
+            create_index_if_missing(conn, index_of(Product, "ix_products_image_hash")),
+        ),
+    ),
+    (7, "image_files для старых изображений", register_legacy_images),
+    (8, "поисковый индекс товаров", rebuild_search_index),
+    (9, "products.revision и updated_at", add_product_revisions),
+    (10, "products: AUTOINCREMENT", rebuild_products_autoincrement),
+]
+
+
+def run_migrations() -> None:
+    """
+    Создает недостающие таблицы и применяет новые миграции.
+    Каждая миграция выполняется в своей транзакции вместе с записью версии.
+    """
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INTEGER PRIMARY KEY, name TEXT NOT NULL, "
+                "applied_at DATETIME NOT NULL)"
+            )
+        )
+        applied = {
+            row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))
+        }
+
+    for version, name, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.connect() as conn:
+            # Перестройка таблицы (DROP + RENAME) не должна запускать ON DELETE
+            # у ссылающихся таблиц. PRAGMA действует только вне транзакции,
+            # поэтому транзакция начинается явно уже после нее
+            conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            try:
+                begin_write(conn)
+                migrate(conn)
+                conn.execute(
+                    text(
+                        "INSERT INTO schema_migrations (version, name, applied_at) "
+                        "VALUES (:version, :name, :applied_at)"
+                    ),
+                    {"version": version, "name": name, "applied_at": datetime.now()},
+                )
+                conn.commit()
+            finally:
+                conn.rollback()
+                conn.exec_driver_sql(
+                    f"PRAGMA foreign_keys={SQLITE_PRAGMAS['foreign_keys']}"
+                )
+
+
+def prepare_storage() -> None:
+    """
+    Создает папки и применяет миграции.
+    При нескольких процессах миграции выполняет первый, остальные ждут
+    его на файловой блокировке и видят уже примененные версии.
+    """
+    for directory in REQUIRED_DIRS:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+
+    with open(STARTUP_LOCK_FILE, "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            run_migrations()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# ===== ЖИЗНЕННЫЙ ЦИКЛ =====
+
+
+async def startup():
+    """
+    Подготовка процесса при старте.
+    """
+    configure_threadpool()
+    await anyio.to_thread.run_sync(prepare_storage)
+    await anyio.to_thread.run_sync(prepare_pages)
+    start_image_gc()
+    start_order_archiver()
+    order_feed.start()
+    notification_dispatcher.start()
+
+
+async def shutdown():
+    """
+    Остановка фоновых задач и пулов.
+    """
+    stop_image_gc()
+    stop_order_archiver()
+    order_feed.stop()
+    notification_dispatcher.stop()
+    await anyio.to_thread.run_sync(stop_order_writer)
+    await anyio.to_thread.run_sync(shutdown_image_pool)
+
+
+def configure_threadpool():
+    """
+    Настраивает размер пула потоков для синхронных обработчиков.
+    """
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = THREADPOOL_SIZE
+
+
+def prepare_pages():
+    """
+    Собирает статику и загружает сжатые HTML-шаблоны при старте.
+    """
+    if STATIC_BUILD:
+        build_static_assets()
+    for path in PAGE_TEMPLATES.values():
+        page_cache.get(path)
+
+
+def start_image_gc():
+    """
+    Запускает фоновую очистку неиспользуемых изображений.
+    """
+    global _image_gc_task
+    _image_gc_task = asyncio.create_task(image_gc_loop())
+
+
+def stop_image_gc():
+    """
+    Останавливает фоновую очистку изображений.
+    """
+    if _image_gc_task is not None:
+        _image_gc_task.cancel()
+
+
+def start_order_archiver():
+    """
+    Запускает фоновый перенос старых заказов в архив.
+    """
+    global _archive_task
+    if ARCHIVE_AFTER_DAYS > 0:
+        _archive_task = asyncio.create_task(order_archive_loop())
+
+
+def stop_order_archiver():
+    """
+    Останавливает перенос заказов в архив.
+    """
+    if _archive_task is not None:
+        _archive_task.cancel()
+
+
+def stop_order_writer():
+    """
+    Дописывает заказы из очереди перед остановкой.
+    """
+    if order_writer is not None:
+        order_writer.stop()
+
+
+def shutdown_image_pool():
+    """
+    Останавливает пул процессов обработки изображений.
+    """
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=True)
+
+
+# ===== ЗАВИСИМОСТИ =====
+
+
+def get_db():
+    """
+    Зависимость для получения сессии базы данных.
+    Гарантирует закрытие сессии после использования.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+        # Изображения, обработанные в незафиксированной транзакции
+        remove_unreferenced_images(db.info.pop("new_images", ()))
+
+
+# ===== УТИЛИТЫ =====
+
+
+def begin_write(conn) -> None:
+    """
+    Начинает транзакцию сразу с блокировкой записи (BEGIN IMMEDIATE):
+    прочитанное в ней не изменится другими процессами до коммита.
+    """
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def generate_order_number() -> str:
+    """
+    Генерирует уникальный номер заказа.
+    Формат: BB-YYYYMMDD-XXXXXX (где XXXXXX - случайная строка)
+    """
+    date_str = datetime.now().strftime("%Y%m%d")
+    random_part = uuid.uuid4().hex[:6].upper()
+    return f"BB-{date_str}-{random_part}"
+
+
+def create_whatsapp_message(
+    order_number: str,
+    items: list,
+    total_amount: int,
+    client_phone: Optional[str],
+    client_comment: Optional[str],
+) -> str:
+    """
+    Создает сообщение для WhatsApp с информацией о заказе.
+    """
+    import urllib.parse
+
+    message = "Здравствуйте! Хочу заказать:\n\n"
+    message += f"Заказ #{order_number}\n\n"
+    message += "Товары:\n"
+
+    for i, item in enumerate(items, 1):
+        message += f"{i}. {item['name']} - {item['quantity']} шт. × {item['price']} сом = {item['quantity'] * item['price']} сом\n"
+
+    message += f"\nИтого: {total_amount} сом\n\n"
+    message += f"Телефон: {client_phone or 'Не указан'}\n"
+    message += f"Комментарий: {client_comment or 'Нет комментария'}\n\n"
+    message += "Доставка по всему Кыргызстану. Самовывоз в Бишкеке."
+
+    return urllib.parse.quote(message)
+
+
+def date_range_filter(column, date_from: Optional[date], date_to: Optional[date]):
+    """
+    Условия выборки по дате для колонки DateTime (обе границы включительно).
+    """
+    conditions = []
+    if date_from is not None:
+        conditions.append(column >= datetime.combine(date_from, datetime.min.time()))
+    if date_to is not None:
+        conditions.append(
+            column < datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+        )
+    return conditions
+
+
+def encode_orders_cursor(created_at: datetime, order_id: int) -> str:
+    """
+    Кодирует позицию последнего заказа страницы в курсор.
+    """
+    raw = f"{created_at.isoformat()}|{order_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_orders_cursor(cursor: str) -> tuple:
+    """
+    Декодирует курсор страницы заказов в (created_at, id).
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, order_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(order_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+
+
+def verify_admin(request: Request) -> bool:
+    """
+    Проверяет авторизацию администратора.
+    Используется как зависимость в защищенных эндпоинтах.
+    """
+    auth_header = request.headers.get("Authorization")
+    if not auth_header or not auth_header.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Не авторизован")
+
+    token = auth_header.split(" ")[1]
+    if token != ADMIN_PASSWORD:
+        raise HTTPException(status_code=401, detail="Неверный пароль")
+
+    return True
+
+
+def dumps_json(content) -> bytes:
+    """
+    Сериализует данные в JSON так же, как стандартный JSONResponse
+    (компактно, без экранирования кириллицы). Если установлен orjson,
+    сериализует им - результат побайтно тот же, но в разы быстрее.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(content)
+        except TypeError:
+            pass  # Например, целые больше 64 бит: их умеет только json
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def loads_json(data: str):
+    """
+    Разбирает JSON (через orjson, если он установлен).
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # Например, NaN или целые больше 64 бит: их умеет только json
+    return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse с сериализацией через dumps_json.
+    Обработчик, который возвращает такой ответ сам, минует проверку
+    по response_model и jsonable_encoder.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Проверяет заголовок If-None-Match против текущего ETag.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+# ===== ИЗОБРАЖЕНИЯ =====
+
+class BadImage(ValueError):
+    """Загрузку не удалось обработать как изображение"""
+
+    def __init__(self, message: str, names: list):
+        super().__init__(message)
+        self.names = names  # Имена загрузок с этим файлом
+
+
+# Пул процессов создается при первой загрузке изображения
+_image_pool: Optional[ProcessPoolExecutor] = None
+_image_pool_lock = threading.Lock()
+_image_gc_task: Optional[asyncio.Task] = None
+
+
+def get_image_pool() -> ProcessPoolExecutor:
+    """
+    Возвращает пул процессов для обработки изображений.
+    """
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ProcessPoolExecutor(
+                max_workers=IMAGE_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _image_pool
+
+
+def reset_image_pool(pool: ProcessPoolExecutor) -> None:
+    """
+    Отбрасывает сломанный пул (рабочий процесс погиб, например, от нехватки
+    памяти на огромной картинке); следующая загрузка создаст новый.
+    """
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is pool:
+            _image_pool = None
+    pool.shutdown(wait=False)
+
+
+def submit_image_processing(upload_path: str, content_hash: str) -> Future:
+    """
+    Отправляет изображение на обработку в пул процессов: убираются EXIF-данные
+    и создаются варианты разной ширины в WebP и JPEG.
+    """
+    args = (
+        process_product_image,
+        upload_path,
+        blob_dir(UPLOADS_ROOT, content_hash),
+        content_hash,
+        IMAGE_WIDTHS,
+    )
+    pool = get_image_pool()
+    try:
+        future = pool.submit(*args)
+    except BrokenProcessPool:
+        # Пул сломался на чужой загрузке - эта уходит в новый
+        reset_image_pool(pool)
+        pool = get_image_pool()
+        future = pool.submit(*args)
+    future.image_pool = pool
+    return future
+
+
+def finish_image_processing(future: Future, content_hash: str) -> tuple:
+    """
+    Дожидается обработки изображения.
+    Возвращает (image_url, variants, files).
+    """
+    try:
+        variants = future.result()
+    except UnidentifiedImageError:
+        raise ValueError("Неверный формат изображения")
+    except BrokenProcessPool:
+        # Ошибка только у загрузок, которые были в пуле; остальные
+        # получат новый пул
+        reset_image_pool(future.image_pool)
+        raise HTTPException(
+            status_code=503,
+            detail="Не удалось обработать изображение, повторите загрузку",
+        )
+
+    files = []
+    for fmt_variants in variants.values():
+        for variant in fmt_variants:
+            variant["file"] = blob_name(content_hash, variant["file"])
+            files.append(variant["file"])
+
+    # Основное изображение - самый крупный JPEG
+    image_url = f"/uploads/products/{variants['jpeg'][-1]['file']}"
+    return image_url, variants, files
+
+
+def process_upload(upload_path: str, content_hash: str) -> tuple:
+    """
+    Обрабатывает изображение в пуле процессов.
+    Возвращает (image_url, variants, files).
+    """
+    return finish_image_processing(
+        submit_image_processing(upload_path, content_hash), content_hash
+    )
+
+
+def acquire_image(db: Session, image: UploadFile) -> tuple:
+    """
+    Сохраняет загруженное изображение товара и увеличивает счетчик ссылок.
+    Файл копируется блоками с подсчетом хеша; если такое изображение уже
+    есть, используются готовые варианты.
+    Возвращает (hash, image_url, image_variants) для записи в Product.
+    """
+    upload = stream_upload(image.file, UPLOAD_TMP_DIR, MAX_UPLOAD_BYTES)
+    return acquire_images(db, {"image": upload}, {"image": 1})["image"]
+
+
+def acquire_images(db: Session, uploads: dict, refs: dict) -> dict:
+    """
+    Сохраняет несколько загрузок (имя -> StreamedUpload) и увеличивает
+    счетчики ссылок на refs[имя]. Новые изображения обрабатываются в пуле
+    процессов параллельно, одинаковые файлы - один раз.
+    Ссылка на готовое изображение берется условным UPDATE, и только после
+    этого проверяются его файлы: транзакция уже держит блокировку записи,
+    и сборка мусора не удалит их до коммита. Заново обработанные хеши
+    запоминаются в db.info["new_images"]: если транзакция не будет
+    зафиксирована, get_db удалит их файлы.
+    Возвращает имя -> (hash, image_url, image_variants).
+    """
+    counts = {}  # hash -> число новых ссылок
+    first = {}  # hash -> StreamedUpload
+    for name, upload in uploads.items():
+        counts[upload.sha256] = counts.get(upload.sha256, 0) + refs[name]
+        first.setdefault(upload.sha256, upload)
+
+    new_images = db.info.setdefault("new_images", set())
+    try:
+        reused = []
+        pending = {}  # hash -> Future обработки
+        processed = {}  # hash -> (image_url, variants, files)
+        try:
+            for content_hash, upload in first.items():
+                existing = db.get(ImageFile, content_hash)
+                if existing is not None and files_exist(
+                    UPLOADS_ROOT, json.loads(existing.files)
+                ):
+                    reused.append(content_hash)
+                else:
+                    new_images.add(content_hash)
+                    pending[content_hash] = submit_image_processing(
+                        upload.path, content_hash
+                    )
+            for content_hash, future in pending.items():
+                try:
+                    processed[content_hash] = finish_image_processing(
+                        future, content_hash
+                    )
+                except ValueError as e:
+                    raise BadImage(
+                        str(e),
+                        [n for n, u in uploads.items() if u.sha256 == content_hash],
+                    )
+        finally:
+            # Удалять файлы после ошибки можно, только когда пул их дописал
+            futures_wait(pending.values())
+
+        # Строку могла удалить сборка мусора после проверки выше -
+        # тогда изображение обрабатывается заново
+        for content_hash in reused:
+            taken = db.execute(
+                update(ImageFile)
+                .where(ImageFile.hash == content_hash)
+                .values(
+                    ref_count=ImageFile.ref_count + counts[content_hash],
+                    released_at=None,
+                )
+            ).rowcount
+            if not taken:
+                new_images.add(content_hash)
+                processed[content_hash] = process_upload(
+                    first[content_hash].path, content_hash
+                )
+
+        for content_hash, (image_url, variants, files) in processed.items():
+            stmt = sqlite_insert(ImageFile).values(
+                hash=content_hash,
+                image_url=image_url,
+                variants=json.dumps(variants),
+                files=json.dumps(files),
+                size=first[content_hash].size,
+                ref_count=counts[content_hash],
+                created_at=datetime.now(),
+            )
+            db.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=["hash"],
+                    set_={
+                        "image_url": stmt.excluded.image_url,
+                        "variants": stmt.excluded.variants,
+                        "files": stmt.excluded.files,
+                        "ref_count": ImageFile.ref_count + stmt.excluded.ref_count,
+                        "released_at": None,
+                    },
+                )
+            )
+
+        # Файлы, которые есть сейчас, останутся до коммита. Недостающие
+        # удалила очистка после чужой неудачной загрузки того же файла
+        images = {
+            row.hash: row
+            for row in db.execute(
+                select(
+                    ImageFile.hash,
+                    ImageFile.image_url,
+                    ImageFile.variants,
+                    ImageFile.files,
+                ).where(ImageFile.hash.in_(list(first)))
+            )
+        }
+        result = {}
+        for content_hash, row in images.items():
+            image_url, variants = row.image_url, row.variants
+            if not files_exist(UPLOADS_ROOT, json.loads(row.files)):
+                new_images.add(content_hash)
+                image_url, variants, files = process_upload(
+                    first[content_hash].path, content_hash
+                )
+                variants = json.dumps(variants)
+                db.execute(
+                    update(ImageFile)
+                    .where(ImageFile.hash == content_hash)
+                    .values(image_url=image_url, variants=variants, files=json.dumps(files))
+                )
+            result[content_hash] = (image_url, variants)
+    finally:
+        # Оригиналы с метаданными не храним
+        for upload in uploads.values():
+            discard(upload.path)
+
+    return {
+        name: (upload.sha256, *result[upload.sha256])
+        for name, upload in uploads.items()
+    }
+
+
+def release_image(db: Session, content_hash: Optional[str], count: int = 1) -> None:
+    """
+    Уменьшает счетчик ссылок на файл изображения (на count ссылок).
+    Сами файлы удаляет фоновая сборка (collect_orphan_images).
+    """
+    if not content_hash:
+        return
+    db.query(ImageFile).filter(ImageFile.hash == content_hash).update(
+        {
+            ImageFile.ref_count: ImageFile.ref_count - count,
+            ImageFile.released_at: datetime.now(),
+        },
+        synchronize_session=False,
+    )
+
+
+def remove_unreferenced_images(hashes, batch_size: int = 500) -> int:
+    """
+    Удаляет файлы изображений, для которых нет строки в image_files
+    (остались от отмененной транзакции или прерванной загрузки).
+    Возвращает число удаленных изображений.
+    """
+    hashes = list(hashes)
+    removed = 0
+    for start in range(0, len(hashes), batch_size):
+        batch = hashes[start : start + batch_size]
+        with engine.connect() as conn:
+            # Пока держится блокировка, никто не добавит ссылку на эти хеши
+            begin_write(conn)
+            referenced = set(
+                conn.scalars(select(ImageFile.hash).where(ImageFile.hash.in_(batch)))
+            )
+            for content_hash in batch:
+                if content_hash not in referenced:
+                    remove_blobs(UPLOADS_ROOT, content_hash)
+                    removed += 1
+            conn.commit()
+    return removed
+
+
+def collect_orphan_images() -> int:
+    """
+    Удаляет файлы изображений, на которые давно не ссылается ни один товар,
+    и файлы без строки в image_files старше того же срока.
+    Возвращает число удаленных изображений.
+    """
+    cutoff = datetime.now() - timedelta(seconds=IMAGE_GC_GRACE)
+    with engine.connect() as conn:
+        # Пока держится блокировка, никто не добавит ссылку на изображение
+        begin_write(conn)
+        orphans = conn.execute(
+            select(ImageFile.hash, ImageFile.files).where(
+                ImageFile.ref_count <= 0, ImageFile.released_at < cutoff
+            )
+        ).all()
+        if orphans:
+            conn.execute(
+                ImageFile.__table__.delete().where(
+                    ImageFile.hash.in_([o.hash for o in orphans])
+                )
+            )
+        # Файлы удаляются до коммита: загрузка, ждущая блокировку,
+        # после него не найдет строку и обработает изображение заново
+        for orphan in orphans:
+            remove_files(UPLOADS_ROOT, json.loads(orphan.files))
+        conn.commit()
+
+    return len(orphans) + remove_unreferenced_images(
+        blob_hashes(UPLOADS_ROOT, cutoff.timestamp())
+    )
+
+
+async def image_gc_loop():
+    """
+    Периодически запускает сборку неиспользуемых изображений в пуле потоков.
+    """
+    while True:
+        await asyncio.sleep(IMAGE_GC_INTERVAL)
+        try:
+            await anyio.to_thread.run_sync(collect_orphan_images)
+        except Exception as e:
+            print(f"Ошибка очистки изображений: {e}")
+
+
+def image_srcset(image_variants: Optional[str]) -> Optional[dict]:
+    """
+    Собирает строки srcset для WebP и JPEG вариантов изображения.
+    """
+    if not image_variants:
+        return None
+    return {
+        fmt: ", ".join(
+            f"/uploads/products/{v['file']} {v['width']}w" for v in files
+        )
+        for fmt, files in json.loads(image_variants).items()
+    }
+
+
+# ===== КЭШ КАТАЛОГА =====
+
+
+def product_to_public_dict(p: Product) -> dict:
+    """
+    Представление товара для витрины (GET /api/products).
+    """
+    return {
+        "id": p.id,
+        "name": p.name,
+        "description": p.description,
+        "price": p.price,
+        "image_url": p.image_url,
+        "image_srcset": image_srcset(p.image_variants),
+        "is_available": p.is_available,
+        "sort_order": p.sort_order,
+    }
+
+
+class PriceEntry(NamedTuple):
+    """Текущая цена и доступность товара"""
+
+    name: str
+    price: int
+    is_available: bool
+
+
+class CatalogSnapshot(NamedTuple):
+    """Сериализованный снимок каталога"""
+
+    version: int
+    body: bytes
+    etag: str
+    prices: dict  # id товара -> PriceEntry (все товары, включая скрытые)
+    revision: int  # Ревизия каталога
+    # Изменения по возрастанию ревизии: (ревизия, id товара, товар для
+    # витрины или None, если товар удален или скрыт)
+    changes: list
+
+
+def catalog_generation(path: str) -> Optional[tuple]:
+    """
+    Поколение каталога - метаданные файла поколения (один вызов stat).
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def next_catalog_revision(db: Session) -> int:
+    """
+    Увеличивает ревизию каталога в текущей транзакции и возвращает новую.
+    Запись сразу берет блокировку SQLite, поэтому два процесса не получат
+    одну ревизию.
+    """
+    stmt = sqlite_insert(CatalogRevision).values(id=1, revision=1)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={"revision": CatalogRevision.revision + 1},
+        )
+    )
+    return db.execute(
+        select(CatalogRevision.revision).where(CatalogRevision.id == 1)
+    ).scalar_one()
+
+
+def clear_tombstones(db: Session, product_ids: list) -> None:
+    """
+    Убирает записи об удалении для товаров, которые снова существуют
+    (SQLite может выдать новому товару id удаленного).
+    """
+    db.execute(
+        ProductTombstone.__table__.delete().where(
+            ProductTombstone.product_id.in_(product_ids)
+        )
+    )
+
+
+def bump_catalog_generation(path: str) -> None:
+    """
+    Перезаписывает файл поколения, чтобы все процессы увидели изменение.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(str(time.time_ns()))
+    os.replace(tmp_path, path)
+
+
+class CatalogCache:
+    """
+    Снимок доступных товаров в памяти процесса.
+    Каталог сериализуется один раз и пересобирается только после
+    изменения товаров в админке, поэтому витрина не ходит в БД.
+    Изменения из других процессов видны по файлу поколения.
+    """
+
+    def __init__(self, generation_file: str):
+        self.generation_file = generation_file
+        self._lock = threading.Lock()
+        self._snapshot: Optional[CatalogSnapshot] = None
+        self._generation: Optional[tuple] = None
+        self._version = 0
+
+    def get(self, db: Session) -> CatalogSnapshot:
+        """
+        Возвращает текущий снимок. Собирает его при первом обращении
+        и после изменения каталога в любом процессе.
+        """
+        generation = catalog_generation(self.generation_file)
+        snapshot = self._snapshot
+        if snapshot is not None and generation == self._generation:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or generation != self._generation:
+                # Поколение запоминается до чтения из БД: если каталог
+                # изменится во время сборки, следующий запрос соберет снова
+                self._generation = generation
+                self._snapshot = self._build(db)
+            return self._snapshot
+
+    def rebuild(self, db: Session) -> None:
+        """
+        Пересобирает снимок после коммита изменений товаров и сообщает
+        об изменении остальным процессам.
+        При ошибке снимок сбрасывается и соберется при следующем запросе.
+        """
+        with self._lock:
+            try:
+                bump_catalog_generation(self.generation_file)
+                self._generation = catalog_generation(self.generation_file)
+                self._snapshot = self._build(db)
+            except Exception:
+                self._snapshot = None
+
+    def _build(self, db: Session) -> CatalogSnapshot:
+        revision = (
+            db.execute(
+                select(CatalogRevision.revision).where(CatalogRevision.id == 1)
+            ).scalar()
+            or 0
+        )
+        products = db.query(Product).order_by(Product.sort_order, Product.id).all()
+
+        public = []
+        prices = {}
+        changes = [
+            (row.revision, row.product_id, None)
+            for row in db.query(ProductTombstone.revision, ProductTombstone.product_id)
+        ]
+        for p in products:
+            prices[p.id] = PriceEntry(p.name, p.price, bool(p.is_available))
+            item = product_to_public_dict(p) if p.is_available else None
+            if item is not None:
+                public.append(item)
+            changes.append((p.revision, p.id, item))
+        changes.sort(key=lambda change: change[0])
+
+        body = dumps_json(public)
+        self._version += 1
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        return CatalogSnapshot(
+            version=self._version,
+            body=body,
+            etag=etag,
+            prices=prices,
+            revision=revision,
+            changes=changes,
+        )
+
+
+catalog_cache = CatalogCache(CATALOG_GENERATION_FILE)
+
+
+def catalog_delta(snapshot: CatalogSnapshot, since: int) -> dict:
+    """
+    Изменения каталога после ревизии since (без запросов к БД).
+    Ревизия из будущего (например, после пересоздания базы) означает, что
+    у клиента чужой каталог: тогда он получает весь каталог с reset.
+    """
+    if since > snapshot.revision:
+        return {
+            "revision": snapshot.revision,
+            "reset": True,
+            "products": loads_json(snapshot.body),
+            "removed": [],
+        }
+
+    # Первое изменение с ревизией больше since
+    start = bisect.bisect_right(snapshot.changes, (since, float("inf")))
+    products = []
+    removed = []
+    for _, product_id, item in snapshot.changes[start:]:
+        if item is None:
+            removed.append(product_id)
+        else:
+            products.append(item)
+    return {
+        "revision": snapshot.revision,
+        "products": products,
+        "removed": removed,
+    }
+
+
+def quote_cart(prices: dict, lines: list) -> dict:
+    """
+    Пересчитывает корзину по текущим ценам за один проход по индексу цен
+    (без запросов к БД). lines - пары (id товара, количество).
+    Скрытые и удаленные товары попадают в unavailable и не входят в сумму.
+    """
+    items = []
+    unavailable = []
+    total_amount = 0
+    for product_id, quantity in lines:
+        entry = prices.get(product_id)
+        if entry is None or not entry.is_available:
+            unavailable.append(product_id)
+            continue
+        items.append(
+            {
+                "id": product_id,
+                "name": entry.name,
+                "price": entry.price,
+                "quantity": quantity,
+            }
+        )
+        total_amount += entry.price * quantity
+    return {"items": items, "total_amount": total_amount, "unavailable": unavailable}
+
+
+def cart_lines(items_data) -> list:
+    """
+    Достает из корзины клиента пары (id товара, количество).
+    Названия и цены из корзины не используются: их дает quote_cart.
+    """
+    if not isinstance(items_data, list) or len(items_data) > CART_MAX_LINES:
+        raise ValueError("Неверный формат товаров")
+    lines = []
+    for item in items_data:
+        try:
+            product_id = int(item["id"])
+            quantity = int(item["quantity"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Неверный формат товаров")
+        if not 1 <= quantity <= CART_MAX_QUANTITY:
+            raise ValueError("Неверное количество товара")
+        lines.append((product_id, quantity))
+    return lines
+
+
+# ===== МАССОВЫЙ ИМПОРТ ТОВАРОВ =====
+
+# Колонки манифеста импорта и их типы. id задает обновляемый товар,
+# image - имя файла в zip-архиве изображений; остальные колонки игнорируются
+IMPORT_COLUMNS = {
+    "id": int,
+    "name": str,
+    "description": str,
+    "price": int,
+    "is_available": bool,
+    "sort_order": int,
+    "image": str,
+}
+# Без этих колонок новый товар не создать
+IMPORT_REQUIRED = ("name", "description", "price")
+# Значения по умолчанию для новых товаров
+IMPORT_DEFAULTS = {
+    "is_available": True,
+    "sort_order": 0,
+    "image_hash": None,
+    "image_url": None,
+    "image_variants": None,
+}
+# Колонки товара, которые перезаписывает импорт
+IMPORT_PRODUCT_COLUMNS = (
+    Product.id,
+    Product.name,
+    Product.description,
+    Product.price,
+    Product.is_available,
+    Product.sort_order,
+    Product.image_hash,
+    Product.image_url,
+    Product.image_variants,
+)
+
+IMPORT_TRUE = {"1", "true", "yes", "да", "+"}
+IMPORT_FALSE = {"0", "false", "no", "нет", "-"}
+
+
+def parse_import_value(column: str, value):
+    """
+    Приводит значение из манифеста к типу колонки.
+    """
+    kind = IMPORT_COLUMNS[column]
+    if kind is bool:
+        if isinstance(value, bool):
+            return value
+        flag = str(value).strip().lower()
+        if flag in IMPORT_TRUE:
+            return True
+        if flag in IMPORT_FALSE:
+            return False
+        raise ValueError(flag)
+    if kind is int:
+        if isinstance(value, bool):
+            raise ValueError(value)
+        return value if isinstance(value, int) else int(str(value).strip())
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value.strip()
+
+
+def parse_import_manifest(filename: str, data: bytes) -> list:
+    """
+    Разбирает манифест импорта: CSV с заголовком (разделитель "," или ";")
+    или JSON-массив объектов. Пустые значения пропускаются, поэтому
+    при обновлении такие поля остаются прежними.
+    """
+    try:
+        content = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ValueError("Манифест должен быть в кодировке UTF-8")
+
+    if filename.lower().endswith(".json") or content.lstrip().startswith("["):
+        try:
+            records = json.loads(content)
+        except json.JSONDecodeError:
+            raise ValueError("Неверный JSON манифеста")
+        if not isinstance(records, list) or not all(
+            isinstance(record, dict) for record in records
+        ):
+            raise ValueError("Манифест JSON должен быть массивом объектов")
+    else:
+        header = content.split("\n", 1)[0]
+        delimiter = ";" if header.count(";") > header.count(",") else ","
+        records = list(csv.DictReader(io.StringIO(content), delimiter=delimiter))
+
+    if len(records) > BULK_MAX_PRODUCTS:
+        raise ValueError(f"Слишком много товаров (максимум {BULK_MAX_PRODUCTS})")
+
+    rows = []
+    seen_ids = set()
+    for number, record in enumerate(records, 1):
+        row = {}
+        for key, value in record.items():
+            column = (key or "").strip().lower()
+            if column not in IMPORT_COLUMNS or value is None:
+                continue
+            if isinstance(value, str) and not value.strip():
+                continue
+            try:
+                row[column] = parse_import_value(column, value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Строка {number}: неверное значение {column}")
+
+        if "id" in row:
+            if row["id"] in seen_ids:
+                raise ValueError(f"Строка {number}: товар {row['id']} уже был выше")
+            seen_ids.add(row["id"])
+        else:
+            missing = [column for column in IMPORT_REQUIRED if column not in row]
+            if missing:
+                raise ValueError(f"Строка {number}: не заполнено {', '.join(missing)}")
+        rows.append(row)
+
+    if not rows:
+        raise ValueError("Манифест пуст")
+    return rows
+
+
+def stream_zip_images(fileobj, names) -> dict:
+    """
+    Копирует файлы из zip-архива во временные файлы, как обычные загрузки
+    (с тем же лимитом размера). Файл ищется по пути в архиве или по имени
+    без папок. Возвращает имя -> StreamedUpload.
+    """
+    try:
+        archive = zipfile.ZipFile(fileobj)
+    except zipfile.BadZipFile:
+        raise ValueError("Неверный zip-архив изображений")
+
+    uploads = {}
+    try:
+        with archive:
+            files = [info for info in archive.infolist() if not info.is_dir()]
+            members = {info.filename: info for info in files}
+            for info in files:
+                members.setdefault(posixpath.basename(info.filename), info)
+
+            for name in names:
+                info = members.get(name)
+                if info is None:
+                    raise ValueError(f"В архиве нет файла {name}")
+                with archive.open(info) as member:
+                    uploads[name] = stream_upload(
+                        member, UPLOAD_TMP_DIR, MAX_UPLOAD_BYTES
+                    )
+    except BaseException:
+        for upload in uploads.values():
+            discard(upload.path)
+        raise
+    return uploads
+
+
+# ===== ОЧЕРЕДЬ ЗАКАЗОВ =====
+
+
+class OrderQueueFull(Exception):
+    """Очередь записи заказов переполнена или не успела записать заказ"""
+
+
+class OrderWriter:
+    """
+    Пакетная запись заказов.
+    Обработчики кладут заказ в очередь и ждут подтверждения; отдельный поток
+    забирает заказы пачками и записывает каждую пачку одной транзакцией,
+    поэтому при наплыве заказов SQLite делает одну синхронизацию на пачку.
+    """
+
+    def __init__(self, batch_size: int, window_ms: int, max_queue: int):
+        self.batch_size = batch_size
+        self.window = window_ms / 1000
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {
+            "batches": 0,
+            "orders": 0,
+            "failed": 0,
+            "rejected": 0,
+            "max_batch": 0,
+            "queue_wait_seconds": 0.0,
+            "max_queue_wait_seconds": 0.0,
+            "commit_seconds": 0.0,
+        }
+
+    def start(self) -> None:
+        """
+        Запускает поток записи (если еще не запущен).
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="order-writer", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Дописывает оставшиеся заказы и останавливает поток.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self.queue.put(None)
+            thread.join()
+
+    def submit(self, make_order: Callable[[], Order]) -> None:
+        """
+        Ставит заказ в очередь и ждет, пока он будет записан.
+        make_order создает новый объект заказа: при ошибке пачки заказ
+        записывается повторно отдельно.
+        Если заказ не записан за ORDER_COMMIT_TIMEOUT, он снимается с очереди
+        (клиент может безопасно повторить); заказ, который уже записывается,
+        дожидается коммита.
+        """
+        self.start()
+        future: Future = Future()
+        try:
+            self.queue.put_nowait((make_order, future, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise OrderQueueFull()
+        try:
+            future.result(timeout=ORDER_COMMIT_TIMEOUT)
+        except FuturesTimeoutError:
+            if not future.cancel():
+                future.result()
+                return
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise OrderQueueFull()
+
+    def snapshot(self) -> dict:
+        """
+        Текущие показатели очереди.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        processed = stats["orders"] + stats["failed"]
+        stats["depth"] = self.queue.qsize()
+        stats["avg_batch"] = round(processed / max(stats["batches"], 1), 2)
+        stats["avg_queue_wait_ms"] = round(
+            stats["queue_wait_seconds"] * 1000 / max(processed, 1), 2
+        )
+        return stats
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            # Добираем пачку, пока не истечет окно или не наберется batch_size
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch: list) -> None:
+        started = time.monotonic()
+        failed = 0
+        # Заказы, снятые с очереди по таймауту, не записываются
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            self._commit([make_order for make_order, _, _ in batch])
+            for _, future, _ in batch:
+                future.set_result(None)
+        except Exception:
+            # Один неудачный заказ не должен отменять всю пачку
+            for make_order, future, _ in batch:
+                try:
+                    self._commit([make_order])
+                    future.set_result(None)
+                except Exception as e:
+                    failed += 1
+                    future.set_exception(e)
+
+        waits = [started - enqueued for _, _, enqueued in batch]
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["orders"] += len(batch) - failed
+            self.stats["failed"] += failed
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+            self.stats["queue_wait_seconds"] += sum(waits)
+            self.stats["max_queue_wait_seconds"] = max(
+                self.stats["max_queue_wait_seconds"], max(waits)
+            )
+            self.stats["commit_seconds"] += time.monotonic() - started
+
+    @staticmethod
+    def _commit(order_factories: list) -> None:
+        db = SessionLocal()
+        try:
+            for make_order in order_factories:
+                order = make_order()
+                db.add(order)
+                record_daily_sales(db, order)
+                enqueue_notifications(order)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+
+# Пакетная запись включается переменной ORDER_BATCHING
+order_writer = (
+    OrderWriter(ORDER_BATCH_SIZE, ORDER_BATCH_WINDOW_MS, ORDER_QUEUE_MAX)
+    if ORDER_BATCHING
+    else None
+)
+
+
+def order_queue_metrics():
+    """
+    Показатели очереди заказов для /metrics.
+    """
+    if order_writer is None:
+        return
+    stats = order_writer.snapshot()
+    yield "order_queue_depth", "gauge", "Заказы в очереди на запись", stats["depth"]
+    yield "order_batches_total", "counter", "Записанные пачки заказов", stats["batches"]
+    yield "order_batch_orders_total", "counter", "Заказы, записанные пачками", stats["orders"]
+    yield "order_batch_max_size", "gauge", "Самая большая пачка", stats["max_batch"]
+    yield (
+        "order_queue_wait_seconds_total",
+        "counter",
+        "Суммарное ожидание заказов в очереди",
+        round(stats["queue_wait_seconds"], 6),
+    )
+    yield "order_queue_rejected_total", "counter", "Отклоненные заказы", stats["rejected"]
+    yield "order_batch_failed_total", "counter", "Незаписанные заказы", stats["failed"]
+
+
+metrics.add_collector(order_queue_metrics)
+
+
+# ===== ЛЕНТА ЗАКАЗОВ =====
+
+
+def order_to_admin_dict(o, with_items: bool = True) -> dict:
+    """
+    Представление заказа для админки (GET /api/admin/orders и лента).
+    """
+    order = {"id": o.id, "order_number": o.order_number}
+    if with_items:
+        order["items"] = loads_json(o.items_json)
+    order["client_phone"] = o.client_phone
+    order["client_comment"] = o.client_comment
+    order["total_amount"] = o.total_amount
+    order["created_at"] = o.created_at.isoformat() if o.created_at else None
+    return order
+
+
+def fetch_order_events(after_id: int, limit: int) -> list:
+    """
+    Заказы с id больше after_id в виде готовых событий SSE.
+    Возвращает [(id, событие)] по возрастанию id.
+    """
+    db = SessionLocal()
+    try:
+        rows = (
+            db.query(
+                Order.id,
+                Order.order_number,
+                Order.items_json,
+                Order.client_phone,
+                Order.client_comment,
+                Order.total_amount,
+                Order.created_at,
+            )
+            .filter(Order.id > after_id)
+            .order_by(Order.id)
+            .limit(limit)
+            .all()
+        )
+    finally:
+        db.close()
+    return [
+        (
+            row.id,
+            b"id: %d\nevent: order\ndata: %s\n\n"
+            % (row.id, dumps_json(order_to_admin_dict(row))),
+        )
+        for row in rows
+    ]
+
+
+def latest_order_id() -> int:
+    """
+    id последнего записанного заказа (0, если заказов нет).
+    """
+    db = SessionLocal()
+    try:
+        return db.query(func.max(Order.id)).scalar() or 0
+    finally:
+        db.close()
+
+
+class OrderFeed:
+    """
+    Рассылка новых заказов подключенным админкам.
+    Один фоновый цикл на процесс читает заказы с id больше последнего
+    разосланного и раскладывает готовые события по очередям подключений,
+    поэтому открытое подключение стоит одну очередь в event loop.
+    Пока подключений нет, БД не опрашивается.
+    """
+
+    def __init__(self, poll_interval: float, batch_size: int, max_pending: int):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._subscribers = set()
+        self._last_id: Optional[int] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._init_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def start(self) -> None:
+        """
+        Запускает цикл рассылки в текущем event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._init_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        """
+        Останавливает цикл и закрывает подключения.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        for queue in list(self._subscribers):
+            self._close(queue)
+
+    def notify(self) -> None:
+        """
+        Сообщает о новом заказе (можно вызывать из любого потока).
+        """
+        loop = self._loop
+        if loop is None or not self._subscribers:
+            return
+        try:
+            loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # Event loop уже остановлен
+
+    async def subscribe(self) -> tuple:
+        """
+        Подключает получателя. Возвращает (очередь, id последнего заказа):
+        в очередь попадут все заказы новее этого id.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_pending)
+        self._subscribers.add(queue)
+        async with self._init_lock:
+            if self._last_id is None:
+                self._last_id = await anyio.to_thread.run_sync(latest_order_id)
+            return queue, self._last_id
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    def _close(self, queue: asyncio.Queue) -> None:
+        # None в очереди - сигнал завершить подключение
+        self._subscribers.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if not self._subscribers:
+                # Следующий подписчик заново узнает последний заказ
+                self._last_id = None
+                continue
+            if self._last_id is None:
+                continue
+
+            try:
+                events = await anyio.to_thread.run_sync(
+                    fetch_order_events, self._last_id, self.batch_size
+                )
+            except Exception as e:
+                print(f"Ошибка ленты заказов: {e}")
+                continue
+
+            for event in events:
+                for queue in list(self._subscribers):
+                    try:
+                        queue.put_nowait(event)
+                    except asyncio.QueueFull:
+                        # Медленный клиент переподключится с Last-Event-ID
+                        self._close(queue)
+            if events:
+                self._last_id = events[-1][0]
+                if len(events) == self.batch_size:
+                    self._wakeup.set()
+
+
+order_feed = OrderFeed(ORDER_FEED_POLL, ORDER_FEED_BACKLOG, ORDER_FEED_QUEUE)
+
+
+async def order_feed_events(after_id: Optional[int]):
+    """
+    Поток событий SSE для одного подключения: сначала пропущенные заказы
+    (после Last-Event-ID), затем новые; раз в ORDER_FEED_HEARTBEAT секунд
+    без заказов отправляется комментарий, чтобы прокси не закрыл соединение.
+    """
+    queue, sent_id = await order_feed.subscribe()
+    try:
+        yield b"retry: 3000\n\n"
+
+        if after_id is not None:
+            events = await anyio.to_thread.run_sync(
+                fetch_order_events, after_id, ORDER_FEED_BACKLOG + 1
+            )
+            if len(events) > ORDER_FEED_BACKLOG:
+                # Пропущено слишком много: клиент перезагрузит список
+                yield b"event: reset\ndata: {}\n\n"
+            else:
+                for _, event in events:
+                    yield event
+                sent_id = events[-1][0] if events else after_id
+
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), ORDER_FEED_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+                continue
+            if item is None:
+                return
+            order_id, event = item
+            if order_id > sent_id:
+                sent_id = order_id
+                yield event
+    finally:
+        order_feed.unsubscribe(queue)
+
+
+def order_feed_metrics():
+    """
+    Показатели ленты заказов для /metrics.
+    """
+    yield (
+        "order_feed_subscribers",
+        "gauge",
+        "Открытые подключения к ленте заказов",
+        order_feed.subscribers,
+    )
+
+
+metrics.add_collector(order_feed_metrics)
+
+
+# ===== УВЕДОМЛЕНИЯ О ЗАКАЗАХ =====
+
+
+def configured_senders() -> dict:
+    """
+    Отправители уведомлений, включенные переменными окружения.
+    """
+    senders = []
+    if NOTIFY_WEBHOOK_URL:
+        senders.append(
+            WebhookSender(NOTIFY_WEBHOOK_URL, NOTIFY_WEBHOOK_SECRET, NOTIFY_TIMEOUT)
+        )
+    if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
+        senders.append(
+            TelegramSender(
+                TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, TELEGRAM_API_URL, NOTIFY_TIMEOUT
+            )
+        )
+    return {sender.name: sender for sender in senders}
+
+
+# Канал -> отправитель; другие отправители подключаются через register_sender
+notification_senders = configured_senders()
+
+
+def register_sender(sender: NotificationSender) -> None:
+    """
+    Подключает отправитель уведомлений (до старта приложения).
+    """
+    notification_senders[sender.name] = sender
+
+
+def enqueue_notifications(order: Order) -> None:
+    """
+    Добавляет к заказу по уведомлению для каждого отправителя.
+    Уведомления записываются той же транзакцией, что и заказ.
+    """
+    if not notification_senders:
+        return
+    payload = dumps_json(
+        {
+            "event": "order.created",
+            "order_number": order.order_number,
+            "items": loads_json(order.items_json),
+            "total_amount": order.total_amount,
+            "client_phone": order.client_phone,
+            "client_comment": order.client_comment,
+            "created_at": order.created_at.isoformat(),
+        }
+    ).decode("utf-8")
+    for channel in notification_senders:
+        order.notifications.append(
+            OrderNotification(
+                channel=channel, payload=payload, next_attempt_at=order.created_at
+            )
+        )
+
+
+class NotificationDispatcher:
+    """
+    Фоновая доставка уведомлений из outbox.
+    Берет созревшие уведомления пачками по каналам, отправляет их и при
+    ошибке назначает повтор с экспоненциальной задержкой. Пачка сначала
+    помечается меткой процесса и сдвигом next_attempt_at (аренда), поэтому
+    несколько процессов не отправят одно уведомление одновременно, а после
+    падения процесса аренда истечет и уведомление уйдет снова.
+    """
+
+    def __init__(
+        self,
+        senders: dict,
+        interval: float,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+        lease: float,
+    ):
+        self.senders = senders
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"sent": 0, "retried": 0, "failed": 0}
+
+    def start(self) -> None:
+        """
+        Запускает фоновый цикл, если настроен хотя бы один отправитель.
+        """
+        if not self.senders:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        """
+        Останавливает цикл; неотправленное уйдет после перезапуска.
+        """
+        if self._task is not None:
+            self._task.cancel()
+
+    def notify(self) -> None:
+        """
+        Будит цикл после записи заказа (можно вызывать из любого потока).
+        """
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # Event loop уже остановлен
+
+    def backoff(self, attempts: int) -> float:
+        """
+        Задержка перед следующей попыткой (со случайным разбросом ±10%).
+        """
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return delay * random.uniform(0.9, 1.1)
+
+    def dispatch_once(self) -> bool:
+        """
+        Отправляет по одной пачке в каждый канал.
+        Возвращает True, если в каком-то канале могли остаться готовые.
+        """
+        more = False
+        for channel, sender in self.senders.items():
+            token, batch = self._claim(channel, sender.batch_size)
+            if not batch:
+                continue
+            more = more or len(batch) == sender.batch_size
+            try:
+                sender.send(
+                    [dict(loads_json(n.payload), notification_id=n.id) for n in batch]
+                )
+            except Exception as e:
+                self._reschedule(token, batch, str(e))
+            else:
+                self._mark_sent(token, len(batch))
+        return more
+
+    def _claim(self, channel: str, limit: int) -> tuple:
+        token = uuid.uuid4().hex
+        now = datetime.now()
+        db = SessionLocal()
+        try:
+            due = (
+                select(OrderNotification.id)
+                .where(
+                    OrderNotification.status == "pending",
+                    OrderNotification.channel == channel,
+                    OrderNotification.next_attempt_at <= now,
+                )
+                .order_by(OrderNotification.next_attempt_at, OrderNotification.id)
+                .limit(limit)
+            )
+            db.execute(
+                update(OrderNotification)
+                .where(OrderNotification.id.in_(due))
+                .values(claim=token, next_attempt_at=now + timedelta(seconds=self.lease))
+                .execution_options(synchronize_session=False)
+            )
+            batch = db.execute(
+                select(
+                    OrderNotification.id,
+                    OrderNotification.payload,
+                    OrderNotification.attempts,
+                )
+                .where(OrderNotification.claim == token)
+                .order_by(OrderNotification.id)
+            ).all()
+            db.commit()
+            return token, batch
+        finally:
+            db.close()
+
+    def _mark_sent(self, token: str, count: int) -> None:
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(OrderNotification)
+                .where(OrderNotification.claim == token)
+                .values(status="sent", sent_at=datetime.now(), claim=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            self.stats["sent"] += count
+
+    def _reschedule(self, token: str, batch: list, error: str) -> None:
+        now = datetime.now()
+        updates = []
+        failed = 0
+        for n in batch:
+            attempts = n.attempts + 1
+            given_up = attempts >= self.max_attempts
+            failed += given_up
+            updates.append(
+                {
+                    "notification_id": n.id,
+                    "attempts": attempts,
+                    "status": "failed" if given_up else "pending",
+                    "next_attempt_at": now + timedelta(seconds=self.backoff(attempts)),
+                    "claim": None,
+                    "last_error": error[:500],
+                }
+            )
+        # Только пока аренда наша: если она истекла и пачку взял другой
+        # процесс, его состояние не перезаписывается
+        db = SessionLocal()
+        try:
+            db.execute(
+                OrderNotification.__table__.update().where(
+                    OrderNotification.id == bindparam("notification_id"),
+                    OrderNotification.claim == token,
+                ),
+                updates,
+            )
+            db.commit()
+        finally:
+            db.close()
+        with self._lock:
+            self.stats["retried"] += len(batch) - failed
+            self.stats["failed"] += failed
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await anyio.to_thread.run_sync(self.dispatch_once):
+                    pass
+            except Exception as e:
+                print(f"Ошибка отправки уведомлений: {e}")
+
+
+notification_dispatcher = NotificationDispatcher(
+    notification_senders,
+    NOTIFY_INTERVAL,
+    NOTIFY_MAX_ATTEMPTS,
+    NOTIFY_BACKOFF_BASE,
+    NOTIFY_BACKOFF_MAX,
+    NOTIFY_LEASE,
+)
+
+
+def notification_metrics():
+    """
+    Показатели отправки уведомлений для /metrics.
+    """
+    if not notification_senders:
+        return
+    with notification_dispatcher._lock:
+        stats = dict(notification_dispatcher.stats)
+    yield "notifications_sent_total", "counter", "Отправленные уведомления", stats["sent"]
+    yield (
+        "notifications_retried_total",
+        "counter",
+        "Неудачные попытки с повтором",
+        stats["retried"],
+    )
+    yield (
+        "notifications_failed_total",
+        "counter",
+        "Уведомления, отправка которых прекращена",
+        stats["failed"],
+    )
+
+
+metrics.add_collector(notification_metrics)
+
+
+# ===== АРХИВ ЗАКАЗОВ =====
+
+
+order_archive = OrderArchive(ARCHIVE_ROOT)
+_archive_task: Optional[asyncio.Task] = None
+
+# Колонки orders в порядке полей ArchivedOrder
+ARCHIVE_COLUMNS = (
+    Order.id,
+    Order.order_number,
+    Order.items_json,
+    Order.client_phone,
+    Order.client_comment,
+    Order.total_amount,
+    Order.created_at,
+)
+
+
+def archive_order_batch(cutoff: datetime) -> int:
+    """
+    Переносит в архив до ARCHIVE_BATCH_SIZE заказов старше cutoff.
+    Заказ удаляется из БД только после того, как сегмент записан на диск;
+    если процесс упадет между этими шагами, следующий перенос увидит
+    заказ в индексе и просто удалит его. Последний заказ не переносится,
+    чтобы SQLite не выдал его id новому заказу.
+    Возвращает число перенесенных заказов.
+    """
+    db = SessionLocal()
+    try:
+        newest_id = db.query(func.max(Order.id)).scalar()
+        rows = db.execute(
+            select(*ARCHIVE_COLUMNS)
+            .where(Order.created_at < cutoff, Order.id != newest_id)
+            .order_by(Order.created_at, Order.id)
+            .limit(ARCHIVE_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return 0
+
+        by_month: Dict[str, list] = {}
+        for row in rows:
+            by_month.setdefault(month_key(row.created_at), []).append(
+                ArchivedOrder(*row)
+            )
+        for month, orders in by_month.items():
+            order_archive.append(month, orders)
+
+        ids = [row.id for row in rows]
+        db.execute(OrderItem.__table__.delete().where(OrderItem.order_id.in_(ids)))
+        db.execute(
+            OrderNotification.__table__.delete().where(
+                OrderNotification.order_id.in_(ids)
+            )
+        )
+        db.execute(
+            IdempotencyKey.__table__.delete().where(IdempotencyKey.order_id.in_(ids))
+        )
+        db.execute(Order.__table__.delete().where(Order.id.in_(ids)))
+        db.commit()
+        return len(rows)
+    finally:
+        db.close()
+
+
+def archive_old_orders() -> int:
+    """
+    Переносит в архив все заказы старше ARCHIVE_AFTER_DAYS дней.
+    Если перенос уже идет в другом процессе, ничего не делает.
+    Возвращает число перенесенных заказов.
+    """
+    cutoff = datetime.combine(
+        date.today() - timedelta(days=ARCHIVE_AFTER_DAYS), datetime.min.time()
+    )
+    with open(ARCHIVE_LOCK_FILE, "w") as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+        try:
+            archived = 0
+            while True:
+                count = archive_order_batch(cutoff)
+                if not count:
+                    return archived
+                archived += count
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+async def order_archive_loop():
+    """
+    Периодически переносит старые заказы в архив в пуле потоков.
+    """
+    while True:
+        try:
+            archived = await anyio.to_thread.run_sync(archive_old_orders)
+            if archived:
+                print(f"Перенесено в архив заказов: {archived}")
+        except Exception as e:
+            print(f"Ошибка переноса заказов в архив: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+def archived_orders(
+    date_from: Optional[date],
+    date_to: Optional[date],
+    before: Optional[tuple] = None,
+    reverse: bool = False,
+):
+    """
+    Заказы из архива за период (границы как у date_range_filter).
+    before - позиция курсора (created_at, id): только заказы до нее.
+    Сегменты за пределами периода не читаются.
+    """
+    start = datetime.combine(date_from, datetime.min.time()) if date_from else None
+    end = (
+        datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+        if date_to
+        else None
+    )
+    if before is not None:
+        # Заказы с той же датой и меньшим id тоже идут до курсора
+        until = before[0] + timedelta(microseconds=1)
+        end = until if end is None else min(end, until)
+    for order in order_archive.scan(start, end, reverse):
+        if before is None or (order.created_at, order.id) < before:
+            yield order
+
+
+# ===== ЗАЩИТА ОТ ПОВТОРОВ И ФЛУДА =====
+
+order_rate_limiter = TokenBucketLimiter(
+    rate=ORDER_RATE_PER_MINUTE / 60, burst=ORDER_RATE_BURST
+)
+idempotency_stats = {"replays": 0}
+_idempotency_lock = threading.Lock()
+_protection_purged_at = 0.0
+
+
+def client_ip(request: Request) -> str:
+    """
+    IP-адрес клиента (с учетом прокси, если TRUST_PROXY_HEADERS).
+    """
+    if TRUST_PROXY_HEADERS:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def order_rate_limit(request: Request, client_phone: Optional[str]) -> float:
+    """
+    Проверяет лимит заказов по IP и по телефону.
+    Возвращает 0 или через сколько секунд можно повторить.
+    """
+    keys = [f"ip:{client_ip(request)}"]
+    phone_digits = re.sub(r"\D", "", client_phone or "")
+    if len(phone_digits) >= 6:
+        keys.append(f"phone:{phone_digits}")
+
+    now = time.time()
+    retry_after = 0.0
+    with engine.connect() as conn:
+        # Корзины читаются и пишутся под блокировкой записи: иначе два
+        # воркера потратят один и тот же жетон
+        begin_write(conn)
+        buckets = {
+            row.key: (row.tokens, row.updated)
+            for row in conn.execute(select(RateBucket).where(RateBucket.key.in_(keys)))
+        }
+        updates = []
+        for key in keys:
+            (tokens, updated), retry_after = order_rate_limiter.take(
+                buckets.get(key), now
+            )
+            updates.append({"key": key, "tokens": tokens, "updated": updated})
+            if retry_after:
+                break
+        stmt = sqlite_insert(RateBucket)
+        conn.execute(
+            stmt.on_conflict_do_update(
+                index_elements=["key"],
+                set_={"tokens": stmt.excluded.tokens, "updated": stmt.excluded.updated},
+            ),
+            updates,
+        )
+        purge_protection_state(conn, now)
+        conn.commit()
+    return retry_after
+
+
+def purge_protection_state(conn, now: float) -> None:
+    """
+    Удаляет полные корзины и истекшие ключи идемпотентности
+    (не чаще раза в PROTECTION_PURGE_INTERVAL секунд в процессе).
+    """
+    global _protection_purged_at
+    if now - _protection_purged_at < PROTECTION_PURGE_INTERVAL:
+        return
+    _protection_purged_at = now
+    conn.execute(
+        RateBucket.__table__.delete().where(
+            RateBucket.updated < order_rate_limiter.full_since(now)
+        )
+    )
+    conn.execute(
+        IdempotencyKey.__table__.delete().where(
+            IdempotencyKey.created_at
+            < datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+        )
+    )
+
+
+def find_idempotent_response(key: str, fingerprint: str) -> Optional[dict]:
+    """
+    Сохраненный ответ на заказ с этим ключом или None, если заказа не было.
+    Ключ, использованный с другими данными, - IdempotencyConflict.
+    """
+    cutoff = datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+    with engine.connect() as conn:
+        row = conn.execute(
+            select(
+                IdempotencyKey.fingerprint,
+                IdempotencyKey.response,
+                IdempotencyKey.created_at,
+            ).where(IdempotencyKey.key == key)
+        ).first()
+        if row is not None and row.created_at < cutoff:
+            # Срок ключа истек: он снова свободен для нового заказа
+            conn.execute(
+                IdempotencyKey.__table__.delete().where(
+                    IdempotencyKey.key == key, IdempotencyKey.created_at < cutoff
+                )
+            )
+            conn.commit()
+            row = None
+
+    if row is None:
+        return None
+    if row.fingerprint != fingerprint:
+        raise IdempotencyConflict()
+    with _idempotency_lock:
+        idempotency_stats["replays"] += 1
+    return loads_json(row.response)
+
+
+def protection_metrics():
+    """
+    Показатели защиты от повторов и флуда для /metrics.
+    """
+    yield (
+        "order_idempotent_replays_total",
+        "counter",
+        "Повторные заказы, отданные из сохраненного ответа",
+        idempotency_stats["replays"],
+    )
+    yield (
+        "order_rate_limited_total",
+        "counter",
+        "Заказы, отклоненные ограничением частоты",
+        order_rate_limiter.rejected,
+    )
+
+
+metrics.add_collector(protection_metrics)
+
+
+# ===== СЖАТЫЕ СТРАНИЦЫ =====
+
+# HTML-шаблоны страниц
+PAGE_TEMPLATES = {
+    "index": "templates/index.html",
+    "admin": "templates/admin.html",
+}
+
+
+class CompressedAsset(NamedTuple):
+    """Содержимое файла в исходном и заранее сжатом виде"""
+
+    raw: bytes
+    gzip: bytes
+    br: Optional[bytes]
+    etag: str  # Без кавычек, к нему добавляется суффикс кодировки
+    last_modified: str
+    mtime: float
+
+
+def compress_asset(raw: bytes, mtime: float) -> CompressedAsset:
+    """
+    Сжимает содержимое в gzip и brotli (если доступен) с максимальным уровнем.
+    """
+    return CompressedAsset(
+        raw=raw,
+        gzip=gzip.compress(raw, compresslevel=9, mtime=0),
+        br=brotli.compress(raw, quality=11) if brotli is not None else None,
+        etag=hashlib.sha256(raw).hexdigest()[:32],
+        last_modified=formatdate(mtime, usegmt=True),
+        mtime=mtime,
+    )
+
+
+def choose_encoding(accept_encoding: Optional[str], asset: CompressedAsset):
+    """
+    Выбирает кодировку ответа по заголовку Accept-Encoding (br, затем gzip).
+    """
+    if not accept_encoding:
+        return None
+
+    prefs = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        prefs[token.strip().lower()] = q
+
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and asset.br is None:
+            continue
+        if prefs.get(encoding, prefs.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def asset_response(
+    request: Request,
+    asset: CompressedAsset,
+    media_type: str,
+    cache_control: str,
+    vary: str = "Accept-Encoding",
+) -> Response:
+    """
+    Отдает сжатый файл с учетом Accept-Encoding, ETag и Last-Modified.
+    """
+    encoding = choose_encoding(request.headers.get("accept-encoding"), asset)
+    suffix = {"br": "-br", "gzip": "-gz"}.get(encoding, "")
+    etag = f'"{asset.etag}{suffix}"'
+
+    headers = {
+        "ETag": etag,
+        "Last-Modified": asset.last_modified,
+        "Cache-Control": cache_control,
+        "Vary": vary,
+    }
+
+    # Условные запросы: If-None-Match важнее If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"])
+            if int(asset.mtime) <= since.timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    if encoding == "br":
+        body = asset.br
+    elif encoding == "gzip":
+        body = asset.gzip
+    else:
+        body = asset.raw
+    if encoding:
+        headers["Content-Encoding"] = encoding
+
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+class PageCache:
+    """
+    HTML-страницы в памяти в уже сжатом виде.
+    Файлы читаются один раз; при TEMPLATES_AUTO_RELOAD - заново после изменения.
+    Перед сжатием ссылки на статику заменяются собранными файлами.
+    """
+
+    def __init__(self, auto_reload: bool):
+        self.auto_reload = auto_reload
+        self._lock = threading.Lock()
+        self._assets = {}
+
+    def clear(self) -> None:
+        """Сбрасывает загруженные страницы (например, после сборки статики)"""
+        with self._lock:
+            self._assets = {}
+
+    def get(self, path: str) -> Optional[CompressedAsset]:
+        """Возвращает сжатую страницу или None, если файла нет"""
+        asset = self._assets.get(path)
+        if asset is not None and not self.auto_reload:
+            return asset
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        if asset is not None and asset.mtime == mtime:
+            return asset
+
+        with self._lock:
+            with open(path, "r", encoding="utf-8") as f:
+                html = rewrite_asset_urls(f.read())
+            asset = compress_asset(html.encode("utf-8"), mtime)
+            self._assets[path] = asset
+        return asset
+
+
+page_cache = PageCache(auto_reload=TEMPLATES_AUTO_RELOAD)
+
+
+# Место в index.html, куда встраивается каталог
+CATALOG_PLACEHOLDER = b"<!--catalog-->"
+
+
+def embed_catalog(html: bytes, catalog_json: bytes, revision: int) -> bytes:
+    """
+    Встраивает JSON каталога в страницу как <script type="application/json">
+    (ревизия каталога - в атрибуте data-revision).
+    "<" экранируется, чтобы текст товара не мог закрыть тег.
+    """
+    script = (
+        b'<script id="catalogData" type="application/json" data-revision="%d">'
+        % revision
+        + catalog_json.replace(b"<", b"\\u003c")
+        + b"</script>"
+    )
+    if CATALOG_PLACEHOLDER in html:
+        return html.replace(CATALOG_PLACEHOLDER, script, 1)
+    return html.replace(b"</body>", script + b"\n</body>", 1)
+
+
+class StorefrontCache:
+    """
+    Главная страница со встроенным каталогом: браузер показывает товары
+    сразу, без отдельного запроса к /api/products.
+    Документ собирается и сжимается один раз для каждой версии каталога
+    и шаблона.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entry: Optional[tuple] = None  # ((шаблон, каталог, ревизия), страница)
+
+    def get(self, page: CompressedAsset, snapshot: CatalogSnapshot) -> CompressedAsset:
+        key = (page.etag, snapshot.etag, snapshot.revision)
+        entry = self._entry
+        if entry is not None and entry[0] == key:
+            return entry[1]
+
+        with self._lock:
+            if self._entry is None or self._entry[0] != key:
+                # Время сборки как Last-Modified: документ меняется вместе
+                # с каталогом, а не только с файлом шаблона
+                html = embed_catalog(page.raw, snapshot.body, snapshot.revision)
+                asset = compress_asset(html, time.time())
+                self._entry = (key, asset)
+            return self._entry[1]
+
+
+storefront_cache = StorefrontCache()
+
+
+# ===== СБОРКА СТАТИКИ =====
+
+# Какие файлы собираются и с каким типом
+STATIC_SOURCES = {
+    ".js": ("static/js", "application/javascript"),
+    ".css": ("static/css", "text/css"),
+}
+
+# Исходный URL -> URL собранного файла
+asset_manifest = {}
+# Имя собранного файла -> (содержимое, тип)
+built_assets = {}
+
+
+def minify_js(source: str) -> str:
+    """
+    Консервативная минификация JS без токенизатора.
+    Убирает отступы, пустые строки и строки-комментарии; переводы строк
+    сохраняются, поэтому автоматическая расстановка ";" не ломается.
+    """
+    lines = []
+    in_comment = False
+    for line in source.splitlines():
+        stripped = line.strip()
+        if in_comment:
+            end = stripped.find("*/")
+            if end < 0:
+                continue
+            # Код после конца комментария на той же строке сохраняется
+            in_comment = False
+            stripped = stripped[end + 2 :].strip()
+        if not stripped or stripped.startswith("//"):
+            continue
+        if stripped.startswith("/*"):
+            end = stripped.find("*/", 2)
+            if end < 0:
+                in_comment = True
+                continue
+            if end == len(stripped) - 2:
+                continue
+        lines.append(stripped)
+    return "\n".join(lines) + "\n"
+
+
+def minify_css(source: str) -> str:
+    """
+    Минификация CSS: убирает комментарии и лишние пробелы.
+    """
+    source = re.sub(r"/\*.*?\*/", "", source, flags=re.S)
+    source = re.sub(r"\s+", " ", source)
+    source = re.sub(r"\s*([{};,>])\s*", r"\1", source)
+    # Пробел после ":" убирается только в объявлениях: в селекторе
+    # ".a :not(.b)" он значимый
+    source = re.sub(
+        r"\{[^{}]*\}", lambda block: re.sub(r":\s+", ":", block.group(0)), source
+    )
+    source = source.replace(";}", "}")
+    return source.strip() + "\n"
+
+
+def write_file_atomic(path: str, data: bytes) -> None:
+    """
+    Записывает файл через временный, чтобы читатели не увидели его наполовину.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build_static_assets() -> dict:
+    """
+    Собирает JS и CSS: минифицирует, добавляет хеш содержимого в имя файла
+    и кладет рядом .gz и .br версии. Возвращает манифест исходный URL -> новый URL.
+    """
+    Path(STATIC_BUILD_DIR).mkdir(parents=True, exist_ok=True)
+
+    manifest = {}
+    assets = {}
+    for extension, (directory, media_type) in STATIC_SOURCES.items():
+        for source_path in sorted(Path(directory).glob(f"*{extension}")):
+            source = source_path.read_text(encoding="utf-8")
+            if extension == ".js":
+                minified = minify_js(source)
+            else:
+                minified = minify_css(source)
+            data = minified.encode("utf-8")
+
+            content_hash = hashlib.sha256(data).hexdigest()[:10]
+            filename = f"{source_path.stem}.{content_hash}{extension}"
+            asset = compress_asset(data, source_path.stat().st_mtime)
+
+            target = os.path.join(STATIC_BUILD_DIR, filename)
+            if not os.path.exists(target):
+                write_file_atomic(target, asset.raw)
+                write_file_atomic(f"{target}.gz", asset.gzip)
+                if asset.br is not None:
+                    write_file_atomic(f"{target}.br", asset.br)
+
+            manifest[f"/{source_path.as_posix()}"] = f"/assets/{filename}"
+            assets[filename] = (asset, media_type)
+
+    write_file_atomic(
+        os.path.join(STATIC_BUILD_DIR, "manifest.json"),
+        json.dumps(manifest, indent=2).encode("utf-8"),
+    )
+
+    # Сборки прошлых версий больше не нужны (недописанные .tmp могут
+    # принадлежать параллельной сборке другого воркера)
+    for name in os.listdir(STATIC_BUILD_DIR):
+        if name == "manifest.json" or name.endswith(".tmp"):
+            continue
+        if name.removesuffix(".gz").removesuffix(".br") not in assets:
+            discard(os.path.join(STATIC_BUILD_DIR, name))
+
+    asset_manifest.clear()
+    asset_manifest.update(manifest)
+    built_assets.clear()
+    built_assets.update(assets)
+
+    # Страницы должны подхватить новые ссылки
+    page_cache.clear()
+    return manifest
+
+
+def rewrite_asset_urls(html: str) -> str:
+    """
+    Заменяет в HTML ссылки на исходные JS/CSS ссылками на собранные файлы.
+    """
+    for source_url, built_url in asset_manifest.items():
+        html = html.replace(f'"{source_url}"', f'"{built_url}"')
+    return html
+
+
+@app.get("/assets/{filename}")
+async def static_asset(filename: str, request: Request):
+    """
+    Собранные JS/CSS. Имя файла содержит хеш, поэтому кэшируются навсегда.
+    """
+    entry = built_assets.get(filename)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+
+    asset, media_type = entry
+    return asset_response(
+        request, asset, media_type, "public, max-age=31536000, immutable"
+    )
+
+
+# ===== МОДЕЛИ ОТВЕТОВ API =====
+# Описывают ответы в документации (/docs). Горячие обработчики возвращают
+# готовый ответ сами, поэтому модели не участвуют в сериализации.
+
+
+class ProductPublic(BaseModel):
+    """Товар на витрине"""
+
+    id: int
+    name: str
+    description: str
+    price: int
+    image_url: Optional[str]
+    image_srcset: Optional[Dict[str, str]]
+    is_available: bool
+    sort_order: Optional[int]
+
+
+class CatalogDelta(BaseModel):
+    """Изменения каталога после ревизии since"""
 
-    for i, item in enumerate(items, 1):
-        message += f"{i}. {item['name']} - {item['quantity']} шт. × {item['price']} сом = {item['quantity'] * item['price']} сом\n"
+    revision: int
+    reset: bool = False  # Клиенту нужно заменить каталог целиком
+    products: List[ProductPublic]  # Новые и измененные товары
+    removed: List[int]  # Удаленные и скрытые товары
 
-    message += f"\nИтого: {total_amount} сом\n\n"
-    message += f"Телефон: {client_phone or 'Не указан'}\n"
-    message += f"Комментарий: {client_comment or 'Нет комментария'}\n\n"
-    message += "Доставка по всему Кыргызстану. Самовывоз в Бишкеке."
 
-    return urllib.parse.quote(message)
+class ProductAdmin(BaseModel):
+    """Товар в админке"""
 
+    id: int
+    name: str
+    description: str
+    price: int
+    image_url: Optional[str]
+    is_available: bool
+    sort_order: int
+    created_at: Optional[str]
 
-def verify_admin(request: Request) -> bool:
-    """
-    Проверяет авторизацию администратора.
-    Используется как зависимость в защищенных эндпоинтах.
-    """
-    auth_header = request.headers.get("Authorization")
-    if not auth_header or not auth_header.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Не авторизован")
 
-    token = auth_header.split(" ")[1]
-    if token != ADMIN_PASSWORD:
-        raise HTTPException(status_code=401, detail="Неверный пароль")
+class OrderAdmin(BaseModel):
+    """Заказ в админке (в режиме summary без items)"""
 
-    return True
+    id: int
+    order_number: str
+    items: Optional[List[Dict[str, Any]]] = None
+    client_phone: Optional[str]
+    client_comment: Optional[str]
+    total_amount: int
+    created_at: Optional[str]
 
 
 # ===== МАРШРУТЫ ГЛАВНОЙ СТРАНИЦЫ =====
 
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
+def read_root(request: Request, db: Session = Depends(get_db)):
     """
     Главная страница магазина.
-    Возвращает HTML шаблон главной страницы.
+    Возвращает HTML шаблон главной страницы с уже встроенным каталогом
+    (из памяти, в сжатом виде). Без каталога отдается обычный шаблон,
+    и товары загрузит main.js - в том числе, когда каталог уже сохранен
+    в браузере (cookie CATALOG_COOKIE) и нужны только изменения.
     """
-    try:
-        with open("templates/index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
+    page = page_cache.get(PAGE_TEMPLATES["index"])
+    if page is None:
         return HTMLResponse(
             content="<h1>BelekBox.kg</h1><p>Магазин подарочных боксов</p>"
         )
 
+    if not request.cookies.get(CATALOG_COOKIE):
+        try:
+            page = storefront_cache.get(page, catalog_cache.get(db))
+        except Exception as e:
+            print(f"Ошибка встраивания каталога: {e}")
+    return asset_response(
+        request, page, "text/html", "no-cache", vary="Accept-Encoding, Cookie"
+    )
+
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_panel():
+async def admin_panel(request: Request):
     """
     Страница админ панели.
     Доступна только авторизованным пользователям.
     """
-    try:
-        with open("templates/admin.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
-    except FileNotFoundError:
+    page = page_cache.get(PAGE_TEMPLATES["admin"])
+    if page is None:
         return HTMLResponse(
             content="<h1>Админ панель</h1><p>Файл admin.html не найден</p>"
         )
+    return asset_response(request, page, "text/html", "no-cache")
 
 
 # ===== API ДЛЯ КЛИЕНТОВ =====
 
 
-@app.get("/api/products")
-async def get_products(db: Session = Depends(get_db)):
+@app.get(
+    "/api/products", response_model=Union[List[ProductPublic], CatalogDelta]
+)
+def get_products(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0),
+    db: Session = Depends(get_db),
+):
     """
     Получение списка доступных товаров.
     Возвращает только товары с is_available=True.
+    Ответ берется из кэша каталога и поддерживает ETag/304.
+    Ревизия каталога приходит в заголовке X-Catalog-Revision; с ?since=<ревизия>
+    возвращаются только изменения после нее (CatalogDelta).
     """
     try:
-        products = (
-            db.query(Product)
-            .filter(Product.is_available == True)
-            .order_by(Product.sort_order, Product.id)
-            .all()
-        )
-
-        return [
-            {
-                "id": p.id,
-                "name": p.name,
-                "description": p.description,
-                "price": p.price,
-                "image_url": p.image_url,
-                "is_available": p.is_available,
-            }
-            for p in products
-        ]
+        snapshot = catalog_cache.get(db)
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Ошибка загрузки товаров: {str(e)}"
         )
 
+    if since is not None:
+        headers = {
+            "ETag": f'"r{snapshot.revision}-{since}"',
+            "Cache-Control": CATALOG_CACHE_CONTROL,
+        }
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        return FastJSONResponse(catalog_delta(snapshot, since), headers=headers)
+
+    headers = {
+        "ETag": snapshot.etag,
+        "Cache-Control": CATALOG_CACHE_CONTROL,
+        "X-Catalog-Revision": str(snapshot.revision),
+    }
+
+    # Клиент уже видел эту версию каталога
+    if etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(
+        content=snapshot.body, media_type="application/json", headers=headers
+    )
+
+
+@app.get("/api/products/search")
+def search_products(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    """
+    Поиск доступных товаров по названию и описанию.
+    Слова ищутся по префиксу без учета регистра и ё/е; совпадения в названии
+    весят больше. Общее число найденных товаров - в заголовке X-Total-Count.
+    """
+    match = search_match_query(q)
+    if match is None:
+        response.headers["X-Total-Count"] = "0"
+        return []
+
+    # CROSS JOIN фиксирует порядок: сначала индекс, потом товары по id
+    matched = (
+        "FROM products_fts CROSS JOIN products p ON p.id = products_fts.rowid "
+        "WHERE products_fts MATCH :match AND p.is_available = 1"
+    )
+    total = db.execute(text(f"SELECT COUNT(*) {matched}"), {"match": match}).scalar()
+    ids = [
+        row[0]
+        for row in db.execute(
+            text(
+                f"SELECT p.id {matched} "
+                "ORDER BY bm25(products_fts, 10.0, 1.0), p.sort_order, p.id "
+                "LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        )
+    ]
+
+    products = {p.id: p for p in db.query(Product).filter(Product.id.in_(ids))}
+    response.headers["X-Total-Count"] = str(total)
+    return [product_to_public_dict(products[i]) for i in ids if i in products]
+
 
 @app.post("/api/orders")
-async def create_order(
+def create_order(
+    request: Request,
     items: str = Form(...),
     total_amount: int = Form(...),
     client_phone: Optional[str] = Form(None),
     client_comment: Optional[str] = Form(None),
+    idempotency_key: Optional[str] = Header(None, max_length=200),
     db: Session = Depends(get_db),
 ):
     """
     Создание нового заказа.
     Принимает товары в корзине и контактные данные клиента.
+    Повтор с тем же заголовком Idempotency-Key возвращает исходный заказ.
+    """
+    fingerprint = None
+    if idempotency_key:
+        fingerprint = hashlib.sha256(
+            json.dumps([items, total_amount, client_phone, client_comment]).encode()
+        ).hexdigest()
+        try:
+            result = find_idempotent_response(idempotency_key, fingerprint)
+        except IdempotencyConflict:
+            return idempotency_conflict_response()
+
+        # Повтор: отдаем сохраненный результат без записи в БД
+        if result is not None:
+            return result
+
+    retry_after = order_rate_limit(request, client_phone)
+    if retry_after:
+        return JSONResponse(
+            status_code=429,
+            content={
+                "success": False,
+                "error": "Слишком много заказов, попробуйте позже",
+            },
+            headers={"Retry-After": str(int(retry_after) + 1)},
+        )
+    return place_order(
+        items,
+        total_amount,
+        client_phone,
+        client_comment,
+        db,
+        idempotency_key,
+        fingerprint,
+    )
+
+
+def idempotency_conflict_response() -> JSONResponse:
+    """
+    Ответ на ключ Idempotency-Key, уже использованный для другого заказа.
+    """
+    return JSONResponse(
+        status_code=422,
+        content={
+            "success": False,
+            "error": "Ключ Idempotency-Key уже использован для другого заказа",
+        },
+    )
+
+
+def place_order(
+    items: str,
+    total_amount: int,
+    client_phone: Optional[str],
+    client_comment: Optional[str],
+    db: Session,
+    idempotency_key: Optional[str] = None,
+    fingerprint: Optional[str] = None,
+):
+    """
+    Проверяет и записывает заказ, возвращает номер заказа и ссылку на WhatsApp.
+    Названия, цены и сумма берутся из индекса цен каталога (quote_cart).
+    С idempotency_key ответ записывается в idempotency_keys той же
+    транзакцией, что и заказ.
     """
     try:
         # Парсим JSON с товарами
-        items_data = json.loads(items)
+        try:
+            items_data = json.loads(items)
+        except json.JSONDecodeError:
+            return {"success": False, "error": "Неверный формат товаров"}
 
         if not items_data:
             return {"success": False, "error": "Корзина пуста"}
 
-        # Генерируем номер заказа
-        order_number = generate_order_number()
+        # Ошибки корзины (формат, количество) отдаются клиенту как есть
+        try:
+            lines = cart_lines(items_data)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
 
-        # Создаем заказ
-        order = Order(
-            order_number=order_number,
-            items_json=items,
-            client_phone=client_phone,
-            client_comment=client_comment,
-            total_amount=total_amount,
-        )
+        # Цены и сумма - по текущему каталогу, а не из корзины клиента
+        quote = quote_cart(catalog_cache.get(db).prices, lines)
+        if quote["unavailable"]:
+            return {
+                "success": False,
+                "error": "Некоторые товары больше недоступны, проверьте корзину",
+                "unavailable": quote["unavailable"],
+            }
+        items_data = quote["items"]
+        items = dumps_json(items_data).decode("utf-8")
+        total_amount = quote["total_amount"]
 
-        # Сохраняем в БД
-        db.add(order)
-        db.commit()
-        db.refresh(order)
+        # Генерируем номер заказа
+        order_number = generate_order_number()
+        created_at = datetime.now()
 
         # Создаем ссылку для WhatsApp
         whatsapp_url = (
@@ -318,19 +3888,106 @@ async def create_order(
                 order_number, items_data, total_amount, client_phone, client_comment
             )
         )
-
-        return {
+        result = {
             "success": True,
             "order_number": order_number,
+            "total_amount": total_amount,
             "whatsapp_url": whatsapp_url,
         }
 
-    except json.JSONDecodeError:
-        return {"success": False, "error": "Неверный формат товаров"}
+        # Заказ вместе с позициями и ключом идемпотентности
+        # (записываются одной транзакцией)
+        def make_order() -> Order:
+            return Order(
+                order_number=order_number,
+                items_json=items,
+                client_phone=client_phone,
+                client_comment=client_comment,
+                total_amount=total_amount,
+                created_at=created_at,
+                order_items=order_items_from_json(items_data, created_at),
+                idempotency_key=(
+                    IdempotencyKey(
+                        key=idempotency_key,
+                        fingerprint=fingerprint,
+                        response=dumps_json(result).decode("utf-8"),
+                        created_at=created_at,
+                    )
+                    if idempotency_key
+                    else None
+                ),
+            )
+
+        # Сохраняем в БД: через очередь пакетной записи или сразу
+        if order_writer is not None:
+            order_writer.submit(make_order)
+        else:
+            order = make_order()
+            db.add(order)
+            record_daily_sales(db, order)
+            enqueue_notifications(order)
+            db.commit()
+        order_feed.notify()
+        notification_dispatcher.notify()
+
+        return result
+
+    except IntegrityError:
+        # Тот же ключ Idempotency-Key успел записать параллельный повтор
+        db.rollback()
+        if idempotency_key:
+            try:
+                replay = find_idempotent_response(idempotency_key, fingerprint)
+            except IdempotencyConflict:
+                return idempotency_conflict_response()
+            if replay is not None:
+                return replay
+        return {"success": False, "error": "Не удалось сохранить заказ"}
+    except OrderQueueFull:
+        return JSONResponse(
+            status_code=503,
+            content={
+                "success": False,
+                "error": "Слишком много заказов, попробуйте через минуту",
+            },
+            headers={"Retry-After": "5"},
+        )
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
+class CartLine(BaseModel):
+    """Позиция корзины"""
+
+    id: int
+    quantity: int = Field(ge=1, le=CART_MAX_QUANTITY)
+
+
+class CartQuoteRequest(BaseModel):
+    """Корзина для пересчета"""
+
+    items: List[CartLine] = Field(max_length=CART_MAX_LINES)
+
+
+@app.post("/api/cart/quote")
+def cart_quote(request: CartQuoteRequest, db: Session = Depends(get_db)):
+    """
+    Пересчет корзины по текущим ценам.
+    Возвращает позиции с актуальными названиями и ценами, итоговую сумму
+    и id товаров, которые больше нельзя заказать. Тот же расчет
+    использует создание заказа.
+    """
+    try:
+        snapshot = catalog_cache.get(db)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Ошибка загрузки товаров: {str(e)}"
+        )
+    return quote_cart(
+        snapshot.prices, [(line.id, line.quantity) for line in request.items]
+    )
+
+
 @app.get("/api/health")
 async def health_check():
     """
@@ -345,6 +4002,18 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def metrics_endpoint(request: Request):
+    """
+    Метрики в текстовом формате Prometheus.
+    """
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Неверный токен")
+    return Response(
+        content=metrics.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 # ===== API ДЛЯ АДМИНИСТРАТОРОВ =====
 
 
@@ -365,8 +4034,12 @@ async def admin_login(request: LoginRequest):
     return {"success": False, "error": "Неверный пароль"}
 
 
-@app.get("/api/admin/products")
-async def admin_get_products(
+@app.get(
+    "/api/admin/products",
+    response_model=List[ProductAdmin],
+    response_class=FastJSONResponse,
+)
+def admin_get_products(
     verified: bool = Depends(verify_admin), db: Session = Depends(get_db)
 ):
     """
@@ -376,19 +4049,21 @@ async def admin_get_products(
     try:
         products = db.query(Product).order_by(Product.sort_order, Product.id).all()
 
-        return [
-            {
-                "id": p.id,
-                "name": p.name,
-                "description": p.description,
-                "price": p.price,
-                "image_url": p.image_url,
-                "is_available": p.is_available,
-                "sort_order": p.sort_order,
-                "created_at": p.created_at.isoformat() if p.created_at else None,
-            }
-            for p in products
-        ]
+        return FastJSONResponse(
+            [
+                {
+                    "id": p.id,
+                    "name": p.name,
+                    "description": p.description,
+                    "price": p.price,
+                    "image_url": p.image_url,
+                    "is_available": p.is_available,
+                    "sort_order": p.sort_order,
+                    "created_at": p.created_at.isoformat() if p.created_at else None,
+                }
+                for p in products
+            ]
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"Ошибка загрузки товаров: {str(e)}"
@@ -396,7 +4071,7 @@ async def admin_get_products(
 
 
 @app.post("/api/admin/products")
-async def admin_create_product(
+def admin_create_product(
     name: str = Form(...),
     description: str = Form(...),
     price: int = Form(...),
@@ -411,44 +4086,46 @@ async def admin_create_product(
     Поддерживает загрузку изображения товара.
     """
     try:
+        image_hash = None
         image_url = None
+        image_variants = None
 
         # Обрабатываем загруженное изображение
         if image and image.filename:
-            # Создаем уникальное имя файла
-            file_extension = os.path.splitext(image.filename)[1]
-            filename = f"{uuid.uuid4().hex}{file_extension}"
-            file_path = f"uploads/products/{filename}"
-
-            # Сохраняем файл
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(image.file, buffer)
-
-            image_url = f"/uploads/products/{filename}"
+            image_hash, image_url, image_variants = acquire_image(db, image)
 
         # Создаем товар
         product = Product(
             name=name,
             description=description,
             price=price,
+            image_hash=image_hash,
             image_url=image_url,
+            image_variants=image_variants,
             is_available=is_available,
             sort_order=sort_order,
+            revision=next_catalog_revision(db),
         )
 
-        # Сохраняем в БД
+        # Сохраняем в БД вместе с поисковым индексом
         db.add(product)
+        db.flush()
+        clear_tombstones(db, [product.id])
+        index_product(db, product)
         db.commit()
         db.refresh(product)
+        catalog_cache.rebuild(db)
 
         return {"success": True, "product_id": product.id}
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
 @app.put("/api/admin/products/{product_id}")
-async def admin_update_product(
+def admin_update_product(
     product_id: int,
     name: Optional[str] = Form(None),
     description: Optional[str] = Form(None),
@@ -483,24 +4160,21 @@ async def admin_update_product(
 
         # Обновляем изображение если нужно
         if image and image.filename:
-            # Удаляем старое изображение если было
-            if product.image_url:
-                old_path = product.image_url.replace("/uploads/", "uploads/")
-                if os.path.exists(old_path):
-                    os.remove(old_path)
+            # Сохраняем новое изображение и отпускаем старое
+            old_hash = product.image_hash
+            image_hash, image_url, image_variants = acquire_image(db, image)
+            release_image(db, old_hash)
 
-            # Сохраняем новое изображение
-            file_extension = os.path.splitext(image.filename)[1]
-            filename = f"{uuid.uuid4().hex}{file_extension}"
-            file_path = f"uploads/products/{filename}"
-
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(image.file, buffer)
-
-            product.image_url = f"/uploads/products/{filename}"
+            product.image_hash = image_hash
+            product.image_url = image_url
+            product.image_variants = image_variants
 
         # Сохраняем изменения
+        product.revision = next_catalog_revision(db)
+        if name is not None or description is not None:
+            index_product(db, product)
         db.commit()
+        catalog_cache.rebuild(db)
         return {"success": True}
 
     except HTTPException:
@@ -510,7 +4184,7 @@ async def admin_update_product(
 
 
 @app.delete("/api/admin/products/{product_id}")
-async def admin_delete_product(
+def admin_delete_product(
     product_id: int,
     verified: bool = Depends(verify_admin),
     db: Session = Depends(get_db),
@@ -525,15 +4199,20 @@ async def admin_delete_product(
         if not product:
             raise HTTPException(status_code=404, detail="Товар не найден")
 
-        # Удаляем изображение если есть
-        if product.image_url:
-            image_path = product.image_url.replace("/uploads/", "uploads/")
-            if os.path.exists(image_path):
-                os.remove(image_path)
+        # Изображение удалит фоновая очистка, если оно больше никому не нужно
+        release_image(db, product.image_hash)
 
-        # Удаляем товар из БД
+        # Удаляем товар из БД и из поискового индекса; запись об удалении
+        # сообщит клиентам с сохраненным каталогом
+        unindex_product(db, product.id)
+        db.merge(
+            ProductTombstone(
+                product_id=product.id, revision=next_catalog_revision(db)
+            )
+        )
         db.delete(product)
         db.commit()
+        catalog_cache.rebuild(db)
 
         return {"success": True}
 
@@ -543,59 +4222,595 @@ async def admin_delete_product(
         return {"success": False, "error": str(e)}
 
 
-@app.get("/api/admin/orders")
-async def admin_get_orders(
-    verified: bool = Depends(verify_admin), db: Session = Depends(get_db)
+@app.post("/api/admin/import/products")
+def admin_import_products(
+    manifest: UploadFile = File(...),
+    images: Optional[UploadFile] = File(None),
+    verified: bool = Depends(verify_admin),
+    db: Session = Depends(get_db),
+):
+    """
+    Массовое добавление и обновление товаров (для смены сезона).
+    Принимает манифест CSV или JSON и zip-архив изображений: строки с id
+    обновляют товары, без id - создают новые. Все изменения записываются
+    одной транзакцией, поэтому ошибка в любой строке не меняет ничего.
+    """
+    try:
+        rows = parse_import_manifest(manifest.filename or "", manifest.file.read())
+
+        # Текущие значения обновляемых товаров - одним запросом
+        update_ids = [row["id"] for row in rows if "id" in row]
+        current = {
+            product.id: product._asdict()
+            for product in db.execute(
+                select(*IMPORT_PRODUCT_COLUMNS).where(Product.id.in_(update_ids))
+            )
+        }
+        missing = [str(i) for i in update_ids if i not in current]
+        if missing:
+            raise ValueError(f"Товары не найдены: {', '.join(missing)}")
+
+        # Изображения из архива (одинаковые файлы обрабатываются один раз)
+        refs = {}
+        for row in rows:
+            if "image" in row:
+                refs[row["image"]] = refs.get(row["image"], 0) + 1
+        acquired = {}
+        if refs:
+            if not images or not images.filename:
+                raise ValueError("В манифесте указаны изображения, но нет архива")
+            try:
+                acquired = acquire_images(
+                    db, stream_zip_images(images.file, refs), refs
+                )
+            except BadImage as e:
+                numbers = [
+                    str(number)
+                    for number, row in enumerate(rows, 1)
+                    if row.get("image") in e.names
+                ]
+                raise ValueError(
+                    f"Строка {', '.join(numbers)} ({', '.join(e.names)}): {e}"
+                )
+
+        created_at = datetime.now()
+        revision = next_catalog_revision(db)
+        inserts = []
+        updates = []
+        released = {}
+        for row in rows:
+            values = {k: v for k, v in row.items() if k not in ("id", "image")}
+            values["revision"] = revision
+            if "image" in row:
+                image_hash, image_url, image_variants = acquired[row["image"]]
+                values["image_hash"] = image_hash
+                values["image_url"] = image_url
+                values["image_variants"] = image_variants
+
+            if "id" in row:
+                product = current[row["id"]]
+                if "image" in row and product["image_hash"]:
+                    old_hash = product["image_hash"]
+                    released[old_hash] = released.get(old_hash, 0) + 1
+                product.update(values)
+                updates.append(product)
+            else:
+                inserts.append({**IMPORT_DEFAULTS, "created_at": created_at, **values})
+
+        # Один executemany на все обновления и один на все новые товары
+        if updates:
+            db.execute(update(Product), updates)
+        new_ids = []
+        if inserts:
+            new_ids = db.scalars(
+                insert(Product).returning(Product.id, sort_by_parameter_order=True),
+                inserts,
+            ).all()
+        if new_ids:
+            clear_tombstones(db, new_ids)
+        for content_hash, count in released.items():
+            release_image(db, content_hash, count)
+
+        # Номера товаров в порядке строк манифеста
+        created = iter(new_ids)
+        product_ids = [row["id"] if "id" in row else next(created) for row in rows]
+
+        index_products(
+            db,
+            db.execute(
+                select(Product.id, Product.name, Product.description).where(
+                    Product.id.in_(product_ids)
+                )
+            ).all(),
+        )
+        db.commit()
+        catalog_cache.rebuild(db)
+
+        return {
+            "success": True,
+            "created": len(inserts),
+            "updated": len(updates),
+            "product_ids": product_ids,
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+
+class ReorderRequest(BaseModel):
+    """Новый порядок товаров: id в порядке показа"""
+
+    product_ids: List[int]
+
+
+@app.post("/api/admin/products/reorder")
+def admin_reorder_products(
+    request: ReorderRequest,
+    verified: bool = Depends(verify_admin),
+    db: Session = Depends(get_db),
+):
+    """
+    Переставляет товары: sort_order становится позицией товара в списке
+    (начиная с 1). Все товары обновляются одним запросом UPDATE ... CASE.
+    """
+    try:
+        product_ids = request.product_ids
+        if not product_ids:
+            raise ValueError("Список товаров пуст")
+        if len(product_ids) > BULK_MAX_PRODUCTS:
+            raise ValueError(f"Слишком много товаров (максимум {BULK_MAX_PRODUCTS})")
+        if len(set(product_ids)) != len(product_ids):
+            raise ValueError("Товары в списке повторяются")
+
+        positions = {
+            product_id: position
+            for position, product_id in enumerate(product_ids, 1)
+        }
+        updated = (
+            db.query(Product)
+            .filter(Product.id.in_(product_ids))
+            .update(
+                {
+                    Product.sort_order: case(positions, value=Product.id),
+                    Product.revision: next_catalog_revision(db),
+                },
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        catalog_cache.rebuild(db)
+        return {"success": True, "updated": updated}
+
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+
+@app.get(
+    "/api/admin/orders",
+    response_model=List[OrderAdmin],
+    response_model_exclude_none=True,
+    response_class=FastJSONResponse,
+)
+def admin_get_orders(
+    limit: int = Query(ORDERS_PAGE_SIZE, ge=1, le=ORDERS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    phone: Optional[str] = None,
+    min_amount: Optional[int] = None,
+    max_amount: Optional[int] = None,
+    order_number: Optional[str] = None,
+    summary: bool = False,
+    verified: bool = Depends(verify_admin),
+    db: Session = Depends(get_db),
+):
+    """
+    Получение заказов для админки постранично (сначала новые).
+    Курсор следующей страницы возвращается в заголовке X-Next-Cursor.
+    В режиме summary товары заказа не загружаются.
+    Когда заказы в БД закончились, страница дополняется из архива.
+    """
+    try:
+        if order_number:
+            # Поиск по номеру: сначала БД, затем индекс архива
+            row = (
+                db.query(*ARCHIVE_COLUMNS)
+                .filter(Order.order_number == order_number)
+                .first()
+            ) or order_archive.find(order_number)
+            orders = [order_to_admin_dict(row, with_items=not summary)] if row else []
+            return FastJSONResponse(orders)
+
+        columns = [
+            Order.id,
+            Order.order_number,
+            Order.client_phone,
+            Order.client_comment,
+            Order.total_amount,
+            Order.created_at,
+        ]
+        if not summary:
+            columns.append(Order.items_json)
+
+        query = db.query(*columns)
+
+        # Фильтры
+        query = query.filter(*date_range_filter(Order.created_at, date_from, date_to))
+        if phone:
+            query = query.filter(Order.client_phone.contains(phone))
+        if min_amount is not None:
+            query = query.filter(Order.total_amount >= min_amount)
+        if max_amount is not None:
+            query = query.filter(Order.total_amount <= max_amount)
+
+        # Продолжаем с позиции предыдущей страницы
+        before = decode_orders_cursor(cursor) if cursor else None
+        if before:
+            query = query.filter(tuple_(Order.created_at, Order.id) < before)
+
+        # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+        rows = (
+            query.order_by(Order.created_at.desc(), Order.id.desc())
+            .limit(limit + 1)
+            .all()
+        )
+
+        # Архивные заказы старше заказов в БД: дополняют неполную страницу
+        if len(rows) <= limit:
+            seen = {row.order_number for row in rows}
+            archived = []
+            for order in archived_orders(date_from, date_to, before, reverse=True):
+                if order.order_number in seen:
+                    continue
+                if phone and phone not in (order.client_phone or ""):
+                    continue
+                if min_amount is not None and order.total_amount < min_amount:
+                    continue
+                if max_amount is not None and order.total_amount > max_amount:
+                    continue
+                archived.append(order)
+                if len(archived) > limit - len(rows):
+                    break
+            rows = sorted(
+                rows + archived, key=lambda o: (o.created_at, o.id), reverse=True
+            )
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            headers["X-Next-Cursor"] = encode_orders_cursor(last.created_at, last.id)
+
+        orders = [order_to_admin_dict(o, with_items=not summary) for o in rows]
+        return FastJSONResponse(orders, headers=headers)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Ошибка загрузки заказов: {str(e)}"
+        )
+
+
+def iter_orders_export(
+    export_format: str, date_from: Optional[date], date_to: Optional[date]
+):
+    """
+    Генератор выгрузки заказов в CSV или NDJSON.
+    Заказы читаются пачками по EXPORT_BATCH_SIZE, поэтому память не растет
+    вместе с историей заказов. Сначала идут заказы из архива (если период
+    его захватывает), затем заказы из БД.
+    Запрос к БД открывается до чтения архива и держит один снимок до конца
+    выгрузки; заказ, перенесенный в архив уже после начала, есть в этом
+    снимке и из архива пропускается (проверка по id в том же снимке).
+    """
+    db = SessionLocal()
+    try:
+        query = (
+            select(
+                Order.id,
+                Order.order_number,
+                Order.created_at,
+                Order.client_phone,
+                Order.client_comment,
+                Order.total_amount,
+                Order.items_json,
+            )
+            .where(*date_range_filter(Order.created_at, date_from, date_to))
+            .order_by(Order.created_at, Order.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        result = db.execute(query)
+
+        if export_format == "csv":
+            # BOM, чтобы Excel правильно открыл кириллицу
+            yield "\ufeff".encode("utf-8")
+            yield ",".join(result.keys()).encode("utf-8") + b"\r\n"
+
+        def archived_batches():
+            archived = archived_orders(date_from, date_to)
+            while True:
+                rows = list(itertools.islice(archived, EXPORT_BATCH_SIZE))
+                if not rows:
+                    return
+                in_db = set(
+                    db.scalars(
+                        select(Order.id).where(Order.id.in_([row.id for row in rows]))
+                    )
+                )
+                yield [row for row in rows if row.id not in in_db]
+
+        for rows in itertools.chain(archived_batches(), result.partitions()):
+            buffer = io.StringIO()
+            if export_format == "csv":
+                writer = csv.writer(buffer)
+                for row in rows:
+                    writer.writerow(
+                        [
+                            row.id,
+                            row.order_number,
+                            row.created_at.isoformat() if row.created_at else "",
+                            row.client_phone or "",
+                            row.client_comment or "",
+                            row.total_amount,
+                            row.items_json,
+                        ]
+                    )
+            else:
+                for row in rows:
+                    buffer.write(
+                        json.dumps(
+                            {
+                                "id": row.id,
+                                "order_number": row.order_number,
+                                "items": json.loads(row.items_json),
+                                "client_phone": row.client_phone,
+                                "client_comment": row.client_comment,
+                                "total_amount": row.total_amount,
+                                "created_at": row.created_at.isoformat()
+                                if row.created_at
+                                else None,
+                            },
+                            ensure_ascii=False,
+                        )
+                    )
+                    buffer.write("\n")
+            yield buffer.getvalue().encode("utf-8")
+    finally:
+        db.close()
+
+
+@app.get("/api/admin/orders/stream")
+async def admin_order_stream(
+    last_event_id: Optional[str] = Header(None),
+    verified: bool = Depends(verify_admin),
+):
+    """
+    Живая лента новых заказов (Server-Sent Events).
+    Каждый заказ - событие order с id заказа в качестве id события;
+    после переподключения с Last-Event-ID досылаются пропущенные заказы.
+    """
+    after_id = None
+    if last_event_id:
+        try:
+            after_id = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Неверный Last-Event-ID")
+
+    return StreamingResponse(
+        order_feed_events(after_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/admin/orders/queue")
+def admin_order_queue(verified: bool = Depends(verify_admin)):
+    """
+    Состояние очереди пакетной записи заказов: размеры пачек,
+    время ожидания в очереди и число отклоненных заказов.
+    """
+    if order_writer is None:
+        return {"enabled": False}
+    return {"enabled": True, **order_writer.snapshot()}
+
+
+@app.get("/api/admin/orders/export")
+def admin_export_orders(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    verified: bool = Depends(verify_admin),
+):
+    """
+    Выгрузка истории заказов для бухгалтерии.
+    Ответ отдается потоком (CSV или NDJSON).
+    """
+    media_types = {
+        "csv": "text/csv",
+        "ndjson": "application/x-ndjson",
+    }
+    filename = f"orders-{datetime.now().strftime('%Y%m%d')}.{format}"
+
+    return StreamingResponse(
+        iter_orders_export(format, date_from, date_to),
+        media_type=media_types[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/api/admin/stats/products")
+def admin_product_stats(
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    order_by: str = Query("units", pattern="^(units|revenue)$"),
+    limit: int = Query(20, ge=1, le=500),
+    verified: bool = Depends(verify_admin),
+    db: Session = Depends(get_db),
 ):
     """
-    Получение всех заказов для админки.
+    Продажи по товарам за период: количество и выручка.
+    Считается по дневным итогам, поэтому учитывает и заказы из архива.
     """
     try:
-        orders = db.query(Order).order_by(Order.created_at.desc()).all()
+        units = func.sum(DailyProductSales.units).label("units")
+        revenue = func.sum(DailyProductSales.revenue).label("revenue")
+
+        query = db.query(
+            DailyProductSales.product_id,
+            func.max(DailyProductSales.name).label("name"),
+            units,
+            revenue,
+        )
+        if date_from is not None:
+            query = query.filter(DailyProductSales.day >= date_from)
+        if date_to is not None:
+            query = query.filter(DailyProductSales.day <= date_to)
+
+        rows = (
+            query.group_by(DailyProductSales.product_id)
+            .order_by((units if order_by == "units" else revenue).desc())
+            .limit(limit)
+            .all()
+        )
 
         return [
             {
-                "id": o.id,
-                "order_number": o.order_number,
-                "items": json.loads(o.items_json),
-                "client_phone": o.client_phone,
-                "client_comment": o.client_comment,
-                "total_amount": o.total_amount,
-                "created_at": o.created_at.isoformat() if o.created_at else None,
+                "product_id": r.product_id or None,
+                "name": r.name,
+                "units": r.units,
+                "revenue": r.revenue,
             }
-            for o in orders
+            for r in rows
         ]
     except Exception as e:
         raise HTTPException(
-            status_code=500, detail=f"Ошибка загрузки заказов: {str(e)}"
+            status_code=500, detail=f"Ошибка загрузки статистики: {str(e)}"
+        )
+
+
+@app.get("/api/admin/analytics")
+def admin_analytics(
+    period: str = Query("day", pattern="^(day|week)$"),
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    top: int = Query(10, ge=1, le=100),
+    verified: bool = Depends(verify_admin),
+    db: Session = Depends(get_db),
+):
+    """
+    Аналитика продаж по дням или неделям и лучшие товары за период.
+    Читает только дневные итоги, без сканирования заказов.
+    """
+    try:
+        # Неделя обозначается датой ее понедельника
+        if period == "week":
+            bucket = func.date(DailySales.day, "-6 days", "weekday 1")
+        else:
+            bucket = DailySales.day
+        bucket = bucket.label("period")
+
+        query = db.query(
+            bucket,
+            func.sum(DailySales.orders_count).label("orders"),
+            func.sum(DailySales.revenue).label("revenue"),
+            func.sum(DailySales.units).label("units"),
+        )
+        if date_from is not None:
+            query = query.filter(DailySales.day >= date_from)
+        if date_to is not None:
+            query = query.filter(DailySales.day <= date_to)
+        rows = query.group_by(bucket).order_by(bucket).all()
+
+        series = [
+            {
+                "period": str(r.period),
+                "orders": r.orders,
+                "revenue": r.revenue,
+                "units": r.units,
+                "avg_basket": round(r.revenue / r.orders) if r.orders else 0,
+            }
+            for r in rows
+        ]
+
+        units = func.sum(DailyProductSales.units).label("units")
+        top_query = db.query(
+            DailyProductSales.product_id,
+            func.max(DailyProductSales.name).label("name"),
+            units,
+            func.sum(DailyProductSales.revenue).label("revenue"),
+        )
+        if date_from is not None:
+            top_query = top_query.filter(DailyProductSales.day >= date_from)
+        if date_to is not None:
+            top_query = top_query.filter(DailyProductSales.day <= date_to)
+        top_rows = (
+            top_query.group_by(DailyProductSales.product_id)
+            .order_by(units.desc())
+            .limit(top)
+            .all()
+        )
+
+        total_orders = sum(item["orders"] for item in series)
+        total_revenue = sum(item["revenue"] for item in series)
+
+        return {
+            "period": period,
+            "series": series,
+            "totals": {
+                "orders": total_orders,
+                "revenue": total_revenue,
+                "avg_basket": round(total_revenue / total_orders)
+                if total_orders
+                else 0,
+            },
+            "top_products": [
+                {
+                    "product_id": r.product_id or None,
+                    "name": r.name,
+                    "units": r.units,
+                    "revenue": r.revenue,
+                }
+                for r in top_rows
+            ],
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Ошибка загрузки аналитики: {str(e)}"
         )
 
 
 @app.post("/api/admin/hide-all")
-async def admin_hide_all(
+def admin_hide_all(
     verified: bool = Depends(verify_admin), db: Session = Depends(get_db)
 ):
     """
     Скрывает все товары (для смены сезона).
     """
     try:
-        db.query(Product).update({Product.is_available: False})
+        db.query(Product).update(
+            {Product.is_available: False, Product.revision: next_catalog_revision(db)}
+        )
         db.commit()
+        catalog_cache.rebuild(db)
         return {"success": True, "hidden": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
 @app.post("/api/admin/show-all")
-async def admin_show_all(
+def admin_show_all(
     verified: bool = Depends(verify_admin), db: Session = Depends(get_db)
 ):
     """
     Показывает все товары.
     """
     try:
-        db.query(Product).update({Product.is_available: True})
+        db.query(Product).update(
+            {Product.is_available: True, Product.revision: next_catalog_revision(db)}
+        )
         db.commit()
+        catalog_cache.rebuild(db)
         return {"success": True, "shown": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -621,5 +4836,27 @@ if __name__ == "__main__":
     import uvicorn
     import os
 
+    # Служебные команды: python app.py <команда>
+    if len(sys.argv) > 1:
+        prepare_storage()
+        if sys.argv[1] == "rebuild-analytics":
+            with engine.begin() as conn:
+                rebuild_sales_rollups(conn)
+            print("Аналитика пересчитана")
+            sys.exit(0)
+        if sys.argv[1] == "build-static":
+            for source_url, built_url in build_static_assets().items():
+                print(f"{source_url} -> {built_url}")
+            sys.exit(0)
+        print(f"Неизвестная команда: {sys.argv[1]}")
+        sys.exit(1)
+
     port = int(os.getenv("PORT", 8000))  # <- вот это важно
-    uvicorn.run(app, host="localhost", port=port, reload=False)
+    # Несколько процессов uvicorn запускает только по строке импорта
+    uvicorn.run(
+        "app:app" if WEB_CONCURRENCY > 1 else app,
+        host="localhost",
+        port=port,
+        reload=False,
+        workers=WEB_CONCURRENCY,
+    )
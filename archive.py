@@ -0,0 +1,227 @@
+"""
+BelekBox.kg - Архив старых заказов
+Заказы хранятся по месяцам: YYYY-MM.ndjson.gz - строки таблицы orders
+в NDJSON. Сегмент только дописывается: каждый перенос добавляет в конец
+отдельный gzip-блок, а записанные блоки не переписываются. Рядом лежит
+индекс YYYY-MM.idx.json: смещения блоков, диапазон дат каждого блока и
+номера заказов, поэтому читаются только блоки, попавшие в запрос.
+"""
+
+import os
+import gzip
+import json
+from datetime import datetime
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+
+class ArchivedOrder(NamedTuple):
+    """Заказ из архива (те же поля, что у строки orders)"""
+
+    id: int
+    order_number: str
+    items_json: str
+    client_phone: Optional[str]
+    client_comment: Optional[str]
+    total_amount: int
+    created_at: datetime
+
+
+def month_key(moment: datetime) -> str:
+    """
+    Сегмент, в который попадает момент времени (YYYY-MM).
+    """
+    return f"{moment.year:04d}-{moment.month:02d}"
+
+
+def order_month(order_number: str) -> Optional[str]:
+    """
+    Месяц из номера заказа BB-YYYYMMDD-XXXXXX (None для чужого формата).
+    """
+    parts = order_number.split("-")
+    if len(parts) != 3 or len(parts[1]) != 8 or not parts[1].isdigit():
+        return None
+    return f"{parts[1][:4]}-{parts[1][4:6]}"
+
+
+class OrderArchive:
+    """
+    Помесячные сегменты заказов в папке root.
+    Дописывать сегменты должен один процесс (за это отвечает вызывающий),
+    читать можно из любого числа процессов: индекс заменяется атомарно
+    и ссылается только на полностью записанные блоки.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._indexes: Dict[str, tuple] = {}  # месяц -> (версия файла, индекс)
+
+    def _data_path(self, month: str) -> str:
+        return os.path.join(self.root, f"{month}.ndjson.gz")
+
+    def _index_path(self, month: str) -> str:
+        return os.path.join(self.root, f"{month}.idx.json")
+
+    def months(self) -> List[str]:
+        """
+        Месяцы, для которых есть сегменты (по возрастанию).
+        """
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return sorted(n[: -len(".idx.json")] for n in names if n.endswith(".idx.json"))
+
+    def index(self, month: str) -> dict:
+        """
+        Индекс сегмента (перечитывается, только если файл изменился).
+        """
+        path = self._index_path(month)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return {"size": 0, "members": [], "orders": {}}
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._indexes.get(month)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self._indexes[month] = (version, index)
+        return index
+
+    def append(self, month: str, orders: List[ArchivedOrder]) -> int:
+        """
+        Дописывает заказы в сегмент месяца одним блоком.
+        Заказы, которые уже есть в индексе, пропускаются, поэтому повтор
+        после сбоя не создает дублей. Возвращает число записанных заказов.
+        """
+        index = self.index(month)
+        orders = [o for o in orders if o.order_number not in index["orders"]]
+        if not orders:
+            return 0
+        orders.sort(key=lambda o: (o.created_at, o.id))
+
+        lines = []
+        for order in orders:
+            record = order._asdict()
+            record["created_at"] = order.created_at.isoformat()
+            lines.append(json.dumps(record, ensure_ascii=False))
+        block = gzip.compress(("\n".join(lines) + "\n").encode("utf-8"), mtime=0)
+
+        # Хвост после последнего проиндексированного блока - остаток
+        # прерванной записи, он затирается новым блоком
+        os.makedirs(self.root, exist_ok=True)
+        offset = index["size"]
+        data_path = self._data_path(month)
+        with open(data_path, "r+b" if os.path.exists(data_path) else "wb") as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+
+        member = len(index["members"])
+        new_index = {
+            "size": offset + len(block),
+            "members": index["members"]
+            + [
+                {
+                    "offset": offset,
+                    "length": len(block),
+                    "count": len(orders),
+                    "first": orders[0].created_at.isoformat(),
+                    "last": orders[-1].created_at.isoformat(),
+                }
+            ],
+            "orders": {
+                **index["orders"],
+                **{o.order_number: member for o in orders},
+            },
+        }
+        tmp_path = self._index_path(month) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(new_index, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._index_path(month))
+        return len(orders)
+
+    def _read_member(self, month: str, member: dict) -> List[ArchivedOrder]:
+        with open(self._data_path(month), "rb") as f:
+            f.seek(member["offset"])
+            block = f.read(member["length"])
+        orders = []
+        for line in gzip.decompress(block).decode("utf-8").splitlines():
+            record = json.loads(line)
+            record["created_at"] = datetime.fromisoformat(record["created_at"])
+            orders.append(ArchivedOrder(**record))
+        return orders
+
+    def read_month(
+        self,
+        month: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> List[ArchivedOrder]:
+        """
+        Заказы месяца с start <= created_at < end по возрастанию даты.
+        Распаковываются только блоки, пересекающиеся с периодом.
+        """
+        orders = []
+        for member in self.index(month)["members"]:
+            if start is not None and datetime.fromisoformat(member["last"]) < start:
+                continue
+            if end is not None and datetime.fromisoformat(member["first"]) >= end:
+                continue
+            orders.extend(
+                o
+                for o in self._read_member(month, member)
+                if (start is None or o.created_at >= start)
+                and (end is None or o.created_at < end)
+            )
+        orders.sort(key=lambda o: (o.created_at, o.id))
+        return orders
+
+    def scan(
+        self,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        reverse: bool = False,
+    ) -> Iterator[ArchivedOrder]:
+        """
+        Заказы за период [start, end) по дате (reverse - сначала новые).
+        В памяти одновременно держится не больше одного месяца.
+        Сегменты вне периода не открываются.
+        """
+        months = [
+            m
+            for m in self.months()
+            if (start is None or m >= month_key(start))
+            and (end is None or m <= month_key(end))
+        ]
+        if reverse:
+            months.reverse()
+        for month in months:
+            orders = self.read_month(month, start, end)
+            if reverse:
+                orders.reverse()
+            yield from orders
+
+    def find(self, order_number: str) -> Optional[ArchivedOrder]:
+        """
+        Заказ по номеру: по индексу находится блок, читается только он.
+        """
+        months = self.months()
+        guess = order_month(order_number)
+        if guess in months:
+            months.remove(guess)
+            months.insert(0, guess)
+        for month in months:
+            index = self.index(month)
+            member = index["orders"].get(order_number)
+            if member is None:
+                continue
+            for order in self._read_member(month, index["members"][member]):
+                if order.order_number == order_number:
+                    return order
+        return None
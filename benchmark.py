@@ -0,0 +1,454 @@
+"""
+BelekBox.kg - Нагрузочный тест основных эндпоинтов
+Запускает приложение на временной базе с синтетическим каталогом и историей
+заказов, замеряет пропускную способность и задержки (p50/p95/p99) и
+сохраняет результат в JSON для сравнения с эталоном.
+
+Использование:
+    python benchmark.py                          # в процессе, через ASGI
+    python benchmark.py --mode uvicorn           # через запущенный uvicorn
+    python benchmark.py --output after.json --baseline before.json
+    python benchmark.py --scaling                # рост задержки с конкурентностью
+
+Нужен httpx (pip install httpx).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import httpx
+
+# Сценарии: имя -> эндпоинт
+SCENARIOS = ["products", "products_delta", "orders", "cart_quote", "admin_orders", "root"]
+
+# Проверка масштабирования (--scaling): сценарии с запросами к БД, задержка,
+# добавляемая к каждому SQL-запросу (имитирует ожидание диска), и во сколько
+# раз может вырасти p50 при конкурентности N по сравнению с одним запросом.
+# Если запросы к БД блокируют event loop, p50 растет примерно в N раз
+SCALING_SCENARIOS = "admin_orders"
+SCALING_QUERY_DELAY_MS = 50
+SCALING_MAX_GROWTH = 0.25  # доля от N
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест BelekBox.kg")
+    parser.add_argument("--mode", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--products", type=int, default=200, help="Товаров в каталоге")
+    parser.add_argument("--orders", type=int, default=20000, help="Заказов в истории")
+    parser.add_argument("--requests", type=int, default=2000, help="Запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=32, help="Одновременных запросов")
+    parser.add_argument("--warmup", type=int, default=100, help="Прогревочных запросов")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--port", type=int, default=8765, help="Порт uvicorn")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--scaling",
+        action="store_true",
+        help="Сравнить p50/p95 при конкурентности 1 и --concurrency (только asgi)",
+    )
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", help="Файл с прошлым результатом для сравнения")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=None,
+        help="Завершиться с ошибкой, если p95 вырос больше чем на N процентов",
+    )
+    return parser.parse_args()
+
+
+# ===== ТЕСТОВЫЕ ДАННЫЕ =====
+
+
+def seed_database(app_module, products_count: int, orders_count: int, seed: int):
+    """
+    Заполняет базу синтетическим каталогом и историей заказов за последний год.
+    """
+    rng = random.Random(seed)
+    db = app_module.SessionLocal()
+    try:
+        products = [
+            app_module.Product(
+                name=f"Бокс №{i}",
+                description=f"Подарочный бокс №{i} " + "с наполнением " * 10,
+                price=rng.randrange(500, 15000, 50),
+                is_available=rng.random() > 0.1,
+                sort_order=i,
+            )
+            for i in range(1, products_count + 1)
+        ]
+        db.add_all(products)
+        db.commit()
+        # Скрытые товары заказать нельзя, в корзины попадают только доступные
+        catalog = [(p.id, p.name, p.price) for p in products if p.is_available]
+
+        now = datetime.now()
+        for start in range(0, orders_count, 1000):
+            for n in range(start, min(start + 1000, orders_count)):
+                created_at = now - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+                cart = [
+                    {"id": pid, "name": name, "price": price, "quantity": rng.randint(1, 3)}
+                    for pid, name, price in rng.sample(catalog, rng.randint(1, 4))
+                ]
+                db.add(
+                    app_module.Order(
+                        order_number=f"BB-SEED-{n:08d}",
+                        items_json=json.dumps(cart, ensure_ascii=False),
+                        client_phone=f"+996555{rng.randrange(10**6):06d}",
+                        total_amount=sum(i["price"] * i["quantity"] for i in cart),
+                        created_at=created_at,
+                        order_items=app_module.order_items_from_json(cart, created_at),
+                    )
+                )
+            db.commit()
+            db.expunge_all()
+    finally:
+        db.close()
+
+    with app_module.engine.begin() as conn:
+        app_module.rebuild_sales_rollups(conn)
+    return catalog
+
+
+def make_requests(catalog: list, admin_password: str, seed: int):
+    """
+    Фабрики запросов для каждого сценария: (метод, путь, параметры).
+    """
+    rng = random.Random(seed)
+    admin_headers = {"Authorization": f"Bearer {admin_password}"}
+
+    def order_request():
+        cart = [
+            {"id": pid, "name": name, "price": price, "quantity": rng.randint(1, 3)}
+            for pid, name, price in rng.sample(catalog, rng.randint(1, 4))
+        ]
+        return (
+            "POST",
+            "/api/orders",
+            {
+                "data": {
+                    "items": json.dumps(cart, ensure_ascii=False),
+                    "total_amount": str(sum(i["price"] * i["quantity"] for i in cart)),
+                    # Разные телефоны, как у настоящих покупателей
+                    "client_phone": f"+996555{rng.randrange(10**6):06d}",
+                }
+            },
+        )
+
+    def quote_request():
+        cart = [
+            {"id": pid, "quantity": rng.randint(1, 3)}
+            for pid, _, _ in rng.sample(catalog, rng.randint(1, 8))
+        ]
+        return ("POST", "/api/cart/quote", {"json": {"items": cart}})
+
+    return {
+        "products": lambda: ("GET", "/api/products", {}),
+        # Повторный визит: каталог уже сохранен в браузере на текущей ревизии
+        "products_delta": lambda: ("GET", "/api/products", {"params": {"since": 0}}),
+        "orders": order_request,
+        "cart_quote": quote_request,
+        "admin_orders": lambda: (
+            "GET",
+            "/api/admin/orders",
+            {"params": {"limit": 50}, "headers": admin_headers},
+        ),
+        "root": lambda: (
+            "GET",
+            "/",
+            {"headers": {"Accept-Encoding": "br, gzip"}},
+        ),
+    }
+
+
+# ===== ИЗМЕРЕНИЯ =====
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """
+    Перцентиль методом ближайшего ранга.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+async def run_scenario(client, make_request, total: int, concurrency: int) -> dict:
+    """
+    Отправляет total запросов не более чем по concurrency одновременно.
+    """
+    latencies = []
+    errors = 0
+    remaining = total
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, path, kwargs = make_request()
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                await response.aread()
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def run_scaling(client, requests: dict, args) -> dict:
+    """
+    Каждый сценарий при одном запросе в работе и при --concurrency.
+    """
+    results = {}
+    for name in SCALING_SCENARIOS.split(","):
+        if args.warmup:
+            await run_scenario(client, requests[name], args.warmup, args.concurrency)
+        single = await run_scenario(client, requests[name], args.requests, 1)
+        loaded = await run_scenario(
+            client, requests[name], args.requests, args.concurrency
+        )
+        growth = loaded["p50_ms"] / max(single["p50_ms"], 0.01)
+        results[name] = {
+            "single": single,
+            "concurrent": loaded,
+            "p50_growth": round(growth, 2),
+        }
+        print(
+            f"{name:14} 1: p50 {single['p50_ms']:>8} мс  p95 {single['p95_ms']:>8} мс   "
+            f"{args.concurrency}: p50 {loaded['p50_ms']:>8} мс  p95 {loaded['p95_ms']:>8} мс   "
+            f"рост p50 x{growth:.2f}"
+        )
+    return results
+
+
+def add_query_delay(engine, delay: float):
+    """
+    Добавляет задержку к каждому SQL-запросу. time.sleep отпускает GIL,
+    как и ожидание диска в sqlite3.
+    Возвращает обработчик события (для sqlalchemy.event.remove).
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def delay_query(conn, cursor, statement, parameters, context, executemany):
+        time.sleep(delay)
+
+    return delay_query
+
+
+async def run_all(client, requests: dict, args) -> dict:
+    results = {}
+    for name in args.scenarios.split(","):
+        if args.warmup:
+            await run_scenario(client, requests[name], args.warmup, args.concurrency)
+        results[name] = await run_scenario(
+            client, requests[name], args.requests, args.concurrency
+        )
+        print(
+            f"{name:14} {results[name]['rps']:>9} req/s  "
+            f"p50 {results[name]['p50_ms']:>8} мс  p95 {results[name]['p95_ms']:>8} мс  "
+            f"p99 {results[name]['p99_ms']:>8} мс  ошибок {results[name]['errors']}"
+        )
+    return results
+
+
+async def bench_asgi(app_module, requests: dict, args) -> dict:
+    """
+    Приложение в том же процессе: без сети и HTTP-сервера.
+    ASGITransport не отправляет lifespan-события, поэтому запуск и остановка
+    приложения (сборка статики, фоновые задачи) выполняются здесь.
+    """
+    app = app_module.app
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            if args.scaling:
+                return await run_scaling(client, requests, args)
+            return await run_all(client, requests, args)
+
+
+async def bench_uvicorn(requests: dict, args, env: dict) -> dict:
+    """
+    Приложение в отдельном процессе uvicorn на локальном порту.
+    """
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "app:app",
+            "--port",
+            str(args.port),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            for _ in range(100):
+                try:
+                    await client.get("/api/health")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn не запустился")
+            return await run_all(client, requests, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# ===== СРАВНЕНИЕ С ЭТАЛОНОМ =====
+
+
+def compare(results: dict, baseline: dict) -> float:
+    """
+    Печатает изменение показателей относительно эталона.
+    Возвращает наибольший рост p95 в процентах.
+    """
+    worst = 0.0
+    print("\nСравнение с эталоном:")
+    for name, current in results.items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        rps_change = (current["rps"] - before["rps"]) / before["rps"] * 100
+        p95_change = (current["p95_ms"] - before["p95_ms"]) / max(before["p95_ms"], 0.01) * 100
+        worst = max(worst, p95_change)
+        print(f"{name:14} req/s {rps_change:+7.1f}%   p95 {p95_change:+7.1f}%")
+    return worst
+
+
+def report_scaling(results: dict, args) -> None:
+    """
+    Сохраняет результат проверки масштабирования и завершается с ошибкой,
+    если задержка растет почти линейно с числом запросов в работе.
+    """
+    limit = max(1.0, args.concurrency * SCALING_MAX_GROWTH)
+    report = {
+        "meta": {
+            "mode": "scaling",
+            "concurrency": args.concurrency,
+            "query_delay_ms": SCALING_QUERY_DELAY_MS,
+            "max_growth": limit,
+            "revision": git_revision(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультат сохранен в {args.output}")
+
+    failed = [name for name, r in results.items() if r["p50_growth"] > limit]
+    if failed:
+        print(f"p50 вырос больше чем в {limit:.1f} раза: {', '.join(failed)}")
+        sys.exit(1)
+    print(f"p50 растет не больше чем в {limit:.1f} раза при {args.concurrency} запросах")
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    args = parse_args()
+
+    # Отдельная база, чтобы не трогать рабочую
+    workdir = tempfile.mkdtemp(prefix="belekbox-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # Все запросы идут с одного IP: с лимитом по умолчанию (5 заказов подряд,
+    # дальше 6 в минуту) сценарий orders мерил бы только ответы 429.
+    # Лимит можно вернуть, задав эти переменные явно
+    os.environ.setdefault("ORDER_RATE_PER_MINUTE", "1000000000")
+    os.environ.setdefault("ORDER_RATE_BURST", "1000000000")
+
+    import app as app_module
+
+    app_module.prepare_storage()
+    started = time.perf_counter()
+    catalog = seed_database(app_module, args.products, args.orders, args.seed)
+    print(
+        f"База: {args.products} товаров, {args.orders} заказов "
+        f"({time.perf_counter() - started:.1f} с)"
+    )
+
+    requests = make_requests(catalog, app_module.ADMIN_PASSWORD, args.seed)
+    if args.scaling:
+        if args.mode != "asgi":
+            sys.exit("--scaling работает только с --mode asgi")
+        add_query_delay(app_module.engine, SCALING_QUERY_DELAY_MS / 1000)
+        results = asyncio.run(bench_asgi(app_module, requests, args))
+        report_scaling(results, args)
+        return
+    if args.mode == "asgi":
+        results = asyncio.run(bench_asgi(app_module, requests, args))
+    else:
+        app_module.engine.dispose()
+        results = asyncio.run(bench_uvicorn(requests, args, dict(os.environ)))
+
+    report = {
+        "meta": {
+            "mode": args.mode,
+            "products": args.products,
+            "orders": args.orders,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультат сохранен в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            worst = compare(results, json.load(f))
+        if args.max_regression is not None and worst > args.max_regression:
+            print(f"p95 вырос на {worst:.1f}% (допустимо {args.max_regression}%)")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+BelekBox.kg - Обработка изображений товаров
+Вынесено в отдельный модуль, чтобы процессы пула не импортировали app.py
+"""
+
+import os
+from typing import Dict, List
+
+from PIL import Image, ImageOps
+
+# Качество сжатия вариантов
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+
+
+def _flatten(img: Image.Image) -> Image.Image:
+    """
+    Приводит изображение к RGB.
+    Прозрачный фон заменяется белым (JPEG не поддерживает альфа-канал).
+    """
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def _save_atomic(img: Image.Image, path: str, fmt: str, **params) -> None:
+    """
+    Сохраняет изображение через временный файл.
+    Один и тот же файл может одновременно писать несколько процессов.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    img.save(tmp_path, fmt, **params)
+    os.replace(tmp_path, path)
+
+
+def process_product_image(
+    source_path: str, output_dir: str, stem: str, widths: List[int]
+) -> Dict[str, List[dict]]:
+    """
+    Создает варианты изображения товара разной ширины в WebP и JPEG.
+    Ориентация из EXIF применяется к пикселям, сами метаданные не сохраняются.
+    Возвращает словарь {"webp": [...], "jpeg": [...]} с именами файлов и шириной.
+    """
+    max_width = max(widths)
+
+    with Image.open(source_path) as img:
+        # Для больших JPEG декодируем сразу в уменьшенном масштабе
+        img.draft("RGB", (max_width, max_width))
+        img = ImageOps.exif_transpose(img)
+        img = _flatten(img)
+
+    # Не увеличиваем изображение больше оригинала
+    targets = sorted({min(width, img.width) for width in widths})
+
+    variants = {"webp": [], "jpeg": []}
+    for width in targets:
+        if width == img.width:
+            resized = img
+        else:
+            height = max(1, round(img.height * width / img.width))
+            resized = img.resize((width, height), Image.LANCZOS)
+
+        webp_name = f"{stem}-{width}.webp"
+        _save_atomic(
+            resized,
+            os.path.join(output_dir, webp_name),
+            "WEBP",
+            quality=WEBP_QUALITY,
+            method=4,
+        )
+        variants["webp"].append({"width": width, "file": webp_name})
+
+        jpeg_name = f"{stem}-{width}.jpg"
+        _save_atomic(
+            resized,
+            os.path.join(output_dir, jpeg_name),
+            "JPEG",
+            quality=JPEG_QUALITY,
+            optimize=True,
+            progressive=True,
+        )
+        variants["jpeg"].append({"width": width, "file": jpeg_name})
+
+    return variants
@@ -0,0 +1,52 @@
+"""
+BelekBox.kg - Защита от повторов и флуда
+Ограничитель частоты запросов по алгоритму token bucket. Состояние корзин
+хранит вызывающий (в app.py - таблица rate_buckets общей базы), поэтому
+лимиты действуют на все процессы сразу, а не на каждый по отдельности.
+"""
+
+import threading
+from typing import Optional, Tuple
+
+
+class IdempotencyConflict(Exception):
+    """Ключ уже использован для запроса с другими данными"""
+
+
+class TokenBucketLimiter:
+    """
+    Ограничитель частоты: у каждого клиента есть корзина на burst жетонов,
+    которая пополняется со скоростью rate жетонов в секунду.
+    Корзина - пара (жетонов, время обновления); время - time.time(),
+    чтобы его одинаково понимали все процессы.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def take(
+        self, bucket: Optional[Tuple[float, float]], now: float
+    ) -> Tuple[Tuple[float, float], float]:
+        """
+        Забирает жетон из корзины (None - новый клиент).
+        Возвращает (новое состояние корзины, retry_after): retry_after = 0,
+        если запрос разрешен, иначе сколько секунд подождать.
+        """
+        tokens, updated = bucket if bucket is not None else (self.burst, now)
+        tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+        if tokens >= 1:
+            return (tokens - 1, now), 0.0
+
+        with self._lock:
+            self.rejected += 1
+        return (tokens, now), (1 - tokens) / self.rate
+
+    def full_since(self, now: float) -> float:
+        """
+        Корзины, не обновлявшиеся с этого момента, уже полны, и их можно
+        забыть: новая корзина ведет себя так же.
+        """
+        return now - self.burst / self.rate
@@ -0,0 +1,282 @@
+"""
+BelekBox.kg - Метрики в формате Prometheus
+Счетчики и гистограммы задержек запросов и SQL-запросов без внешних зависимостей
+"""
+
+import re
+import time
+import random
+import bisect
+import threading
+import contextvars
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Границы корзин гистограмм (секунды)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Максимальная длина формы SQL-запроса в метке
+SQL_SHAPE_MAX = 200
+
+
+class Histogram:
+    """
+    Гистограмма в стиле Prometheus: счетчики по корзинам, сумма и количество.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> Iterable[Tuple[str, int]]:
+        """
+        Накопленные значения по корзинам (как требует формат Prometheus).
+        """
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield repr(bound), total
+        yield "+Inf", self.count
+
+
+class RequestStats:
+    """
+    Статистика текущего запроса: сколько SQL-запросов и сколько времени они заняли.
+    """
+
+    __slots__ = ("sql_count", "sql_seconds")
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+
+
+# Статистика запроса, который сейчас обрабатывается (в том числе в пуле потоков)
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "current_request", default=None
+)
+
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = r"\s*(?:\?|:\w+|%\(\w+\)s)\s*"
+_PLACEHOLDER_LISTS = re.compile(rf"\((?:{_PLACEHOLDER},)+{_PLACEHOLDER}\)")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def sql_shape(statement: str) -> str:
+    """
+    Приводит SQL к форме без значений: литералы заменяются на ?,
+    списки параметров IN (?, ?, ?) сворачиваются в (?).
+    """
+    shape = _SPACES.sub(" ", statement).strip()
+    shape = _LITERALS.sub("?", shape)
+    shape = _PLACEHOLDER_LISTS.sub("(?)", shape)
+    if len(shape) > SQL_SHAPE_MAX:
+        shape = shape[: SQL_SHAPE_MAX - 3] + "..."
+    return shape
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class MetricsRegistry:
+    """
+    Хранилище метрик приложения.
+    Запись метрики - словарь и bisect под общей блокировкой, поэтому
+    накладные расходы малы и метрики можно держать включенными всегда.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, Tuple[str, Tuple[str, ...], dict]] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, float]]]] = []
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...]) -> None:
+        """
+        Регистрирует гистограмму с метками.
+        """
+        self._histograms[name] = (help_text, label_names, {})
+
+    def observe(self, name: str, label_values: Tuple[str, ...], value: float) -> None:
+        """
+        Добавляет наблюдение в гистограмму.
+        """
+        series = self._histograms[name][2]
+        with self._lock:
+            histogram = series.get(label_values)
+            if histogram is None:
+                histogram = series[label_values] = Histogram()
+            histogram.observe(value)
+
+    def add_collector(
+        self, collector: Callable[[], Iterable[Tuple[str, str, str, float]]]
+    ) -> None:
+        """
+        Добавляет функцию, которая при выгрузке возвращает значения
+        (имя, тип, описание, значение) - например, размер очереди.
+        """
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        Выгружает метрики в текстовом формате Prometheus.
+        """
+        lines = []
+        with self._lock:
+            for name, (help_text, label_names, series) in self._histograms.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for label_values, histogram in series.items():
+                    for bound, total in histogram.cumulative():
+                        labels = _labels(label_names, label_values, f'le="{bound}"')
+                        lines.append(f"{name}_bucket{labels} {total}")
+                    labels = _labels(label_names, label_values)
+                    lines.append(f"{name}_sum{labels} {histogram.sum:.6f}")
+                    lines.append(f"{name}_count{labels} {histogram.count}")
+
+        for collector in self._collectors:
+            for name, metric_type, help_text, value in collector():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def route_template(scope: dict, root_path: str) -> str:
+    """
+    Шаблон маршрута для метки (/api/admin/products/{product_id}), а не
+    фактический путь, чтобы число серий не росло с каждым id.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    # Подключенные приложения (/static, /uploads): роутер дописывает
+    # их префикс в root_path
+    mount_path = scope.get("root_path", "")[len(root_path):]
+    if mount_path:
+        return mount_path + "/*"
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: считает запросы и их длительность по маршруту,
+    методу и статусу. Медленные запросы выборочно пишутся в лог
+    вместе с числом и временем SQL-запросов.
+    """
+
+    def __init__(
+        self,
+        app,
+        registry: MetricsRegistry,
+        slow_request_seconds: float,
+        slow_log_sample: float,
+        logger: Callable[[str], None] = print,
+    ):
+        self.app = app
+        self.registry = registry
+        self.registry.histogram(
+            "http_request_duration_seconds",
+            "Длительность HTTP-запросов",
+            ("method", "route", "status"),
+        )
+        self.slow_request_seconds = slow_request_seconds
+        self.slow_log_sample = slow_log_sample
+        self.logger = logger
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        streaming = False  # Ответ - поток событий (SSE), долгий по природе
+        # Роутер меняет path и root_path при входе в подключенное приложение
+        path = scope["path"]
+        root_path = scope.get("root_path", "")
+
+        async def send_wrapper(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                streaming = dict(message.get("headers", [])).get(
+                    b"content-type", b""
+                ).startswith(b"text/event-stream")
+            await send(message)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+
+            self.registry.observe(
+                "http_request_duration_seconds",
+                (scope["method"], route_template(scope, root_path), str(status)),
+                elapsed,
+            )
+
+            if (
+                not streaming
+                and elapsed >= self.slow_request_seconds
+                and random.random() < self.slow_log_sample
+            ):
+                self.logger(
+                    f"Медленный запрос: {scope['method']} {path} -> {status} "
+                    f"за {elapsed * 1000:.0f} мс, SQL: {stats.sql_count} запросов "
+                    f"за {stats.sql_seconds * 1000:.0f} мс"
+                )
+
+
+def instrument_engine(engine, registry: MetricsRegistry) -> None:
+    """
+    Подключает замер времени SQL-запросов к движку SQLAlchemy.
+    """
+    from sqlalchemy import event
+
+    registry.histogram(
+        "db_query_duration_seconds", "Длительность SQL-запросов", ("statement",)
+    )
+
+    # Время начала хранится в контексте выполнения, а не в стеке соединения:
+    # после ошибки запроса after_cursor_execute не вызывается, и запись
+    # в стеке осталась бы навсегда и сбила бы пары у следующих запросов
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_start", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        registry.observe("db_query_duration_seconds", (sql_shape(statement),), elapsed)
+
+        stats = current_request.get()
+        if stats is not None:
+            stats.sql_count += 1
+            stats.sql_seconds += elapsed
@@ -0,0 +1,135 @@
+"""
+BelekBox.kg - Отправка уведомлений о заказах операторам
+Отправитель получает пачку уведомлений и либо доставляет ее целиком,
+либо бросает DeliveryError. Очередь, повторы и задержки - в outbox
+(app.py), поэтому отправители ничего не хранят.
+"""
+
+import hmac
+import json
+import abc
+import hashlib
+import urllib.error
+import urllib.request
+from typing import List, Optional
+
+
+class DeliveryError(Exception):
+    """Уведомление не доставлено (будет повтор)"""
+
+
+def post_json(
+    url: str, body: bytes, timeout: float, headers: Optional[dict] = None
+) -> bytes:
+    """
+    Отправляет JSON методом POST и возвращает тело ответа.
+    Ответ не 2xx и сетевые ошибки превращаются в DeliveryError.
+    """
+    request = urllib.request.Request(
+        url,
+        data=body,
+        method="POST",
+        headers={"Content-Type": "application/json", **(headers or {})},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read()
+    except urllib.error.HTTPError as e:
+        raise DeliveryError(f"HTTP {e.code} от {url}") from e
+    except OSError as e:  # URLError, таймауты, отказ в соединении
+        raise DeliveryError(f"{url}: {e}") from e
+
+
+def format_order_message(payload: dict) -> str:
+    """
+    Текст уведомления о заказе для мессенджера.
+    """
+    lines = [f"Новый заказ #{payload['order_number']}", ""]
+    for i, item in enumerate(payload["items"], 1):
+        lines.append(
+            f"{i}. {item['name']} - {item['quantity']} шт. × {item['price']} сом"
+        )
+    lines.append("")
+    lines.append(f"Итого: {payload['total_amount']} сом")
+    lines.append(f"Телефон: {payload.get('client_phone') or 'Не указан'}")
+    if payload.get("client_comment"):
+        lines.append(f"Комментарий: {payload['client_comment']}")
+    return "\n".join(lines)
+
+
+class NotificationSender(abc.ABC):
+    """
+    Базовый отправитель.
+    name - канал в outbox, batch_size - сколько уведомлений
+    передается в один вызов send.
+    """
+
+    name = "base"
+    batch_size = 1
+
+    @abc.abstractmethod
+    def send(self, payloads: List[dict]) -> None:
+        """
+        Доставляет пачку целиком или бросает DeliveryError.
+        """
+
+
+class WebhookSender(NotificationSender):
+    """
+    Отправляет пачку уведомлений JSON-массивом на адрес магазина.
+    С секретом добавляется заголовок X-Signature: sha256=<HMAC тела>.
+    Получатель отличает повторы по notification_id.
+    """
+
+    name = "webhook"
+
+    def __init__(
+        self,
+        url: str,
+        secret: Optional[str] = None,
+        timeout: float = 10.0,
+        batch_size: int = 50,
+    ):
+        self.url = url
+        self.secret = secret
+        self.timeout = timeout
+        self.batch_size = batch_size
+
+    def send(self, payloads: List[dict]) -> None:
+        body = json.dumps(payloads, ensure_ascii=False).encode("utf-8")
+        headers = {}
+        if self.secret:
+            signature = hmac.new(self.secret.encode(), body, hashlib.sha256)
+            headers["X-Signature"] = f"sha256={signature.hexdigest()}"
+        post_json(self.url, body, self.timeout, headers)
+
+
+class TelegramSender(NotificationSender):
+    """
+    Отправляет каждое уведомление сообщением через Bot API (sendMessage).
+    api_url можно направить на локальный сервер для проверки.
+    """
+
+    name = "telegram"
+
+    def __init__(
+        self,
+        token: str,
+        chat_id: str,
+        api_url: str = "https://api.telegram.org",
+        timeout: float = 10.0,
+    ):
+        self.token = token
+        self.chat_id = chat_id
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+
+    def send(self, payloads: List[dict]) -> None:
+        for payload in payloads:
+            body = json.dumps(
+                {"chat_id": self.chat_id, "text": format_order_message(payload)},
+                ensure_ascii=False,
+            ).encode("utf-8")
+            post_json(
+                f"{self.api_url}/bot{self.token}/sendMessage", body, self.timeout
+            )
@@ -2,6 +2,10 @@
 
 // ===== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ =====
 let adminToken = null;
+let ordersCursor = null; // Курсор следующей страницы заказов
+let productOrder = []; // id товаров в порядке показа
+let orderStream = null; // AbortController живой ленты заказов
+let lastOrderId = null; // id последнего показанного заказа (для Last-Event-ID)
 
 // ===== АУТЕНТИФИКАЦИЯ =====
 
@@ -47,6 +51,7 @@ async function login() {
  * Выход из админки
  */
 function logout() {
+    stopOrderStream();
     adminToken = null;
     localStorage.removeItem('admin_token');
     document.getElementById('loginScreen').style.display = 'block';
@@ -125,6 +130,7 @@ function renderProducts(products) {
     if (!tbody) return;
     
     tbody.innerHTML = '';
+    productOrder = products.map(product => product.id);
     
     products.forEach(product => {
         const row = document.createElement('tr');
@@ -146,6 +152,8 @@ function renderProducts(products) {
             <td>${product.sort_order}</td>
             <td>
                 <div class="actions">
+                    <button class="action-btn" onclick="moveProduct(${product.id}, -1)" title="Выше">↑</button>
+                    <button class="action-btn" onclick="moveProduct(${product.id}, 1)" title="Ниже">↓</button>
                     <button class="action-btn edit-btn" onclick="editProduct(${product.id})">Ред.</button>
                     <button class="action-btn delete-btn" onclick="deleteProduct(${product.id})">Уд.</button>
                 </div>
@@ -155,14 +163,51 @@ function renderProducts(products) {
     });
 }
 
+/**
+ * Сдвигает товар на одну позицию и сохраняет новый порядок всех товаров
+ * @param {number} productId - ID товара
+ * @param {number} step - -1 (выше) или 1 (ниже)
+ */
+async function moveProduct(productId, step) {
+    const index = productOrder.indexOf(productId);
+    const target = index + step;
+    if (index < 0 || target < 0 || target >= productOrder.length) return;
+    
+    const order = [...productOrder];
+    [order[index], order[target]] = [order[target], order[index]];
+    
+    try {
+        const response = await fetch('/api/admin/products/reorder', {
+            method: 'POST',
+            headers: getAuthHeaders(),
+            body: JSON.stringify({ product_ids: order })
+        });
+        const result = await response.json();
+        
+        if (result.success) {
+            loadProducts();
+        } else {
+            alert('Ошибка: ' + result.error);
+        }
+    } catch (error) {
+        console.error('Ошибка сортировки:', error);
+        alert('Ошибка при изменении порядка');
+    }
+}
+
 // ===== ЗАКАЗЫ =====
 
 /**
- * Загружает заказы для админки
+ * Загружает заказы для админки (первую страницу или следующую)
+ * @param {boolean} append - Добавить к уже загруженным заказам
  */
-async function loadOrders() {
+async function loadOrders(append = false) {
     try {
-        const response = await fetch('/api/admin/orders', {
+        const url = append && ordersCursor
+            ? `/api/admin/orders?cursor=${encodeURIComponent(ordersCursor)}`
+            : '/api/admin/orders';
+        
+        const response = await fetch(url, {
             headers: getAuthHeaders()
         });
         
@@ -172,48 +217,176 @@ async function loadOrders() {
         }
         
         const orders = await response.json();
-        renderOrders(orders);
+        ordersCursor = response.headers.get('X-Next-Cursor');
+        renderOrders(orders, append);
+        
+        // Дальше новые заказы приходят через живую ленту
+        if (!append) {
+            if (orders.length) {
+                lastOrderId = Math.max(lastOrderId || 0, orders[0].id);
+            }
+            startOrderStream();
+        }
+        
+        const loadMoreBtn = document.getElementById('loadMoreOrders');
+        if (loadMoreBtn) {
+            loadMoreBtn.style.display = ordersCursor ? 'block' : 'none';
+        }
     } catch (error) {
         console.error('Ошибка загрузки заказов:', error);
     }
 }
 
+/**
+ * Загружает следующую страницу заказов
+ */
+function loadMoreOrders() {
+    loadOrders(true);
+}
+
 /**
  * Отображает заказы в таблице админки
  * @param {Array} orders - Массив заказов
+ * @param {boolean} append - Добавить строки к существующим
  */
-function renderOrders(orders) {
+function renderOrders(orders, append = false) {
     const tbody = document.querySelector('#ordersTable tbody');
     if (!tbody) return;
     
-    tbody.innerHTML = '';
+    if (!append) {
+        tbody.innerHTML = '';
+    }
     
     orders.forEach(order => {
-        const date = new Date(order.created_at);
-        const formattedDate = date.toLocaleDateString('ru-RU') + ' ' + date.toLocaleTimeString('ru-RU');
+        tbody.appendChild(createOrderRow(order));
+    });
+}
+
+/**
+ * Создает строку таблицы заказов
+ * @param {Object} order - Заказ
+ * @returns {HTMLTableRowElement} Строка таблицы
+ */
+function createOrderRow(order) {
+    const date = new Date(order.created_at);
+    const formattedDate = date.toLocaleDateString('ru-RU') + ' ' + date.toLocaleTimeString('ru-RU');
+    
+    const row = document.createElement('tr');
+    row.innerHTML = `
+        <td>${order.order_number}</td>
+        <td>${formattedDate}</td>
+        <td>
+            <button class="btn" onclick="showOrderDetails(${order.id})">Показать</button>
+            <div id="orderDetails${order.id}" style="display: none;" class="order-details">
+                ${order.items.map((item, index) => `
+                    <div class="order-item">
+                        <div>${index + 1}. ${item.name}</div>
+                        <div>${item.quantity} × ${item.price} = ${item.quantity * item.price} сом</div>
+                    </div>
+                `).join('')}
+                <div class="order-total">Итого: ${order.total_amount} сом</div>
+            </div>
+        </td>
+        <td>${order.total_amount} сом</td>
+        <td>${order.client_phone || '-'}</td>
+        <td>${order.client_comment || '-'}</td>
+    `;
+    return row;
+}
+
+// ===== ЖИВАЯ ЛЕНТА ЗАКАЗОВ =====
+
+/**
+ * Подключается к ленте новых заказов (Server-Sent Events).
+ * Поток читается через fetch, чтобы передать заголовок авторизации;
+ * после обрыва переподключается с Last-Event-ID и получает пропущенное.
+ */
+async function startOrderStream() {
+    if (orderStream) return;
+    const controller = new AbortController();
+    orderStream = controller;
+    
+    while (!controller.signal.aborted) {
+        try {
+            const headers = { 'Authorization': `Bearer ${adminToken}` };
+            if (lastOrderId !== null) {
+                headers['Last-Event-ID'] = String(lastOrderId);
+            }
+            
+            const response = await fetch('/api/admin/orders/stream', {
+                headers,
+                signal: controller.signal
+            });
+            if (response.status === 401) {
+                logout();
+                return;
+            }
+            
+            const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += value;
+                
+                // События разделены пустой строкой
+                let boundary;
+                while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+                    handleOrderEvent(buffer.slice(0, boundary));
+                    buffer = buffer.slice(boundary + 2);
+                }
+            }
+        } catch (error) {
+            if (controller.signal.aborted) return;
+            console.warn('Лента заказов прервалась:', error);
+        }
         
-        const row = document.createElement('tr');
-        row.innerHTML = `
-            <td>${order.order_number}</td>
-            <td>${formattedDate}</td>
-            <td>
-                <button class="btn" onclick="showOrderDetails(${order.id})">Показать</button>
-                <div id="orderDetails${order.id}" style="display: none;" class="order-details">
-                    ${order.items.map((item, index) => `
-                        <div class="order-item">
-                            <div>${index + 1}. ${item.name}</div>
-                            <div>${item.quantity} × ${item.price} = ${item.quantity * item.price} сом</div>
-                        </div>
-                    `).join('')}
-                    <div class="order-total">Итого: ${order.total_amount} сом</div>
-                </div>
-            </td>
-            <td>${order.total_amount} сом</td>
-            <td>${order.client_phone || '-'}</td>
-            <td>${order.client_comment || '-'}</td>
-        `;
-        tbody.appendChild(row);
+        await new Promise(resolve => setTimeout(resolve, 3000));
+    }
+}
+
+/**
+ * Отключает ленту заказов
+ */
+function stopOrderStream() {
+    if (orderStream) {
+        orderStream.abort();
+        orderStream = null;
+    }
+}
+
+/**
+ * Обрабатывает одно событие ленты
+ * @param {string} block - Текст события SSE
+ */
+function handleOrderEvent(block) {
+    let id = null;
+    let type = 'message';
+    let data = '';
+    
+    block.split('\n').forEach(line => {
+        if (line.startsWith('id: ')) id = line.slice(4);
+        else if (line.startsWith('event: ')) type = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
     });
+    
+    if (type === 'reset') {
+        // Пропущено слишком много заказов: загружаем список заново
+        loadOrders();
+        return;
+    }
+    if (type !== 'order' || !data) return;
+    
+    const order = JSON.parse(data);
+    lastOrderId = Math.max(lastOrderId || 0, Number(id));
+    
+    // Заказ уже в таблице (например, пришел вместе со страницей)
+    if (document.getElementById(`orderDetails${order.id}`)) return;
+    
+    const tbody = document.querySelector('#ordersTable tbody');
+    if (tbody) {
+        tbody.prepend(createOrderRow(order));
+    }
 }
 
 /**
@@ -273,6 +446,47 @@ async function showAllProducts() {
     }
 }
 
+/**
+ * Загружает товары из манифеста (CSV/JSON) и архива изображений одним запросом
+ */
+async function importProducts() {
+    const manifestInput = document.getElementById('importManifest');
+    const imagesInput = document.getElementById('importImages');
+    if (!manifestInput.files[0]) {
+        alert('Выберите файл манифеста');
+        return;
+    }
+    
+    const formData = new FormData();
+    formData.append('manifest', manifestInput.files[0]);
+    if (imagesInput.files[0]) {
+        formData.append('images', imagesInput.files[0]);
+    }
+    
+    try {
+        const response = await fetch('/api/admin/import/products', {
+            method: 'POST',
+            headers: {
+                'Authorization': `Bearer ${adminToken}`
+            },
+            body: formData
+        });
+        const result = await response.json();
+        
+        if (result.success) {
+            alert(`Добавлено: ${result.created}, обновлено: ${result.updated}`);
+            manifestInput.value = '';
+            imagesInput.value = '';
+            loadProducts();
+        } else {
+            alert('Ошибка: ' + (result.error || result.detail));
+        }
+    } catch (error) {
+        console.error('Ошибка импорта:', error);
+        alert('Ошибка при импорте товаров');
+    }
+}
+
 // ===== МОДАЛЬНОЕ ОКНО ТОВАРА =====
 
 /**
@@ -488,6 +702,9 @@ window.closeProductModal = closeProductModal;
 window.saveProduct = saveProduct;
 window.deleteProduct = deleteProduct;
 window.showOrderDetails = showOrderDetails;
+window.loadMoreOrders = loadMoreOrders;
+window.moveProduct = moveProduct;
+window.importProducts = importProducts;
 window.hideAllProducts = hideAllProducts;
 window.showAllProducts = showAllProducts;
 
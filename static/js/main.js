@@ -10,6 +10,10 @@ const CONFIG = {
     CART_EXPIRY_DAYS: 7,
     PRODUCTS_CACHE_MINUTES: 5,
     PRODUCTS_CACHE_MAX_HOURS: 24,
+    // Сколько дней сервер не встраивает каталог в страницу, если он сохранен
+    CATALOG_COOKIE_DAYS: 30,
+    // Ширина карточки товара для выбора варианта изображения из srcset
+    PRODUCT_IMAGE_SIZES: '(max-width: 768px) 100vw, 400px',
     PHONE_PATTERNS: [
         /^\+996\d{9}$/,
         /^996\d{9}$/,
@@ -24,7 +28,9 @@ let state = {
     cart: JSON.parse(localStorage.getItem('cart')) || [],
     cachedProducts: null,
     productsLastFetched: null,
+    catalogRevision: null,
     isCheckingOut: false,
+    checkoutAttempt: null,
     cartLastUpdated: localStorage.getItem('cart_last_updated'),
     currentSort: 'default',
     cartAnimationEnabled: true
@@ -457,12 +463,150 @@ function renderCartItems() {
 
 // ===== ТОВАРЫ =====
 
+/**
+ * Cookie для сервера: каталог сохранен в браузере, встраивать его
+ * в страницу не нужно
+ */
+function setCatalogCookie(enabled) {
+    const maxAge = enabled ? CONFIG.CATALOG_COOKIE_DAYS * 24 * 60 * 60 : 0;
+    document.cookie = `catalog_cached=${enabled ? 1 : ''}; path=/; max-age=${maxAge}; SameSite=Lax`;
+}
+
+/**
+ * Сохраняет каталог в состоянии и в localStorage.
+ * Каталог с ревизией потом обновляется только изменениями.
+ */
+function cacheProducts(products, fetchedAt, revision = null) {
+    state.cachedProducts = products;
+    state.productsLastFetched = fetchedAt.toISOString();
+    state.catalogRevision = revision;
+    
+    try {
+        localStorage.setItem('products_cache', JSON.stringify(products));
+        localStorage.setItem('products_cache_time', state.productsLastFetched);
+        if (revision !== null) {
+            localStorage.setItem('products_cache_revision', String(revision));
+        } else {
+            localStorage.removeItem('products_cache_revision');
+        }
+        setCatalogCookie(revision !== null);
+    } catch (storageError) {
+        console.warn('Не удалось сохранить в localStorage:', storageError);
+        setCatalogCookie(false);
+    }
+}
+
+/**
+ * Восстанавливает каталог, сохраненный при прошлых визитах.
+ * Нужна ревизия: без нее изменения догрузить нельзя.
+ */
+function restoreCachedCatalog() {
+    try {
+        const cached = localStorage.getItem('products_cache');
+        const revision = localStorage.getItem('products_cache_revision');
+        if (!cached || revision === null) return false;
+        
+        state.cachedProducts = JSON.parse(cached);
+        state.productsLastFetched = localStorage.getItem('products_cache_time');
+        state.catalogRevision = Number(revision);
+        return true;
+    } catch (error) {
+        console.warn('Не удалось прочитать сохраненный каталог:', error);
+        return false;
+    }
+}
+
+/**
+ * Забирает каталог, встроенный сервером в страницу (один раз).
+ * Следующие обновления идут через /api/products.
+ */
+function takeEmbeddedCatalog() {
+    const element = document.getElementById('catalogData');
+    if (!element) return null;
+    element.remove();
+    
+    try {
+        const revision = element.dataset.revision;
+        return {
+            products: JSON.parse(element.textContent),
+            revision: revision === undefined ? null : Number(revision)
+        };
+    } catch (error) {
+        console.warn('Не удалось разобрать встроенный каталог:', error);
+        return null;
+    }
+}
+
+/**
+ * Применяет изменения каталога: убирает удаленные и скрытые товары,
+ * заменяет измененные и восстанавливает порядок витрины
+ */
+function applyCatalogDelta(products, delta) {
+    if (delta.reset) return delta.products;
+    
+    const changed = new Set(delta.removed);
+    delta.products.forEach(product => changed.add(product.id));
+    
+    return products
+        .filter(product => !changed.has(product.id))
+        .concat(delta.products)
+        .sort((a, b) => (a.sort_order || 0) - (b.sort_order || 0) || a.id - b.id);
+}
+
+/**
+ * Загружает каталог с сервера. Если каталог уже сохранен,
+ * запрашиваются только изменения после его ревизии.
+ */
+async function fetchCatalog() {
+    const hasRevision = state.cachedProducts && state.catalogRevision !== null;
+    const url = hasRevision
+        ? `/api/products?since=${state.catalogRevision}`
+        : '/api/products';
+    
+    const response = await fetch(url, {
+        headers: { 'Cache-Control': 'no-cache' }
+    });
+    
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}`);
+    }
+    
+    if (hasRevision) {
+        const delta = await response.json();
+        return {
+            products: applyCatalogDelta(state.cachedProducts, delta),
+            revision: delta.revision,
+            changed: delta.reset || delta.products.length > 0 || delta.removed.length > 0
+        };
+    }
+    
+    const revision = response.headers.get('X-Catalog-Revision');
+    return {
+        products: await response.json(),
+        revision: revision === null ? null : Number(revision),
+        changed: true
+    };
+}
+
 async function loadProducts() {
     const grid = document.getElementById('productsGrid');
     if (!grid) return;
     
-    // Показываем skeleton loading
-    grid.innerHTML = `
+    // Каталог уже в странице: показываем сразу, без запроса к API
+    const embedded = takeEmbeddedCatalog();
+    if (embedded) {
+        cacheProducts(embedded.products, new Date(), embedded.revision);
+        renderProducts(embedded.products);
+        return;
+    }
+    
+    // Каталог из прошлых визитов: показываем сразу, изменения догрузим
+    if (!state.cachedProducts && restoreCachedCatalog()) {
+        renderProducts(state.cachedProducts);
+    }
+    
+    // Показываем skeleton loading, если показать пока нечего
+    if (!state.cachedProducts) grid.innerHTML = `
         <div class="skeleton-grid">
             <div class="product-card skeleton">
                 <div class="skeleton-image"></div>
@@ -505,30 +649,14 @@ async function loadProducts() {
             }
         }
         
-        // Загружаем с сервера
-        const response = await fetch('/api/products', {
-            headers: { 'Cache-Control': 'no-cache' }
-        });
-        
-        if (!response.ok) {
-            throw new Error(`HTTP ${response.status}`);
-        }
-        
-        const products = await response.json();
+        // Загружаем с сервера (весь каталог или только изменения)
+        const catalog = await fetchCatalog();
         
-        // Сохраняем в кэш
-        state.cachedProducts = products;
-        state.productsLastFetched = now.toISOString();
-        
-        try {
-            localStorage.setItem('products_cache', JSON.stringify(products));
-            localStorage.setItem('products_cache_time', state.productsLastFetched);
-        } catch (storageError) {
-            console.warn('Не удалось сохранить в localStorage:', storageError);
+        cacheProducts(catalog.products, now, catalog.revision);
+        if (catalog.changed) {
+            renderProducts(catalog.products);
         }
         
-        renderProducts(products);
-        
     } catch (error) {
         console.error('Ошибка загрузки товаров:', error);
         
@@ -609,6 +737,7 @@ function renderProducts(products) {
         grid.innerHTML = sortedProducts.map((product, index) => {
             const tags = generateProductTags(product, index);
             const hasImage = product.image_url && product.image_url !== 'null' && product.image_url !== 'undefined';
+            const srcset = hasImage ? product.image_srcset : null;
             
             return `
                 <div class="product-card" data-product-id="${product.id}">
@@ -621,12 +750,18 @@ function renderProducts(products) {
                             </div>
                         ` : ''}
                         
-                        <img src="${hasImage ? product.image_url : 'https://images.unsplash.com/photo-1556909114-f6e7ad7d3136?w=400&h=400&fit=crop&crop=center'}" 
-                             alt="${escapeHtml(product.name)}" 
-                             class="product-image"
-                             onclick="openImageModal('${hasImage ? product.image_url : ''}')"
-                             onerror="this.onerror=null; this.src='https://images.unsplash.com/photo-1556909114-f6e7ad7d3136?w=400&h=400&fit=crop&crop=center'"
-                             loading="lazy">
+                        <picture>
+                            ${srcset && srcset.webp ? `
+                                <source type="image/webp" srcset="${srcset.webp}" sizes="${CONFIG.PRODUCT_IMAGE_SIZES}">
+                            ` : ''}
+                            <img src="${hasImage ? product.image_url : 'https://images.unsplash.com/photo-1556909114-f6e7ad7d3136?w=400&h=400&fit=crop&crop=center'}" 
+                                 ${srcset && srcset.jpeg ? `srcset="${srcset.jpeg}" sizes="${CONFIG.PRODUCT_IMAGE_SIZES}"` : ''}
+                                 alt="${escapeHtml(product.name)}" 
+                                 class="product-image"
+                                 onclick="openImageModal('${hasImage ? product.image_url : ''}')"
+                                 onerror="this.onerror=null; this.srcset=''; this.src='https://images.unsplash.com/photo-1556909114-f6e7ad7d3136?w=400&h=400&fit=crop&crop=center'"
+                                 loading="lazy">
+                        </picture>
                         
                         <button class="quick-view-btn" 
                                 onclick="quickViewProduct(${product.id})"
@@ -721,11 +856,52 @@ function setupFAQ() {
 
 // ===== МОДАЛЬНЫЕ ОКНА =====
 
+/**
+ * Обновляет названия и цены в корзине по текущему каталогу
+ * и убирает товары, которые больше нельзя заказать
+ */
+async function refreshCartPrices() {
+    if (state.cart.length === 0) return;
+    
+    try {
+        const response = await fetch('/api/cart/quote', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                items: state.cart.map(item => ({ id: item.id, quantity: item.quantity }))
+            })
+        });
+        if (!response.ok) return;
+        
+        const quote = await response.json();
+        const current = new Map(quote.items.map(item => [item.id, item]));
+        let changed = quote.unavailable.length > 0;
+        
+        state.cart = state.cart.filter(item => current.has(item.id));
+        state.cart.forEach(item => {
+            const fresh = current.get(item.id);
+            if (item.price !== fresh.price || item.name !== fresh.name) {
+                item.price = fresh.price;
+                item.name = fresh.name;
+                changed = true;
+            }
+        });
+        
+        if (changed) {
+            saveCart();
+            showNotification('Цены или наличие товаров в корзине изменились', 'info');
+        }
+    } catch (error) {
+        console.warn('Не удалось обновить цены корзины:', error);
+    }
+}
+
 function openCartModal() {
     const cartModal = document.getElementById('cartModal');
     if (cartModal) {
         cartModal.style.display = 'flex';
         renderCartItems();
+        refreshCartPrices();
         
         setTimeout(() => {
             cartModal.style.opacity = '1';
@@ -788,6 +964,16 @@ function closeImageModal() {
 
 // ===== ОФОРМЛЕНИЕ ЗАКАЗА =====
 
+/**
+ * Генерирует ключ идемпотентности для оформления заказа
+ */
+function generateIdempotencyKey() {
+    if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+        return window.crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
 async function checkout() {
     if (state.isCheckingOut) return;
     
@@ -829,17 +1015,27 @@ async function checkout() {
             client_comment: clientComment
         };
         
+        const body = new URLSearchParams(orderData).toString();
+        
+        // Повторная отправка того же заказа (например, после обрыва связи)
+        // идет с тем же ключом, и сервер не создаст второй заказ
+        if (!state.checkoutAttempt || state.checkoutAttempt.body !== body) {
+            state.checkoutAttempt = { body, key: generateIdempotencyKey() };
+        }
+        
         const response = await fetch('/api/orders', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/x-www-form-urlencoded',
+                'Idempotency-Key': state.checkoutAttempt.key
             },
-            body: new URLSearchParams(orderData)
+            body
         });
         
         const result = await response.json();
         
         if (result.success) {
+            state.checkoutAttempt = null;
             showNotification('Заказ оформлен! Открываем WhatsApp...', 'success');
             
             setTimeout(() => {
@@ -854,6 +1050,9 @@ async function checkout() {
             
         } else {
             showNotification(`Ошибка: ${result.error || 'Неизвестная ошибка'}`, 'error');
+            if (result.unavailable) {
+                refreshCartPrices();
+            }
         }
         
     } catch (error) {
@@ -0,0 +1,145 @@
+"""
+BelekBox.kg - Хранилище загруженных файлов
+Файлы хранятся по хешу содержимого, поэтому одинаковые загрузки не дублируются
+"""
+
+import os
+import uuid
+import hashlib
+from typing import BinaryIO, Iterable, NamedTuple
+
+# Размер блока при чтении загрузки
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """Загруженный файл больше допустимого размера"""
+
+
+class StreamedUpload(NamedTuple):
+    """Загрузка, сохраненная во временный файл"""
+
+    path: str  # Временный файл
+    sha256: str  # Хеш содержимого
+    size: int  # Размер в байтах
+
+
+def stream_upload(fileobj: BinaryIO, tmp_dir: str, max_bytes: int) -> StreamedUpload:
+    """
+    Копирует загрузку во временный файл блоками, одновременно считая хеш.
+    Если файл больше max_bytes, копирование прерывается.
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part")
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = fileobj.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(
+                        f"Файл слишком большой (максимум {max_bytes // (1024 * 1024)} МБ)"
+                    )
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        discard(tmp_path)
+        raise
+
+    return StreamedUpload(path=tmp_path, sha256=digest.hexdigest(), size=size)
+
+
+def blob_dir(root: str, content_hash: str) -> str:
+    """
+    Каталог для файлов с данным хешем (первые два символа хеша).
+    """
+    directory = os.path.join(root, content_hash[:2])
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def blob_name(content_hash: str, filename: str) -> str:
+    """
+    Путь файла относительно корня хранилища.
+    """
+    return f"{content_hash[:2]}/{filename}"
+
+
+def files_exist(root: str, relative_paths: Iterable[str]) -> bool:
+    """
+    Проверяет, что все файлы на месте.
+    """
+    return all(os.path.exists(os.path.join(root, p)) for p in relative_paths)
+
+
+def discard(path: str) -> None:
+    """
+    Удаляет файл, если он существует.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_files(root: str, relative_paths: Iterable[str]) -> None:
+    """
+    Удаляет файлы из хранилища и пустые каталоги после них.
+    """
+    directories = set()
+    for relative_path in relative_paths:
+        path = os.path.join(root, relative_path)
+        discard(path)
+        directories.add(os.path.dirname(path))
+
+    for directory in directories:
+        if os.path.normpath(directory) == os.path.normpath(root):
+            continue
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass  # В каталоге есть другие файлы
+
+
+def remove_blobs(root: str, content_hash: str) -> None:
+    """
+    Удаляет все файлы с данным хешем, включая недописанные временные.
+    """
+    try:
+        names = os.listdir(os.path.join(root, content_hash[:2]))
+    except FileNotFoundError:
+        return
+    remove_files(
+        root,
+        [blob_name(content_hash, n) for n in names if n.startswith(content_hash + "-")],
+    )
+
+
+def blob_hashes(root: str, older_than: float) -> set:
+    """
+    Хеши, все файлы которых не менялись с момента older_than (timestamp).
+    """
+    newest = {}  # hash -> время последнего изменения
+    try:
+        directories = os.listdir(root)
+    except FileNotFoundError:
+        return set()
+    for directory in directories:
+        path = os.path.join(root, directory)
+        if len(directory) != 2 or not os.path.isdir(path):
+            continue
+        try:
+            for entry in os.scandir(path):
+                content_hash, dash, _ = entry.name.partition("-")
+                if not dash or len(content_hash) != 64:
+                    continue
+                mtime = entry.stat().st_mtime
+                newest[content_hash] = max(mtime, newest.get(content_hash, mtime))
+        except FileNotFoundError:
+            continue  # Каталог или файл удалили во время обхода
+    return {h for h, mtime in newest.items() if mtime < older_than}
@@ -0,0 +1,15 @@
+"""
+Общие настройки тестов: приложение импортируется из корня репозитория
+и работает с временной базой, а не с database.db.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(
+    tempfile.mkdtemp(prefix="belekbox-tests-"), "test.db"
+)
@@ -0,0 +1,54 @@
+"""
+Обработчики с запросами к БД не блокируют event loop: N одновременных
+запросов выполняются параллельно в пуле потоков, и общее время почти не
+растет с N. Задержка SQL-запросов - та же, что в benchmark.py --scaling.
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+from sqlalchemy import event
+
+import app
+from benchmark import add_query_delay
+
+CONCURRENCY = 10
+QUERY_DELAY = 0.05  # секунд на каждый SQL-запрос
+
+
+@pytest.fixture
+def slow_queries():
+    app.run_migrations()
+    listener = add_query_delay(app.engine, QUERY_DELAY)
+    yield
+    event.remove(app.engine, "before_cursor_execute", listener)
+
+
+async def timed_requests(count: int) -> float:
+    """
+    Отправляет count одновременных запросов к списку заказов.
+    Возвращает общее время в секундах.
+    """
+    transport = httpx.ASGITransport(app=app.app)
+    headers = {"Authorization": f"Bearer {app.ADMIN_PASSWORD}"}
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://test", headers=headers
+    ) as client:
+        started = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.get("/api/admin/orders") for _ in range(count))
+        )
+        elapsed = time.perf_counter() - started
+    assert all(response.status_code == 200 for response in responses)
+    return elapsed
+
+
+def test_latency_does_not_grow_with_concurrency(slow_queries):
+    asyncio.run(timed_requests(1))  # Прогрев: импорт, соединения пула
+    single = asyncio.run(timed_requests(1))
+    concurrent = asyncio.run(timed_requests(CONCURRENCY))
+
+    # При блокировке event loop запросы шли бы по очереди: ~N x single
+    assert concurrent < CONCURRENCY * single / 2
@@ -0,0 +1,220 @@
+"""
+Доставка уведомлений из outbox на локальный сервер вместо Telegram
+(тот же прием, что TELEGRAM_API_URL): успешная отправка, повтор
+с экспоненциальной задержкой и отказ после NOTIFY_MAX_ATTEMPTS попыток.
+"""
+
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from sqlalchemy import select, update
+
+import app
+from notify import TelegramSender
+
+BACKOFF_BASE = 60  # секунд
+MAX_ATTEMPTS = 3
+
+
+class FakeTelegram:
+    """Локальный Bot API: отвечает кодами из statuses и запоминает сообщения"""
+
+    def __init__(self):
+        self.statuses = []  # Коды следующих ответов (по умолчанию 200)
+        self.messages = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake.messages.append((self.path, json.loads(body)))
+                status = fake.statuses.pop(0) if fake.statuses else 200
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps({"ok": status == 200}).encode())
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def telegram():
+    fake = FakeTelegram()
+    yield fake
+    fake.close()
+
+
+@pytest.fixture
+def dispatcher(telegram):
+    app.run_migrations()
+    with app.engine.begin() as conn:
+        conn.execute(app.OrderNotification.__table__.delete())
+        conn.execute(app.OrderItem.__table__.delete())
+        conn.execute(app.Order.__table__.delete())
+    sender = TelegramSender("TOKEN", "42", api_url=telegram.url, timeout=5)
+    return app.NotificationDispatcher(
+        {sender.name: sender},
+        interval=1,
+        max_attempts=MAX_ATTEMPTS,
+        backoff_base=BACKOFF_BASE,
+        backoff_max=3600,
+        lease=300,
+    )
+
+
+def add_order() -> int:
+    """
+    Записывает заказ с одним уведомлением в канал telegram.
+    Возвращает id уведомления.
+    """
+    now = datetime.now()
+    payload = {
+        "event": "order.created",
+        "order_number": "BB-20260101-000001",
+        "items": [{"id": 1, "name": "Бокс", "price": 1500, "quantity": 2}],
+        "total_amount": 3000,
+        "client_phone": "+996555000001",
+        "client_comment": None,
+        "created_at": now.isoformat(),
+    }
+    db = app.SessionLocal()
+    try:
+        order = app.Order(
+            order_number=payload["order_number"],
+            items_json=json.dumps(payload["items"]),
+            total_amount=payload["total_amount"],
+            client_phone=payload["client_phone"],
+            created_at=now,
+        )
+        order.notifications.append(
+            app.OrderNotification(
+                channel="telegram",
+                payload=json.dumps(payload),
+                next_attempt_at=now,
+            )
+        )
+        db.add(order)
+        db.commit()
+        return order.notifications[0].id
+    finally:
+        db.close()
+
+
+def notification(notification_id: int):
+    with app.engine.connect() as conn:
+        return conn.execute(
+            select(app.OrderNotification).where(
+                app.OrderNotification.id == notification_id
+            )
+        ).one()
+
+
+def make_due(notification_id: int) -> None:
+    """Переводит время повтора в прошлое, как будто задержка прошла"""
+    with app.engine.begin() as conn:
+        conn.execute(
+            update(app.OrderNotification)
+            .where(app.OrderNotification.id == notification_id)
+            .values(next_attempt_at=datetime.now() - timedelta(seconds=1))
+        )
+
+
+def test_delivers_message(telegram, dispatcher):
+    notification_id = add_order()
+
+    dispatcher.dispatch_once()
+
+    assert len(telegram.messages) == 1
+    path, body = telegram.messages[0]
+    assert path == "/botTOKEN/sendMessage"
+    assert body["chat_id"] == "42"
+    assert "BB-20260101-000001" in body["text"]
+    assert "Итого: 3000 сом" in body["text"]
+    row = notification(notification_id)
+    assert row.status == "sent"
+    assert row.sent_at is not None
+    assert dispatcher.stats["sent"] == 1
+
+
+def test_retries_with_backoff(telegram, dispatcher):
+    notification_id = add_order()
+    telegram.statuses = [500, 502]
+
+    started = datetime.now()
+    dispatcher.dispatch_once()
+    row = notification(notification_id)
+    assert row.status == "pending"
+    assert row.attempts == 1
+    assert "HTTP 500" in row.last_error
+    delay = (row.next_attempt_at - started).total_seconds()
+    assert BACKOFF_BASE * 0.9 - 1 <= delay <= BACKOFF_BASE * 1.1 + 1
+
+    # До истечения задержки повторов нет
+    dispatcher.dispatch_once()
+    assert len(telegram.messages) == 1
+
+    # Вторая ошибка - задержка удваивается
+    make_due(notification_id)
+    started = datetime.now()
+    dispatcher.dispatch_once()
+    row = notification(notification_id)
+    assert row.attempts == 2
+    delay = (row.next_attempt_at - started).total_seconds()
+    assert BACKOFF_BASE * 2 * 0.9 - 1 <= delay <= BACKOFF_BASE * 2 * 1.1 + 1
+
+    make_due(notification_id)
+    dispatcher.dispatch_once()
+    assert notification(notification_id).status == "sent"
+    assert len(telegram.messages) == 3
+    assert dispatcher.stats == {"sent": 1, "retried": 2, "failed": 0}
+
+
+def test_gives_up_after_max_attempts(telegram, dispatcher):
+    notification_id = add_order()
+    telegram.statuses = [500] * (MAX_ATTEMPTS + 1)
+
+    for _ in range(MAX_ATTEMPTS):
+        make_due(notification_id)
+        dispatcher.dispatch_once()
+
+    row = notification(notification_id)
+    assert row.status == "failed"
+    assert row.attempts == MAX_ATTEMPTS
+    assert dispatcher.stats["failed"] == 1
+
+    # Отказанное уведомление больше не отправляется
+    make_due(notification_id)
+    dispatcher.dispatch_once()
+    assert len(telegram.messages) == MAX_ATTEMPTS
+
+
+def test_stale_claim_does_not_reschedule(telegram, dispatcher):
+    notification_id = add_order()
+    token, batch = dispatcher._claim("telegram", 1)
+
+    # Аренда истекла, и пачку взял другой процесс
+    with app.engine.begin() as conn:
+        conn.execute(
+            update(app.OrderNotification)
+            .where(app.OrderNotification.id == notification_id)
+            .values(claim="other-worker")
+        )
+    dispatcher._reschedule(token, batch, "HTTP 500")
+
+    row = notification(notification_id)
+    assert row.claim == "other-worker"
+    assert row.attempts == 0
+    assert row.last_error is None
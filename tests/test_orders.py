@@ -0,0 +1,118 @@
+"""
+Идемпотентность и лимиты заказов хранятся в общей базе: повторы с тем же
+Idempotency-Key создают один заказ, даже если приходят одновременно.
+"""
+
+import json
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+import app
+
+
+@pytest.fixture
+def shop(monkeypatch):
+    """Клиент приложения и форма заказа одного товара"""
+    app.run_migrations()
+    with app.engine.begin() as conn:
+        for model in (
+            app.IdempotencyKey,
+            app.RateBucket,
+            app.OrderNotification,
+            app.OrderItem,
+            app.Order,
+        ):
+            conn.execute(model.__table__.delete())
+    monkeypatch.setattr(app.order_rate_limiter, "burst", 1000)
+
+    db = app.SessionLocal()
+    try:
+        product = app.Product(
+            name="Бокс",
+            description="Тестовый бокс",
+            price=1500,
+            revision=app.next_catalog_revision(db),
+        )
+        db.add(product)
+        db.commit()
+        app.catalog_cache.rebuild(db)
+        product_id = product.id
+    finally:
+        db.close()
+
+    with TestClient(app.app) as test_client:
+        yield test_client, {
+            "items": json.dumps([{"id": product_id, "quantity": 2}]),
+            "total_amount": "3000",
+            "client_phone": "+996555123456",
+        }
+
+
+def order_count() -> int:
+    with app.engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(app.Order)).scalar()
+
+
+def test_concurrent_retries_create_one_order(shop):
+    client, form = shop
+    results = []
+
+    def post():
+        response = client.post(
+            "/api/orders", data=form, headers={"Idempotency-Key": "retry-1"}
+        )
+        results.append(response.json())
+
+    threads = [threading.Thread(target=post) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(result["success"] for result in results)
+    assert len({result["order_number"] for result in results}) == 1
+    assert order_count() == 1
+
+
+def test_key_reused_for_other_order(shop):
+    client, form = shop
+    headers = {"Idempotency-Key": "retry-2"}
+    first = client.post("/api/orders", data=form, headers=headers)
+    assert first.json()["success"]
+
+    response = client.post(
+        "/api/orders", data={**form, "client_comment": "другой"}, headers=headers
+    )
+    assert response.status_code == 422
+    assert order_count() == 1
+
+
+def test_rate_limit_is_kept_in_database(shop, monkeypatch):
+    client, form = shop
+    monkeypatch.setattr(app.order_rate_limiter, "burst", 2)
+
+    statuses = [
+        client.post("/api/orders", data=form).status_code for _ in range(3)
+    ]
+
+    assert statuses == [200, 200, 429]
+    with app.engine.connect() as conn:
+        keys = set(conn.scalars(select(app.RateBucket.key)))
+    assert keys == {"ip:testclient", "phone:996555123456"}
+
+
+def test_invalid_quantity_keeps_its_message(shop):
+    client, form = shop
+    items = [{"id": 1, "quantity": 0}]
+
+    response = client.post("/api/orders", data={**form, "items": json.dumps(items)})
+    assert response.json() == {
+        "success": False,
+        "error": "Неверное количество товара",
+    }
+
+    response = client.post("/api/orders", data={**form, "items": "{не json"})
+    assert response.json()["error"] == "Неверный формат товаров"